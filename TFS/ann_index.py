@@ -0,0 +1,258 @@
+"""
+TuneFuse Similarity Index
+
+Finding the songs closest to a given song by checking every song in the
+catalog gets slow once there are tens of thousands of them. This is an
+inverted-file (IVF) index over song embeddings, in plain NumPy:
+- Songs are grouped around a few hundred "centroids" (k-means); a search
+  only looks inside the groups closest to the query
+- Vectors are stored group by group in .npy files that workers open with
+  mmap, so loading is instant and every worker shares the same pages
+- New songs can be added at any time; they're kept in memory (and searched
+  exactly) until the next save folds them into the files
+- Each save writes a new version folder and then switches the CURRENT
+  pointer, so readers never see a half-written index
+
+Run `python ann_index.py [songs] [dims]` for a recall/latency benchmark
+against exact search.
+"""
+
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+
+
+def normalize_rows(vectors):
+    """Scale vectors to unit length, so a dot product is the cosine similarity"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def kmeans(vectors, n_lists, iterations=10, sample_size=50000, seed=0):
+    """Spherical k-means centroids, trained on a sample of the vectors"""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample_size:
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=n_lists)
+        # Empty groups get a random vector, so every centroid stays useful
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+def assign(vectors, centroids, chunk_size=8192):
+    """Index of the closest centroid for each vector"""
+    out = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        out[start:start + chunk_size] = np.argmax(vectors[start:start + chunk_size] @ centroids.T, axis=1)
+    return out
+
+
+class IVFIndex:
+    def __init__(self, centroids, vectors, offsets, keys, n_probe=None, directory=None, key_lookup=None):
+        """Use IVFIndex.build() or IVFIndex.load() rather than calling this directly"""
+        self.centroids = centroids  # (lists, dim)
+        self.vectors = vectors  # (songs, dim), stored list by list
+        self.offsets = offsets  # List l is vectors[offsets[l]:offsets[l + 1]]
+        self.keys = keys  # Song key for each row (bytes)
+        self.dim = centroids.shape[1]
+        self.n_probe = n_probe or max(1, len(centroids) // 16)
+        self.directory = directory
+        # Keys in sorted order and their rows, for finding a song's vector by binary search
+        self._sorted_keys, self._key_rows = key_lookup or self._key_lookup(keys)
+        self._pending_keys = []
+        self._pending_vectors = np.zeros((0, self.dim), dtype=np.float32)
+        self._pending_rows = {}  # key -> row in the pending buffer
+        self._replaced = np.zeros(len(keys), dtype=bool)  # Stored rows superseded by a pending one
+
+    @staticmethod
+    def _key_lookup(keys):
+        order = np.argsort(keys, kind='stable')
+        return keys[order], order
+
+    @classmethod
+    def build(cls, keys, vectors, n_lists=None, n_probe=None):
+        """Train centroids and build an index over (key, vector) pairs"""
+        vectors = normalize_rows(vectors)
+        n_lists = n_lists or max(1, min(len(vectors) // 39, int(4 * np.sqrt(len(vectors)))))
+        centroids = kmeans(vectors, n_lists)
+        keys = np.array([key.encode('utf-8') if isinstance(key, str) else key for key in keys])
+        return cls._from_assignment(centroids, vectors, keys, n_probe)
+
+    @classmethod
+    def _from_assignment(cls, centroids, vectors, keys, n_probe=None):
+        assignment = assign(vectors, centroids)
+        order = np.argsort(assignment, kind='stable')
+        offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=len(centroids)), out=offsets[1:])
+        return cls(centroids, vectors[order], offsets, keys[order], n_probe)
+
+    @classmethod
+    def load(cls, directory, n_probe=None):
+        """Open the current version of a saved index (memory-mapped, nothing is copied)"""
+        with open(os.path.join(directory, 'CURRENT')) as f:
+            version = os.path.join(directory, f.read().strip())
+
+        def part(name):
+            return np.load(os.path.join(version, f'{name}.npy'), mmap_mode='r')
+
+        return cls(part('centroids'), part('vectors'), part('offsets'), part('keys'), n_probe, directory,
+                   key_lookup=(part('sorted_keys'), part('key_rows')))
+
+    @staticmethod
+    def current_version(directory):
+        """Name of the saved version in use, or None if there's no index yet"""
+        try:
+            with open(os.path.join(directory, 'CURRENT')) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def __len__(self):
+        return len(self.keys) - int(self._replaced.sum()) + len(self._pending_keys)
+
+    def _stored_row(self, key):
+        position = np.searchsorted(self._sorted_keys, key)
+        if position < len(self._sorted_keys) and self._sorted_keys[position] == key:
+            return int(self._key_rows[position])
+        return None
+
+    def vector(self, key):
+        """The stored vector for a song key, or None"""
+        key = key.encode('utf-8') if isinstance(key, str) else key
+        if key in self._pending_rows:
+            return self._pending_vectors[self._pending_rows[key]]
+        row = self._stored_row(key)
+        return None if row is None else np.asarray(self.vectors[row])
+
+    def add(self, keys, vectors):
+        """Add (or replace) songs. They're searchable straight away and written out on save()."""
+        vectors = normalize_rows(np.atleast_2d(vectors))
+        new_rows = []
+        for key, vector in zip(keys, vectors):
+            key = key.encode('utf-8') if isinstance(key, str) else key
+            row = self._stored_row(key)
+            if row is not None:
+                self._replaced[row] = True
+            if key in self._pending_rows:
+                self._pending_vectors[self._pending_rows[key]] = vector
+            else:
+                self._pending_rows[key] = len(self._pending_keys)
+                new_rows.append(vector)
+                self._pending_keys.append(key)
+        if new_rows:
+            self._pending_vectors = np.vstack([self._pending_vectors, np.asarray(new_rows, dtype=np.float32)])
+
+    def search(self, query, k=10, n_probe=None):
+        """The k songs most similar to a query vector, as [(key, score)], best first"""
+        query = normalize_rows(query)
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+
+        rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+        if self._replaced.any():
+            rows = rows[~self._replaced[rows]]
+        candidates = [(rows, np.asarray(self.vectors[rows]) @ query)] if len(rows) else []
+        if self._pending_keys:
+            candidates.append((-1 - np.arange(len(self._pending_keys)), self._pending_vectors @ query))
+        if not candidates:
+            return []
+
+        rows = np.concatenate([c[0] for c in candidates])
+        scores = np.concatenate([c[1] for c in candidates])
+        if len(scores) > k:
+            best = np.argpartition(-scores, k)[:k]
+            rows, scores = rows[best], scores[best]
+        order = np.argsort(-scores, kind='stable')
+        return [((self.keys[row] if row >= 0 else self._pending_keys[-1 - row]).decode('utf-8'), float(score))
+                for row, score in zip(rows[order], scores[order])]
+
+    def similar(self, key, k=10, n_probe=None):
+        """The k songs most similar to a stored song (not including itself)"""
+        vector = self.vector(key)
+        if vector is None:
+            return []
+        return [(other, score) for other, score in self.search(vector, k + 1, n_probe) if other != key][:k]
+
+    def save(self, directory, keep_versions=2):
+        """Write the index (pending songs included) as a new version and make it current"""
+        keys, vectors = self.keys[~self._replaced], np.asarray(self.vectors[~self._replaced])
+        if self._pending_keys:
+            keys = np.concatenate([keys, np.asarray(self._pending_keys, dtype=bytes)])
+            vectors = np.vstack([vectors, self._pending_vectors])
+        merged = IVFIndex._from_assignment(np.asarray(self.centroids), vectors, keys)
+
+        os.makedirs(directory, exist_ok=True)
+        version = f"v{time.time_ns()}"
+        path = os.path.join(directory, version)
+        os.makedirs(path)
+        for name, array in (('centroids', merged.centroids), ('vectors', merged.vectors),
+                            ('offsets', merged.offsets), ('keys', merged.keys),
+                            ('sorted_keys', merged._sorted_keys), ('key_rows', merged._key_rows)):
+            np.save(os.path.join(path, f'{name}.npy'), array)
+        with open(os.path.join(path, 'manifest.json'), 'w') as f:
+            json.dump({"songs": len(merged.keys), "lists": len(merged.centroids), "dim": merged.dim}, f)
+
+        # Switch readers over in one step
+        pointer = os.path.join(directory, f'CURRENT.{os.getpid()}')
+        with open(pointer, 'w') as f:
+            f.write(version)
+        os.replace(pointer, os.path.join(directory, 'CURRENT'))
+
+        # Old versions can go; workers that still have them mapped keep working
+        versions = sorted(name for name in os.listdir(directory) if name.startswith('v'))
+        for old in versions[:-keep_versions]:
+            shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+        logging.info(f"Saved similarity index {version}: {len(merged.keys)} songs")
+        return version
+
+
+def benchmark(songs=50000, dim=64, queries=200, k=10, seed=0):
+    """Recall and latency of the index against exact (brute-force) search on clustered data"""
+    import tempfile
+    rng = np.random.default_rng(seed)
+    # Songs cluster loosely around "genres", like real embeddings do
+    genres = normalize_rows(rng.normal(size=(200, dim)))
+    vectors = normalize_rows(genres[rng.integers(0, len(genres), songs)] + 0.2 * rng.normal(size=(songs, dim)))
+    keys = [f"song{i}" for i in range(songs)]
+    picks = rng.choice(songs, queries, replace=False)
+
+    started = time.perf_counter()
+    exact = []
+    for i in picks:
+        scores = vectors @ vectors[i]
+        exact.append(set(np.argpartition(-scores, k)[:k]))
+    exact_ms = (time.perf_counter() - started) / queries * 1000
+
+    started = time.perf_counter()
+    index = IVFIndex.build(keys, vectors)
+    print(f"{songs} songs x {dim} dims, {len(index.centroids)} lists, built in {time.perf_counter() - started:.1f}s")
+    with tempfile.TemporaryDirectory() as directory:
+        index.save(directory)
+        started = time.perf_counter()
+        index = IVFIndex.load(directory)
+        print(f"Loaded (mmap) in {(time.perf_counter() - started) * 1000:.1f} ms")
+        print(f"Exact search: {exact_ms:.2f} ms/query")
+        for n_probe in (4, 8, 16, 32, 64):
+            started = time.perf_counter()
+            found = [index.search(vectors[i], k, n_probe) for i in picks]
+            ms = (time.perf_counter() - started) / queries * 1000
+            recall = np.mean([len(truth & {int(key[4:]) for key, _ in result}) / k
+                              for truth, result in zip(exact, found)])
+            print(f"n_probe={n_probe:>3}: recall@{k} {recall:.3f}, {ms:.2f} ms/query")
+
+
+if __name__ == '__main__':
+    import sys
+    benchmark(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,493 @@
+"""
+TuneFuse Async Server
+
+The same app as server.py (same routes, same JSON), but fully async so one
+process can keep thousands of slow Spotify/Last.fm/Deezer requests waiting
+at once instead of tying up a thread for each:
+- Upstream calls use the shared aiohttp session on the server's event loop
+- Database calls run on a small thread pool so they never block the loop
+- Sessions use the same signed cookies as the Flask app
+
+Run it with an ASGI server, e.g.:
+    uvicorn asgi:app --workers 4
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from quart import Quart, Response, request, jsonify, render_template, session, send_file, g
+from quart.wrappers.response import DataBody, IterableBody
+
+import server
+from server import (
+    db, autocomplete, preview_cache, upstream_cache, normalize_track_key,
+    get_recommendations, find_preview_url, SpotifyUnavailable, CircuitOpen, RateLimited,
+    missing_registration_fields, login_error_message, page_limit, wants,
+    change_songs, caught_up, batch_song_changes, BATCH_ACTIONS,
+    metrics, profiler, upstream_call, start_request_timing,
+    static_assets, library_etag, library_headers,
+    PREVIEW_CHUNK_SIZE, SERVER_TIMING
+)
+from http_pool import get_session, close_session
+from database import submit_hash, submit_check
+import http_cache
+
+DB_THREADS = int(os.getenv("DB_THREADS", "8"))  # Database calls running at once per process
+
+app = Quart(__name__,
+    static_folder='assets',
+    static_url_path=''
+)
+# Same secret and cookie settings as the Flask app, so sessions work in both
+app.secret_key = server.app.secret_key
+for setting in ('SESSION_COOKIE_SECURE', 'SESSION_COOKIE_HTTPONLY', 'PERMANENT_SESSION_LIFETIME'):
+    app.config[setting] = server.app.config[setting]
+
+@app.context_processor
+async def asset_helpers():
+    return {"asset_url": static_assets.url}
+
+async def body_chunks(body):
+    async with body:
+        async for chunk in body:
+            yield chunk
+
+@app.after_request
+async def compress_response(response):
+    """Compress JSON, HTML, CSS and JS for browsers that accept it (like the Flask app)"""
+    if not http_cache.should_compress(response.mimetype, response.status_code, response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = http_cache.choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+    if isinstance(response.response, IterableBody):
+        response.response = IterableBody(http_cache.compress_stream_async(body_chunks(response.response), encoding))
+        response.headers.pop('Content-Length', None)
+    elif isinstance(response.response, DataBody):
+        data = await response.get_data()
+        if len(data) < http_cache.COMPRESS_MIN_BYTES:
+            return response
+        response.set_data(http_cache.compress(data, encoding))
+    else:
+        return response  # Files are served as they are
+    response.headers['Content-Encoding'] = encoding
+    if 'ETag' in response.headers:
+        response.headers['ETag'] = http_cache.encoded_etag(response.headers['ETag'], encoding)
+    return response
+
+# SQLite is blocking, so every database call goes through this pool
+db_pool = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+
+async def run_db(func, *args):
+    """Run a Database method without blocking the event loop (keeping the request's timing)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_pool, contextvars.copy_context().run, func, *args)
+
+def route_name():
+    """The route pattern that matched, like server.route_name()"""
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+# Same request metrics as the Flask app
+@app.before_request
+async def start_request_metrics():
+    metrics.start_publishing()
+    g.request_started = time.perf_counter()
+    g.request_timing = start_request_timing()
+    metrics.add('tunefuse_http_requests_in_flight', 1)
+    g.profile = profiler.begin(f"{request.method} {route_name()}", task=asyncio.current_task()) if profiler else None
+
+@app.after_request
+async def record_request_metrics(response):
+    if 'request_started' in g:
+        metrics.observe('tunefuse_http_request_duration_seconds', time.perf_counter() - g.request_started,
+                        {"route": route_name(), "method": request.method, "status": response.status_code})
+        if SERVER_TIMING:
+            response.headers['Server-Timing'] = g.request_timing.header()
+    return response
+
+@app.teardown_request
+async def finish_request_metrics(error=None):
+    if g.pop('request_started', None) is not None:
+        metrics.add('tunefuse_http_requests_in_flight', -1)
+        if g.profile:
+            profiler.end(g.profile)
+
+@app.after_serving
+async def shutdown():
+    await close_session()
+
+# Routes
+@app.route('/')
+async def home():
+    return await render_template('index.html')
+
+@app.route('/assets/<path:name>')
+async def hashed_asset(name):
+    """CSS, JS and images under their content-hashed names (see StaticAssets)"""
+    answer = static_assets.respond(name, request.headers.get('Accept-Encoding'), request.headers.get('If-None-Match'))
+    if answer is None:
+        return jsonify({"error": "Not found"}), 404
+    status, body, mimetype, headers = answer
+    return Response(body, status=status, mimetype=mimetype, headers=headers)
+
+@app.route('/api/search')
+async def search():
+    """Handle search with Spotify"""
+    query = request.args.get('q')
+    if not query:
+        return jsonify([])
+
+    try:
+        return jsonify(await autocomplete.search_async(query))
+    except (SpotifyUnavailable, CircuitOpen, RateLimited):
+        return jsonify({"error": "Spotify service unavailable"}), 503
+    except Exception as e:
+        logging.error(f"Spotify search error: {str(e)}")
+        return jsonify({"error": "Search failed"}), 500
+
+@app.route('/api/cache/stats')
+async def cache_stats():
+    """Hit/miss/eviction counters for the upstream cache"""
+    return jsonify(upstream_cache.stats())
+
+@app.route('/metrics')
+async def metrics_page():
+    """Prometheus metrics for this worker (and every other live worker, with METRICS_DIR)"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/check_login')
+async def check_login():
+    """Check if user is logged in (only reads the signed session cookie, never the database)"""
+    return jsonify({
+        "logged_in": 'user_id' in session
+    })
+
+# Auth routes
+@app.route('/api/register', methods=['POST'])
+async def register():
+    """Handle user registration"""
+    try:
+        data = await request.get_json()
+        if not data:
+            return jsonify({"error": "No data provided"}), 400
+
+        # Check required fields
+        missing = missing_registration_fields(data)
+        if missing:
+            return jsonify({
+                "error": f"Missing required fields: {', '.join(missing)}"
+            }), 400
+
+        # Hashing is slow on purpose; wait for it without holding a database thread
+        password_hash = await asyncio.wrap_future(submit_hash(data['password']))
+
+        # Try to create user
+        result = await run_db(lambda: db.create_user(
+            username=data['username'],
+            password=data['password'],
+            password_hash=password_hash,
+            firstname=data['firstname'],
+            lastname=data['lastname'],
+            email=data['email'],
+            age=data.get('dob'),
+            sex=data.get('sex'),
+            country=data.get('country')
+        ))
+
+        if result.get("success"):
+            return jsonify({
+                "success": True,
+                "message": "Registration successful",
+                "user_id": result["user_id"]
+            }), 200
+        else:
+            # Return the specific error message
+            return jsonify({
+                "success": False,
+                "error": result.get("error", "Registration failed")
+            }), 409
+
+    except Exception as e:
+        app.logger.error(f"Registration error: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": "An unexpected error occurred"
+        }), 500
+
+@app.route('/api/login', methods=['POST'])
+async def login():
+    """Handle user login"""
+    try:
+        data = await request.get_json()
+        if not data:
+            return jsonify({"success": False, "error": "No data provided"}), 400
+
+        username = data.get('username', '').strip()
+        password = data.get('password', '')
+
+        if not username or not password:
+            return jsonify({
+                "success": False,
+                "error": "Username and password are required"
+            }), 400
+
+        # Same as db.verify_user, but the password check is awaited rather than blocking a thread
+        user = await run_db(db.find_login, username)
+        password_ok = bool(user) and await asyncio.wrap_future(submit_check(user[2], password))
+        result = await run_db(db.finish_login, username, user, password_ok, password)
+
+        if result and "id" in result:
+            session.clear()
+            session['user_id'] = result['id']
+            session.permanent = True
+
+            return jsonify({
+                "success": True,
+                "message": "Login successful",
+                "user": {
+                    "id": result['id'],
+                    "username": result['username']
+                }
+            }), 200
+
+        # Handle specific error cases
+        return jsonify({
+            "success": False,
+            "error": login_error_message(result)
+        }), 401
+
+    except Exception as e:
+        app.logger.error(f"Login error: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": "An error occurred during login"
+        }), 500
+
+@app.route('/api/logout', methods=['POST'])
+async def logout():
+    session.pop('user_id', None)
+    return jsonify({"success": True, "message": "Logout successful"})
+
+# Song management routes
+async def stream_song_pages(get_page, user_id, page_size=500):
+    """Write a JSON array page by page, fetching each page off the event loop"""
+    yield '['
+    after, first = None, True
+    while True:
+        songs, after = await run_db(get_page, user_id, page_size, after)
+        for song in songs:
+            yield ('' if first else ',') + json.dumps(song)
+            first = False
+        if after is None:
+            break
+    yield ']'
+
+async def song_listing(user_id, kind, list_songs, get_page):
+    """Answer a liked/hidden listing request (same options, ETags and errors as the Flask app)"""
+    try:
+        await run_db(caught_up, user_id)
+        etag = await run_db(library_etag, user_id, kind, request.query_string)
+        matched = http_cache.matching_etag(request.headers.get('If-None-Match'), etag)
+        if matched:
+            return library_headers(Response('', status=304), matched)
+
+        if wants(request.args, 'stream'):
+            response = Response(stream_song_pages(get_page, user_id), mimetype='application/json')
+        elif 'limit' not in request.args and 'after' not in request.args:
+            response = jsonify(await run_db(list_songs, user_id))
+        else:
+            try:
+                songs, next_cursor = await run_db(get_page, user_id, page_limit(request.args),
+                                                  request.args.get('after'))
+            except ValueError:
+                return jsonify({"error": "Invalid limit or cursor"}), 400
+            response = jsonify({"songs": songs, "next": next_cursor})
+    except sqlite3.Error as e:
+        logging.error(f"Error listing {kind} songs: {e}")
+        return jsonify({"error": f"Failed to get {kind} songs"}), 500
+    return library_headers(response, f'"{etag}"')
+
+@app.route('/api/songs/like', methods=['GET', 'POST', 'DELETE'])
+async def handle_like():
+    """Handle liking/unliking songs and getting liked songs"""
+    if 'user_id' not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    user_id = session['user_id']
+
+    if request.method == 'GET':
+        return await song_listing(user_id, 'liked', db.get_liked_songs, db.get_liked_songs_page)
+
+    song_data = await request.get_json()
+
+    if request.method == 'POST':
+        success = await run_db(change_songs, [db.song_change('like', user_id, song_data)])
+        if success:
+            return jsonify({"message": "Song liked"}), 200
+        return jsonify({"error": "Failed to like song"}), 500
+
+    elif request.method == 'DELETE':
+        success = await run_db(change_songs, [db.song_change('unlike', user_id, song_data)])
+        if success:
+            return jsonify({"message": "Song unliked"}), 200
+        return jsonify({"error": "Failed to unlike song"}), 500
+
+@app.route('/api/songs/hide', methods=['POST'])
+async def hide_song():
+    """Handle hiding songs"""
+    if 'user_id' not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    user_id = session['user_id']
+    song_data = await request.get_json()
+
+    if await run_db(change_songs, [db.song_change('hide', user_id, song_data)]):
+        return jsonify({"message": "Song hidden"}), 200
+    return jsonify({"error": "Failed to hide song"}), 500
+
+@app.route('/api/songs/hidden', methods=['GET'])
+async def get_hidden_songs():
+    """Get list of hidden songs"""
+    if 'user_id' not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    return await song_listing(session['user_id'], 'hidden', db.get_hidden_songs, db.get_hidden_songs_page)
+
+@app.route('/api/songs/unhide', methods=['POST'])
+async def unhide_song():
+    """Handle unhiding songs"""
+    if 'user_id' not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    song_data = await request.get_json()
+    success = await run_db(change_songs, [db.song_change('unhide', session['user_id'], song_data)])
+
+    if success:
+        return jsonify({"message": "Song unhidden"}), 200
+    return jsonify({"error": "Failed to unhide song"}), 500
+
+@app.route('/api/songs/batch/<action>', methods=['POST'])
+async def batch_songs(action):
+    """Like, unlike, hide or unhide many songs at once, all in one transaction"""
+    if 'user_id' not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    if action not in BATCH_ACTIONS:
+        return jsonify({"error": "Unknown action"}), 404
+
+    try:
+        changes = batch_song_changes(session['user_id'], action, await request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if await run_db(change_songs, changes):
+        return jsonify({"message": f"{len(changes)} songs {BATCH_ACTIONS[action]}"}), 200
+    return jsonify({"error": f"Failed to {action} songs"}), 500
+
+@app.route('/api/recommendations')
+async def recommendations():
+    """Get recommendations from our own users' likes, or Last.fm and Deezer ranked together"""
+    track = request.args.get('track')
+    artist = request.args.get('artist')
+    exclude_liked = wants(request.args, 'exclude_liked')
+
+    if not track or not artist:
+        return jsonify({"error": "Missing track or artist"}), 400
+
+    try:
+        # Logged-in users never get songs they've hidden (or, if asked, already liked)
+        excluded = liked = frozenset()
+        if 'user_id' in session:
+            await run_db(caught_up, session['user_id'])
+            excluded = await run_db(db.get_hidden_filter, session['user_id'])
+            liked = await run_db(db.get_liked_filter, session['user_id'])
+            if exclude_liked:
+                excluded = excluded | liked
+
+        recommendation_source, results = await get_recommendations(track, artist, excluded, liked)
+
+        # Add source to response
+        return jsonify({
+            "source": recommendation_source,
+            "results": results
+        })
+
+    except Exception as e:
+        logging.error(f"Recommendations error: {str(e)}")
+        return jsonify({"error": "Failed to fetch recommendations"}), 500
+
+async def send_cached_preview(path):
+    """Serve a cached preview file (handles Range requests)"""
+    response = await send_file(path, mimetype='audio/mpeg', conditional=True)
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+@app.route('/api/preview')
+async def preview():
+    """Play a song's 30-second preview, cached on disk after the first listen"""
+    track = request.args.get('track')
+    artist = request.args.get('artist')
+
+    if not track or not artist:
+        return jsonify({"error": "Missing track or artist"}), 400
+
+    key = normalize_track_key(track, artist)
+    path = preview_cache.get(key)
+    metrics.inc('tunefuse_preview_requests_total', {"cached": "yes" if path else "no"})
+    if path:
+        return await send_cached_preview(path)
+
+    try:
+        upstream = None
+        for refresh in (False, True):
+            preview_url = await find_preview_url(track, artist, refresh=refresh)
+            if not preview_url:
+                return jsonify({"error": "No preview available"}), 404
+            with upstream_call('deezer_preview') as labels:
+                upstream = await get_session().get(preview_url, timeout=aiohttp.ClientTimeout(total=10))
+                labels['status'] = upstream.status
+            if upstream.status == 200:
+                break
+            # Most likely an expired link, so look it up again once
+            upstream.release()
+            upstream = None
+        if upstream is None:
+            return jsonify({"error": "Preview unavailable"}), 502
+    except Exception as e:
+        logging.error(f"Preview error: {str(e)}")
+        return jsonify({"error": "Preview unavailable"}), 502
+
+    # A range request needs the whole file first; previews are only a few hundred KB
+    if request.headers.get('Range'):
+        try:
+            async with upstream:
+                body = await upstream.read()
+            path = await asyncio.get_running_loop().run_in_executor(None, preview_cache.store, key, [body])
+        except Exception as e:
+            logging.error(f"Preview download error: {str(e)}")
+            return jsonify({"error": "Preview unavailable"}), 502
+        return await send_cached_preview(path)
+
+    # Otherwise relay the bytes as they arrive and keep a copy on disk
+    async def relay():
+        async with upstream:
+            with preview_cache.writer(key) as out:
+                async for chunk in upstream.content.iter_chunked(PREVIEW_CHUNK_SIZE):
+                    out.write(chunk)
+                    yield chunk
+
+    headers = {"Accept-Ranges": "bytes", "Cache-Control": "public, max-age=86400"}
+    if upstream.headers.get('Content-Length'):
+        headers["Content-Length"] = upstream.headers['Content-Length']
+    return Response(relay(), mimetype='audio/mpeg', headers=headers)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run("asgi:app", host="127.0.0.1", port=5000, workers=int(os.getenv("ASGI_WORKERS", "1")))
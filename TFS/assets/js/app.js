@@ -151,8 +151,8 @@ async function showSongDetails(song) {
                             <p>${rec.artist}</p>
                         </div>
                         ${rec.preview_url ? `
-                            <audio controls class="preview-player">
-                                <source src="${rec.preview_url}" type="audio/mp3">
+                            <audio controls class="preview-player" preload="none">
+                                <source src="/api/preview?track=${encodeURIComponent(rec.title)}&artist=${encodeURIComponent(rec.artist)}" type="audio/mp3">
                             </audio>
                         ` : '<p class="no-preview">No preview available</p>'}
                     </div>
@@ -195,15 +195,6 @@ window.likeSong = async function(songId, title, artist, image, buttonElement) {
     }
 
     try {
-        const loginCheck = await fetch('/api/check_login');
-        const loginStatus = await loginCheck.json();
-        
-        if (!loginStatus.logged_in) {
-            alert('Please log in to like songs');
-            toggleModal('loginModal');
-            return;
-        }
-
         const imgElement = buttonElement.querySelector('img');
         if (!imgElement) {
             console.error('No image element found');
@@ -224,6 +215,13 @@ window.likeSong = async function(songId, title, artist, image, buttonElement) {
             })
         });
 
+        // The server tells us if we're logged out, no need to ask it first
+        if (response.status === 401) {
+            alert('Please log in to like songs');
+            toggleModal('loginModal');
+            return;
+        }
+
         if (response.ok) {
             // Update button state
             imgElement.src = `/images/${isLiked ? 'like-icon.png' : 'like-icon-liked.png'}`;
@@ -257,15 +255,6 @@ window.likeSong = async function(songId, title, artist, image, buttonElement) {
 
 window.hideSong = async function(songId, title, artist, albumCover) {
     try {
-        const loginCheck = await fetch('/api/check_login');
-        const loginStatus = await loginCheck.json();
-        
-        if (!loginStatus.logged_in) {
-            alert('Please log in to hide songs');
-            toggleModal('loginModal');
-            return;
-        }
-
         const response = await fetch('/api/songs/hide', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
@@ -278,6 +267,12 @@ window.hideSong = async function(songId, title, artist, albumCover) {
             })
         });
 
+        if (response.status === 401) {
+            alert('Please log in to hide songs');
+            toggleModal('loginModal');
+            return;
+        }
+
         if (response.ok) {
             // Remove song from any list where it appears
             const songElements = document.querySelectorAll(`[data-song-id="${songId}"]`);
@@ -0,0 +1,244 @@
+"""
+TuneFuse Autocomplete
+
+The search box asks for suggestions on (almost) every keystroke, and lots of
+people type the same popular songs. This sits in front of the Spotify search:
+- Queries are normalized, so "Daft  Punk" and "daft punk" are the same thing
+- Answers are cached for a few minutes in a prefix tree, so "daft pu" can be
+  answered from "daft p" when that answer was already complete
+- Identical searches running at the same time share one Spotify call
+- If Spotify is slow, we answer from what we already know and let the
+  Spotify answer fill the cache for the next keystroke
+"""
+
+import asyncio
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_query(query):
+    """Lowercase and tidy up a search query"""
+    return _WHITESPACE.sub(' ', (query or '').casefold()).strip()
+
+
+def _matches(result, words):
+    """True if every word of the query appears in the song's title or artist"""
+    text = f"{result.get('title', '')} {result.get('artist', '')}".casefold()
+    return all(word in text for word in words)
+
+
+class PrefixCache:
+    def __init__(self, max_entries=5000, ttl=300):
+        """Recent search answers, indexed by a trie of their queries"""
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # query -> (expires_at, results, complete)
+        self._trie = {}
+        self._lock = threading.Lock()
+
+    def _trie_add(self, query):
+        node = self._trie
+        for char in query:
+            node = node.setdefault(char, {})
+        node[None] = True  # Marks the end of a cached query
+
+    def _trie_remove(self, query):
+        path = [self._trie]
+        for char in query:
+            node = path[-1].get(char)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].pop(None, None)
+        # Prune branches that no longer lead to any query
+        for char, parent in zip(reversed(query), reversed(path[:-1])):
+            if parent[char]:
+                break
+            del parent[char]
+
+    def _live(self, query, now):
+        entry = self._entries.get(query)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._entries[query]
+            self._trie_remove(query)
+            return None
+        return entry
+
+    def get(self, query):
+        """Results for exactly this query, or None"""
+        with self._lock:
+            entry = self._live(query, time.time())
+            if entry is None:
+                return None
+            self._entries.move_to_end(query)
+            return entry[1]
+
+    def longest_prefix(self, query):
+        """The longest cached query that query starts with: (results, complete), or None"""
+        with self._lock:
+            now = time.time()
+            node, best = self._trie, None
+            for length, char in enumerate(query, start=1):
+                node = node.get(char)
+                if node is None:
+                    break
+                if None in node and self._live(query[:length], now):
+                    best = query[:length]
+            if best is None:
+                return None
+            entry = self._entries[best]
+            return entry[1], entry[2]
+
+    def set(self, query, results, complete):
+        """Remember an answer. complete means Spotify had nothing more to give."""
+        with self._lock:
+            if query not in self._entries:
+                self._trie_add(query)
+            self._entries[query] = (time.time() + self.ttl, results, complete)
+            self._entries.move_to_end(query)
+            while len(self._entries) > self.max_entries:
+                old_query, _ = self._entries.popitem(last=False)
+                self._trie_remove(old_query)
+
+
+class Autocomplete:
+    def __init__(self, fetch, local_search=None, limit=10, ttl=300, upstream_timeout=0.8, workers=8,
+                 fetch_async=None):
+        """fetch(query) calls Spotify; local_search(query, limit) searches our own data.
+
+        fetch_async is the coroutine version of fetch, used by search_async.
+        """
+        self.fetch = fetch
+        self.fetch_async = fetch_async
+        self.local_search = local_search
+        self.limit = limit
+        self.upstream_timeout = upstream_timeout  # How long we wait before answering locally
+        self.cache = PrefixCache(ttl=ttl)
+        self._inflight = {}  # query -> Future shared by everyone asking the same thing
+        self._inflight_async = {}  # Same, for search_async (asyncio tasks)
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="search-upstream")
+
+    def _upstream(self, query):
+        """Start (or join) the Spotify call for a query"""
+        with self._lock:
+            future = self._inflight.get(query)
+            if future is not None:
+                return future
+            future = self._pool.submit(self.fetch, query)
+            self._inflight[query] = future
+        # Outside the lock: if the call already finished, the callback runs
+        # right here and takes the lock itself
+        future.add_done_callback(lambda f: self._finished(query, f))
+        return future
+
+    def _finished(self, query, future):
+        with self._lock:
+            self._inflight.pop(query, None)
+        self._remember(query, future)
+
+    def _remember(self, query, future):
+        if not future.cancelled() and future.exception() is None:
+            results = future.result()
+            self.cache.set(query, results, complete=len(results) < self.limit)
+
+    def _local_results(self, query):
+        """Best answer we can give without Spotify"""
+        words = query.split(' ')
+        results, seen = [], set()
+        prefix = self.cache.longest_prefix(query)
+        candidates = list(prefix[0]) if prefix else []
+        if self.local_search:
+            try:
+                candidates += self.local_search(query, self.limit)
+            except Exception as e:
+                logging.error(f"Local search error: {e}")
+        for result in candidates:
+            if result['id'] not in seen and _matches(result, words):
+                seen.add(result['id'])
+                results.append(result)
+        return results[:self.limit]
+
+    def _cached_answer(self, query):
+        """An answer we can give straight from the cache, or None"""
+        cached = self.cache.get(query)
+        if cached is not None:
+            return cached
+
+        # A complete answer for a shorter query already contains every match for this one
+        prefix = self.cache.longest_prefix(query)
+        if prefix and prefix[1]:
+            return [r for r in prefix[0] if _matches(r, query.split(' '))]
+        return None
+
+    def search(self, query):
+        """Suggestions for a query. Raises if Spotify fails and we have nothing else."""
+        query = normalize_query(query)
+        if not query:
+            return []
+
+        cached = self._cached_answer(query)
+        if cached is not None:
+            return cached
+
+        future = self._upstream(query)
+        try:
+            return future.result(timeout=self.upstream_timeout)
+        except TimeoutError:
+            # Spotify is slow: answer from what we know, the real answer will be cached for next time
+            local = self._local_results(query)
+            if local:
+                return local
+            return future.result()
+        except Exception:
+            local = self._local_results(query)
+            if local:
+                return local
+            raise
+
+    def _upstream_async(self, query):
+        """Start (or join) the Spotify call for a query, on the running event loop"""
+        task = self._inflight_async.get(query)
+        if task is None:
+            task = asyncio.ensure_future(self.fetch_async(query))
+            self._inflight_async[query] = task
+
+            def finished(task):
+                self._inflight_async.pop(query, None)
+                self._remember(query, task)
+            task.add_done_callback(finished)
+        return task
+
+    async def search_async(self, query):
+        """Same as search, without blocking the event loop"""
+        query = normalize_query(query)
+        if not query:
+            return []
+
+        cached = self._cached_answer(query)
+        if cached is not None:
+            return cached
+
+        loop = asyncio.get_running_loop()
+        task = self._upstream_async(query)
+        try:
+            # shield() keeps the shared Spotify call going for everyone else if we stop waiting
+            return await asyncio.wait_for(asyncio.shield(task), self.upstream_timeout)
+        except asyncio.TimeoutError:
+            local = await loop.run_in_executor(None, self._local_results, query)
+            if local:
+                return local
+            return await asyncio.shield(task)
+        except Exception:
+            local = await loop.run_in_executor(None, self._local_results, query)
+            if local:
+                return local
+            raise
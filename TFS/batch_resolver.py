@@ -0,0 +1,87 @@
+"""
+TuneFuse Batch Resolver
+
+Lots of recommendation requests ask about the same songs at the same time.
+Instead of every request looking up every candidate on its own, lookups go
+through a resolver shared by the whole worker:
+- Lookups that arrive within a short window are collected into one batch
+- Each song is looked up once per batch, no matter how many requests want it
+- A song that's already being looked up is joined, not looked up again
+- The answer is handed back to every request that was waiting for it
+"""
+
+import asyncio
+import logging
+
+
+class BatchResolver:
+    def __init__(self, resolve_batch, window=0.01, max_batch=50):
+        """resolve_batch(items, deadline) is a coroutine taking {key: item} and returning {key: answer}"""
+        self.resolve_batch = resolve_batch
+        self.window = window  # Seconds to wait for more lookups before sending a batch
+        self.max_batch = max_batch
+        self._waiting = {}  # key -> (future, item), not sent yet
+        self._inflight = {}  # key -> future, being looked up right now
+        self._deadline = 0
+        self._flush_handle = None
+        self.requested = 0
+        self.shared = 0
+        self.batches = 0
+
+    async def resolve(self, key, item, deadline):
+        """Answer for one key (None if it couldn't be found in time).
+
+        Cancelling this only stops the wait; the shared lookup carries on for
+        everyone else.
+        """
+        self.requested += 1
+        future = self._inflight.get(key)
+        if future is None and key in self._waiting:
+            future = self._waiting[key][0]
+        if future is not None:
+            self.shared += 1
+        else:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._waiting[key] = (future, item)
+            if len(self._waiting) >= self.max_batch:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = loop.call_later(self.window, self._flush)
+        # The batch runs until the latest deadline of anyone waiting on it
+        self._deadline = max(self._deadline, deadline)
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._waiting:
+            return
+        batch, self._waiting = self._waiting, {}
+        deadline, self._deadline = self._deadline, 0
+        for key, (future, _) in batch.items():
+            self._inflight[key] = future
+        self.batches += 1
+        asyncio.ensure_future(self._run(batch, deadline))
+
+    async def _run(self, batch, deadline):
+        try:
+            answers = await self.resolve_batch({key: item for key, (_, item) in batch.items()}, deadline)
+        except Exception as e:
+            logging.error(f"Batch lookup failed: {e}")
+            answers = {}
+        finally:
+            for key in batch:
+                self._inflight.pop(key, None)
+        for key, (future, _) in batch.items():
+            if not future.done():
+                future.set_result(answers.get(key))
+
+    def stats(self):
+        return {
+            "requested": self.requested,
+            "shared": self.shared,
+            "batches": self.batches,
+            "inflight": len(self._inflight)
+        }
@@ -0,0 +1,397 @@
+"""
+TuneFuse Benchmarks
+
+Repeatable performance numbers without touching the real Spotify, Last.fm
+or Deezer APIs:
+
+    python benchmark.py http [--requests 500] [--concurrency 16] [--latency 50] [--asgi]
+        Starts fake_upstream.py and the real app (each in its own process, in
+        a scratch folder with fresh databases), then sends concurrent search,
+        recommendation, preview and like requests. For each endpoint it prints
+        p50/p95/p99 latency, throughput, errors and upstream calls.
+
+    python benchmark.py db [--db bench_tunefuse.db] [--likes 2000000]
+        Generates a big database once (kept for the next run) and times the
+        Database calls the routes use.
+
+Everything is seeded (--seed), so two runs ask the same questions. Use
+--json FILE to save the numbers and compare before/after a change.
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentiles(samples):
+    """p50/p95/p99 (and mean) of a list of seconds, in milliseconds"""
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    ordered = sorted(samples)
+
+    def at(share):
+        return round(ordered[min(len(ordered) - 1, int(share * len(ordered)))] * 1000, 2)
+    return {"p50": at(0.50), "p95": at(0.95), "p99": at(0.99),
+            "mean": round(sum(ordered) / len(ordered) * 1000, 2)}
+
+
+def zipf_picker(size, rng, exponent=1.1):
+    """Pick numbers below size, a few of them very often and most rarely (like real traffic)"""
+    weights = [1 / (rank + 1) ** exponent for rank in range(size)]
+    cumulative, total = [], 0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    order = list(range(size))
+    rng.shuffle(order)
+    return lambda: order[rng.choices(range(size), cum_weights=cumulative)[0]]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, timeout=30):
+    give_up_at = time.monotonic() + timeout
+    while time.monotonic() < give_up_at:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} didn't come up within {timeout}s")
+
+
+def print_table(title, rows):
+    print(f"\n{title}")
+    columns = list(rows[0].keys())
+    widths = [max(len(str(c)), *(len(str(row[c])) for row in rows)) for c in columns]
+    print('  '.join(str(c).ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(row[c]).ljust(w) for c, w in zip(columns, widths)))
+
+
+### 🌐 HTTP BENCHMARK ###
+def start_processes(args, workdir):
+    """Start the fake upstream and the app. Returns (app_url, fake_url, processes)."""
+    fake_port, app_port = free_port(), free_port()
+    fake_url = f"http://127.0.0.1:{fake_port}"
+    log = open(os.path.join(workdir, 'benchmark.log'), 'w')
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(HERE, 'fake_upstream.py'), '--port', str(fake_port),
+        '--latency', str(args.latency), '--error-rate', str(args.error_rate),
+        '--throttle-rate', str(args.throttle_rate), '--seed', str(args.seed)
+    ], stdout=log, stderr=subprocess.STDOUT)
+
+    env = dict(os.environ,
+               PYTHONPATH=HERE,
+               SPOTIFY_CLIENT_ID='bench', SPOTIFY_CLIENT_SECRET='bench', LASTFM_API_KEY='bench',
+               SPOTIFY_API_URL=f"{fake_url}/spotify/v1",
+               SPOTIFY_TOKEN_URL=f"{fake_url}/spotify/api/token",
+               LASTFM_API_URL=f"{fake_url}/lastfm/2.0/",
+               DEEZER_API_URL=f"{fake_url}/deezer")
+    for setting in args.env:
+        name, _, value = setting.partition('=')
+        env[name] = value
+    if args.asgi:
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(app_port),
+                   '--log-level', 'warning', '--no-access-log']
+    else:
+        command = [sys.executable, os.path.abspath(__file__), '_serve', '--port', str(app_port)]
+    # A scratch folder as working directory means fresh databases and caches every run
+    app = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    app_url = f"http://127.0.0.1:{app_port}"
+    wait_for(f"{fake_url}/_stats")
+    wait_for(f"{app_url}/api/check_login")
+    return app_url, fake_url, [app, fake]
+
+
+def logged_in_session(app_url, name):
+    client = requests.Session()
+    client.post(f"{app_url}/api/register", json={
+        "username": name, "password": "benchmark-password", "email": f"{name}@example.com",
+        "firstname": "Bench", "lastname": "Mark"
+    })
+    response = client.post(f"{app_url}/api/login", json={"username": name, "password": "benchmark-password"})
+    response.raise_for_status()
+    return client
+
+
+def scenarios(args):
+    """Endpoint name -> function(client, rng, pick) that sends one request"""
+    from fake_upstream import song_title, artist_name
+
+    def search(client, rng, pick):
+        title = song_title(pick())
+        # People type: the first few letters, then a bit more
+        return client.get(f"{client.app_url}/api/search", params={"q": title[:rng.randint(6, len(title))]})
+
+    def recommendations(client, rng, pick):
+        n = pick()
+        return client.get(f"{client.app_url}/api/recommendations",
+                          params={"track": song_title(n), "artist": artist_name(n)})
+
+    def preview(client, rng, pick):
+        n = pick()
+        return client.get(f"{client.app_url}/api/preview", params={"track": song_title(n), "artist": artist_name(n)})
+
+    def like(client, rng, pick):
+        n = pick()
+        return client.post(f"{client.app_url}/api/songs/like", json={
+            "track_id": f"bench{n}", "track_name": song_title(n), "artist_name": artist_name(n)
+        })
+
+    def liked(client, rng, pick):
+        return client.get(f"{client.app_url}/api/songs/like", params={"limit": 50})
+
+    everything = {"search": search, "recommendations": recommendations, "preview": preview,
+                  "like": like, "liked": liked}
+    return {name: everything[name] for name in args.endpoints}
+
+
+def run_scenario(app_url, fake_url, clients, send, args, seed):
+    """Send args.requests requests from len(clients) threads at once. Returns the result row."""
+    latencies, statuses, lock = [], Counter(), threading.Lock()
+    remaining = [args.requests]
+    requests.post(f"{fake_url}/_reset")
+
+    def worker(index, client):
+        rng = random.Random(seed * 1000 + index)
+        pick = zipf_picker(args.songs, rng)
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            started = time.perf_counter()
+            try:
+                status = send(client, rng, pick).status_code
+            except requests.RequestException:
+                status = 'error'
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i, client)) for i, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    upstream = requests.get(f"{fake_url}/_stats").json()
+    failed = sum(count for status, count in statuses.items() if status == 'error' or status >= 500)
+    return dict(
+        requests=len(latencies),
+        **{"req/s": round(len(latencies) / elapsed, 1)},
+        **percentiles(latencies),
+        errors=failed,
+        upstream=sum(upstream['calls'].values()),
+        **{"upstream/req": round(sum(upstream['calls'].values()) / max(1, len(latencies)), 2)},
+        upstream_detail=upstream
+    )
+
+
+def http_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='tunefuse-bench-')
+    app_url, fake_url, processes = start_processes(args, workdir)
+    try:
+        clients = []
+        for i in range(args.concurrency):
+            client = logged_in_session(app_url, f"bench{i}")
+            client.app_url = app_url
+            clients.append(client)
+
+        results = {}
+        for seed, (name, send) in enumerate(scenarios(args).items()):
+            results[name] = run_scenario(app_url, fake_url, clients, send, args, args.seed + seed)
+        rows = [dict(endpoint=name, **{k: v for k, v in row.items() if k != 'upstream_detail'})
+                for name, row in results.items()]
+        print_table(f"{'ASGI' if args.asgi else 'Flask'} app, {args.concurrency} clients, "
+                    f"upstream latency {args.latency:g} ms (latencies in ms)", rows)
+        print(f"\nScratch folder (databases, app log): {workdir}")
+        return results
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def serve(args):
+    """Run the Flask app without the debugger or reloader (started by http_benchmark)"""
+    import logging
+    import server
+    logging.getLogger().setLevel(logging.WARNING)
+    server.app.run(host='127.0.0.1', port=args.port, threaded=True, debug=False, use_reloader=False)
+
+
+### 🗄️ DATABASE BENCHMARK ###
+def generate_database(path, users, songs, likes, seed):
+    """Fill a new database with made-up users, likes, hides and catalog entries"""
+    from database import Database, normalize_track_key, hash_password
+    from fake_upstream import song_title, artist_name, spotify_id
+
+    print(f"Generating {path}: {users} users, {songs} songs, {likes} likes (once, kept for later runs)")
+    started = time.perf_counter()
+    Database(path)  # Creates the tables and indexes
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA synchronous=OFF')
+    password = hash_password('benchmark-password')
+    conn.executemany(
+        'INSERT INTO users (username, password, email, firstname, lastname) VALUES (?, ?, ?, ?, ?)',
+        ((f"user{u}", password, f"user{u}@example.com", "Bench", "Mark") for u in range(users)))
+
+    conn.executemany(
+        'INSERT OR IGNORE INTO tracks (lookup_key, title, artist, spotify_id, deezer_id, preview_url, cover_url) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+        ((normalize_track_key(song_title(n), artist_name(n)), song_title(n), artist_name(n), spotify_id(n), str(n),
+          f"https://example.com/preview/{n}.mp3", f"https://example.com/covers/{n}.jpg") for n in range(songs)))
+
+    # A few heavy users and popular songs, a long tail of everything else
+    pick_user, pick_song = zipf_picker(users, rng, 0.8), zipf_picker(songs, rng, 0.9)
+    start = datetime(2024, 1, 1)
+
+    def rows(count):
+        for _ in range(count):
+            n = pick_song()
+            yield (pick_user() + 1, spotify_id(n), song_title(n), artist_name(n),
+                   f"https://example.com/covers/{n}.jpg",
+                   (start + timedelta(seconds=rng.randrange(365 * 24 * 3600))).strftime('%Y-%m-%d %H:%M:%S'))
+    conn.executemany('INSERT OR IGNORE INTO saved_songs (user_id, track_id, track_name, artist_name, album_cover, '
+                     'saved_at) VALUES (?, ?, ?, ?, ?, ?)', rows(likes))
+    conn.executemany('INSERT OR IGNORE INTO hidden_songs (user_id, track_id, track_name, artist_name, album_cover, '
+                     'hidden_at) VALUES (?, ?, ?, ?, ?, ?)', rows(likes // 10))
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+    print(f"Generated in {time.perf_counter() - started:.0f}s")
+
+
+def time_calls(call, iterations):
+    samples = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        call(i)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def db_benchmark(args):
+    from database import Database
+    from fake_upstream import song_title, artist_name
+
+    if not os.path.exists(args.db) or args.regenerate:
+        if os.path.exists(args.db):
+            os.remove(args.db)
+        generate_database(args.db, args.users, args.songs, args.likes, args.seed)
+
+    db = Database(args.db)
+    rng = random.Random(args.seed)
+    # An existing database may have been generated with other sizes
+    conn = db._get_connection()
+    count = conn.execute('SELECT COUNT(*) FROM saved_songs').fetchone()[0]
+    user_count = conn.execute('SELECT MAX(id) FROM users').fetchone()[0]
+    args.songs = conn.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+    heavy_user = conn.execute(
+        'SELECT user_id FROM saved_songs GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1').fetchone()[0]
+    users = [rng.randrange(1, user_count + 1) for _ in range(args.iterations)]
+    second_pages = [db.get_liked_songs_page(user, 50)[1] for user in users]
+
+    def liked_filter(i):
+        db._song_filters.delete(('saved_songs', users[i]))  # Time the query, not the cache
+        db.get_liked_filter(users[i])
+
+    def like(i):
+        n = rng.randrange(args.songs)
+        db.save_song(users[i], {"track_id": f"bench{n}", "track_name": song_title(n), "artist_name": artist_name(n)})
+
+    def like_batch(i):
+        numbers = [rng.randrange(args.songs) for _ in range(100)]
+        db.apply_song_changes([db.song_change('like', users[i], {
+            "track_id": f"bench{n}", "track_name": song_title(n), "artist_name": artist_name(n)
+        }) for n in numbers])
+
+    operations = {
+        "get_liked_songs_page": lambda i: db.get_liked_songs_page(users[i], 50),
+        "get_liked_songs_page (page 2)": lambda i: db.get_liked_songs_page(users[i], 50, second_pages[i]),
+        "get_hidden_songs_page": lambda i: db.get_hidden_songs_page(users[i], 50),
+        "get_liked_songs (heaviest user)": lambda i: db.get_liked_songs(heavy_user),
+        "get_liked_filter (uncached)": liked_filter,
+        "get_tracks (50 songs)": lambda i: db.get_tracks([
+            (song_title(n), artist_name(n)) for n in (rng.randrange(args.songs) for _ in range(50))]),
+        "search_tracks": lambda i: db.search_tracks(f"song {rng.randrange(1, 1000)}"),
+        "get_likes_since (5000 rows)": lambda i: db.get_likes_since(rng.randrange(max(1, count - 5000))),
+        "save_song": like,
+        "apply_song_changes (100 likes)": like_batch,
+    }
+
+    results = {}
+    for name, call in operations.items():
+        samples = time_calls(call, args.iterations)
+        results[name] = dict(calls=len(samples), **{"ops/s": round(len(samples) / sum(samples), 1)},
+                             **percentiles(samples))
+    print_table(f"Database with {count} likes (latencies in ms)",
+                [dict(operation=name, **row) for name, row in results.items()])
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline benchmarks for TuneFuse")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help="also write the results to this file")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    http = commands.add_parser('http', help="load-test the app against fake upstreams")
+    http.add_argument('--requests', type=int, default=500, help="requests per endpoint")
+    http.add_argument('--concurrency', type=int, default=16, help="clients sending at once")
+    http.add_argument('--endpoints', nargs='+', default=['search', 'recommendations', 'preview', 'like', 'liked'],
+                      choices=['search', 'recommendations', 'preview', 'like', 'liked'])
+    http.add_argument('--songs', type=int, default=5000, help="distinct songs the clients ask about")
+    http.add_argument('--latency', type=float, default=50, help="typical upstream response time in ms")
+    http.add_argument('--error-rate', type=float, default=0, help="share of upstream calls that fail with a 500")
+    http.add_argument('--throttle-rate', type=float, default=0, help="share of upstream calls that get a 429")
+    http.add_argument('--asgi', action='store_true', help="benchmark asgi.py (uvicorn) instead of the Flask app")
+    http.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                      help="setting for the app, e.g. --env SPOTIFY_RATE_LIMIT=1000 (repeatable)")
+
+    database = commands.add_parser('db', help="time Database calls on a big generated database")
+    database.add_argument('--db', default='bench_tunefuse.db')
+    database.add_argument('--users', type=int, default=50000)
+    database.add_argument('--songs', type=int, default=200000)
+    database.add_argument('--likes', type=int, default=2000000)
+    database.add_argument('--iterations', type=int, default=200, help="calls per operation")
+    database.add_argument('--regenerate', action='store_true', help="build the database again even if it exists")
+
+    serve_app = commands.add_parser('_serve')
+    serve_app.add_argument('--port', type=int)
+
+    args = parser.parse_args()
+    if args.command == '_serve':
+        serve(args)
+        sys.exit()
+    results = http_benchmark(args) if args.command == 'http' else db_benchmark(args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"command": args.command, "settings": {k: v for k, v in vars(args).items() if k != 'json'},
+                       "results": results}, f, indent=2)
@@ -0,0 +1,244 @@
+"""
+TuneFuse Response Cache
+
+The same popular songs get looked up over and over, so we remember what
+Last.fm, Deezer and Spotify told us last time. There are two layers:
+- A small, fast in-memory LRU inside each worker
+- A shared SQLite file on disk, so every worker (and restarts) can reuse answers
+
+Both layers respect per-entry expiry times, and "nothing found" answers can
+be stored for a shorter time than real ones.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+MISS = object()  # Returned when a key isn't cached (None is a valid cached value)
+
+
+class LRUCache:
+    def __init__(self, max_size=10000):
+        """In-memory cache that drops the least recently used entry when full"""
+        self.max_size = max_size
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Get a value, or MISS if it's not here or has expired"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISS
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return MISS
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None, expires_at=None):
+        """Store a value for ttl seconds (or until expires_at)"""
+        if expires_at is None:
+            expires_at = time.time() + ttl
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+
+class DiskCache:
+    def __init__(self, db_name='tunefuse_cache.db', purge_every=500):
+        """Shared on-disk cache, stored as JSON in its own SQLite file"""
+        self.db_name = db_name
+        self.purge_every = purge_every  # Clean out expired rows every N writes
+        self._local = threading.local()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self._create_tables()
+
+    def _get_connection(self):
+        """One connection per thread, reused for every lookup"""
+        conn = getattr(self._local, 'conn', None)
+        # Connections can't be shared with a forked child, so it opens its own
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_name, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """Close this thread's connection"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _create_tables(self):
+        conn = self._get_connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_expires_at ON cache (expires_at)')
+        conn.commit()
+
+    def get(self, key):
+        """Returns (value, expires_at), or (MISS, None)"""
+        try:
+            row = self._get_connection().execute(
+                'SELECT value, expires_at FROM cache WHERE key = ?', (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"Disk cache read error: {e}")
+            self.misses += 1
+            return MISS, None
+
+        if row is None:
+            self.misses += 1
+            return MISS, None
+        if row[1] <= time.time():
+            self.expirations += 1
+            self.misses += 1
+            return MISS, None
+        self.hits += 1
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, value, ttl):
+        try:
+            conn = self._get_connection()
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                    (key, json.dumps(value), time.time() + ttl)
+                )
+            self._writes += 1
+            if self._writes % self.purge_every == 0:
+                self.purge_expired()
+        except sqlite3.Error as e:
+            logging.error(f"Disk cache write error: {e}")
+
+    def delete(self, key):
+        try:
+            conn = self._get_connection()
+            with conn:
+                conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+        except sqlite3.Error as e:
+            logging.error(f"Disk cache delete error: {e}")
+
+    def claim(self, key, owner, ttl):
+        """Take a lease, or renew it if owner already has it. True if owner holds it now.
+
+        Every process sharing this file sees the same lease, so only one of
+        them gets it until the holder stops renewing it and it expires.
+        """
+        now = time.time()
+        try:
+            conn = self._get_connection()
+            with conn:
+                conn.execute('''
+                    INSERT INTO cache (key, value, expires_at) VALUES (?, ?, ?)
+                    ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+                    WHERE cache.expires_at <= ? OR cache.value = excluded.value
+                ''', (key, json.dumps(owner), now + ttl, now))
+                row = conn.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+            return row is not None and json.loads(row[0]) == owner
+        except sqlite3.Error as e:
+            logging.error(f"Disk cache lease error: {e}")
+            return False
+
+    def purge_expired(self):
+        """Drop everything that has expired"""
+        conn = self._get_connection()
+        with conn:
+            conn.execute('DELETE FROM cache WHERE expires_at <= ?', (time.time(),))
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "expirations": self.expirations,
+            "writes": self._writes
+        }
+
+
+class TieredCache:
+    def __init__(self, memory_size=10000, db_name='tunefuse_cache.db'):
+        """Memory first, then disk. Disk hits get copied back into memory."""
+        self.memory = LRUCache(memory_size)
+        self.disk = DiskCache(db_name)
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not MISS:
+            return value
+        value, expires_at = self.disk.get(key)
+        if value is not MISS:
+            self.memory.set(key, value, expires_at=expires_at)
+        return value
+
+    def set(self, key, value, ttl):
+        self.memory.set(key, value, ttl)
+        self.disk.set(key, value, ttl)
+
+    def delete(self, key):
+        self.memory.delete(key)
+        self.disk.delete(key)
+
+    async def aget(self, key):
+        """Async get: memory hits are instant, disk reads happen off the event loop"""
+        value = self.memory.get(key)
+        if value is not MISS:
+            return value
+        loop = asyncio.get_running_loop()
+        value, expires_at = await loop.run_in_executor(None, self.disk.get, key)
+        if value is not MISS:
+            self.memory.set(key, value, expires_at=expires_at)
+        return value
+
+    async def aset(self, key, value, ttl):
+        self.memory.set(key, value, ttl)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.disk.set, key, value, ttl)
+
+    def stats(self):
+        return {
+            "memory": self.memory.stats(),
+            "disk": self.disk.stats()
+        }
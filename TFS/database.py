@@ -9,20 +9,156 @@ This is where we store all our data! Think of it as our music diary where we kee
 It's like a personal music notebook for each user! 📝
 """
 
+import base64
+import itertools
+import os
+import re
 import sqlite3
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
+from cache import LRUCache, MISS
+
+# Only after a space and followed by one, so "Little Feat" and "FT Island" stay whole
+_FEATURING = re.compile(r'\s[\(\[]?(feat|ft|featuring)\.?\s.*$')
+_PUNCTUATION = re.compile(r'[^\w\s]')
+_WHITESPACE = re.compile(r'\s+')
+
+def _normalize(text):
+    text = (text or '').casefold().strip()
+    text = _FEATURING.sub('', text)      # "Song (feat. Someone)" -> "Song"
+    text = _PUNCTUATION.sub('', text)    # "Don't Stop!" -> "dont stop"
+    return _WHITESPACE.sub(' ', text).strip()
+
+def normalize_track_key(title, artist):
+    """Turn a title and artist into the key we file tracks under in the catalog"""
+    return f"{_normalize(artist)}|{_normalize(title)}"
+
+# Connection tuning (can be tuned from .env)
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))  # Page cache per connection
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))  # Bytes of the file to memory-map
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))  # Wait this long for a locked database
+
+# How long a worker trusts its in-memory copy of a user's hidden/liked songs.
+# Changes made through this worker show up at once; other workers catch up within this time.
+SONG_FILTER_TTL = int(os.getenv("SONG_FILTER_TTL", "60"))
+
+# Password hashing (can be tuned from .env)
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "pbkdf2:sha256:260000")  # Werkzeug method and cost
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 2)))  # Hashes at once
+
+# Hashing is slow on purpose, so only a few run at a time no matter how many logins arrive
+_hash_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+_current_hash_prefix = None
+
+def submit_hash(password):
+    """Start hashing a password on the hashing pool. Returns a Future the async app can await."""
+    return _hash_pool.submit(generate_password_hash, password, method=PASSWORD_HASH_METHOD)
+
+def submit_check(password_hash, password):
+    """Start checking a password against its hash on the hashing pool. Returns a Future."""
+    return _hash_pool.submit(check_password_hash, password_hash, password)
+
+# The Flask app has one thread per request anyway, so it waits for the pool there.
+# The pool still caps how many hashes run at once.
+def hash_password(password):
+    """Hash a password with the configured method, on the hashing pool"""
+    return submit_hash(password).result()
+
+def check_password(password_hash, password):
+    """Check a password against its hash, on the hashing pool"""
+    return submit_check(password_hash, password).result()
+
+def needs_rehash(password_hash):
+    """True if a stored hash was made with different settings than we use now"""
+    global _current_hash_prefix
+    if _current_hash_prefix is None:
+        # "method:params$salt$hash" - let Werkzeug tell us what it writes for our settings
+        _current_hash_prefix = generate_password_hash('', method=PASSWORD_HASH_METHOD).split('$')[0]
+    return password_hash.split('$')[0] != _current_hash_prefix
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version.
+# Never change one that has shipped: add a new entry instead.
+MIGRATIONS = [
+    # 1: Indexes for per-user listings and logins, and one row per (user, track)
+    [
+        # Drop duplicate likes/hides (keeping the newest) so the unique indexes can be built
+        '''DELETE FROM saved_songs WHERE id NOT IN (
+               SELECT MAX(id) FROM saved_songs GROUP BY user_id, track_id)''',
+        '''DELETE FROM hidden_songs WHERE id NOT IN (
+               SELECT MAX(id) FROM hidden_songs GROUP BY user_id, track_id)''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_saved_songs_user_track ON saved_songs (user_id, track_id)',
+        'CREATE INDEX IF NOT EXISTS idx_saved_songs_user_saved_at ON saved_songs (user_id, saved_at DESC)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_hidden_songs_user_track ON hidden_songs (user_id, track_id)',
+        'CREATE INDEX IF NOT EXISTS idx_hidden_songs_user_hidden_at ON hidden_songs (user_id, hidden_at DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users (username COLLATE NOCASE)',
+        'CREATE INDEX IF NOT EXISTS idx_users_email_nocase ON users (email COLLATE NOCASE)',
+    ],
+    # 2: Listing indexes that also cover the id tie-breaker used by paged listings
+    [
+        'CREATE INDEX IF NOT EXISTS idx_saved_songs_user_saved_at_id ON saved_songs (user_id, saved_at DESC, id DESC)',
+        'DROP INDEX IF EXISTS idx_saved_songs_user_saved_at',
+        'CREATE INDEX IF NOT EXISTS idx_hidden_songs_user_hidden_at_id ON hidden_songs (user_id, hidden_at DESC, id DESC)',
+        'DROP INDEX IF EXISTS idx_hidden_songs_user_hidden_at',
+    ],
+    # 3: Prefix search over the track catalog (LIKE 'abc%' can use NOCASE indexes)
+    [
+        'CREATE INDEX IF NOT EXISTS idx_tracks_title_nocase ON tracks (title COLLATE NOCASE)',
+        'CREATE INDEX IF NOT EXISTS idx_tracks_artist_nocase ON tracks (artist COLLATE NOCASE)',
+    ],
+    # 4: A version per user's library, bumped by every like/unlike/hide/unhide (for ETags)
+    [
+        '''CREATE TABLE IF NOT EXISTS library_versions (
+               user_id INTEGER PRIMARY KEY,
+               version INTEGER NOT NULL
+           )''',
+    ],
+]
 
 class Database:
     def __init__(self, db_name='tunefuse.db'):
         """Start up our music diary"""
         self.db_name = db_name  # Store the database name
+        self._local = threading.local()  # Each thread keeps its own connection
+        self._song_filters = LRUCache(max_size=10000)  # (table, user_id) -> track IDs and keys
+        self._filter_generations = {}  # (table, user_id) -> bumped on every change, so stale loads aren't kept
+        self._filter_lock = threading.Lock()
         self._create_tables()    # Initialize tables once
+        self._migrate()          # Bring older databases up to date
 
     def _get_connection(self):
-        """Get a new database connection"""
-        return sqlite3.connect(self.db_name)
+        """Get this thread's database connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        # Connections can't be shared with a forked child, so it opens its own
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(
+                self.db_name,
+                timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                cached_statements=256  # Reuse prepared statements
+            )
+            conn.execute('PRAGMA journal_mode=WAL')  # Readers don't block writers
+            conn.execute('PRAGMA synchronous=NORMAL')  # Safe with WAL, far fewer fsyncs
+            conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+            conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+            conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _release(self, conn):
+        """Done with the connection for now: throw away anything left uncommitted"""
+        if conn.in_transaction:
+            conn.rollback()
+
+    def close(self):
+        """Close this thread's connection"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
 
     def _create_tables(self):
         """Set up our music diary with different sections"""
@@ -72,13 +208,85 @@ class Database:
                     FOREIGN KEY (user_id) REFERENCES users (id)
                 )
             ''')
+
+            # Create tracks catalog (everything we've learned about a song, by normalized key)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS tracks (
+                    lookup_key TEXT PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    artist TEXT NOT NULL,
+                    spotify_id TEXT,
+                    deezer_id TEXT,
+                    preview_url TEXT,
+                    cover_url TEXT,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_tracks_spotify_id ON tracks (spotify_id)
+            ''')
+
+            # Create track_edges table (Last.fm's "similar track" links between catalog keys)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS track_edges (
+                    source_key TEXT NOT NULL,
+                    target_key TEXT NOT NULL,
+                    weight REAL NOT NULL,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (source_key, target_key)
+                )
+            ''')
+
+            # Create seed_requests table (how often people ask for recommendations from a song)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS seed_requests (
+                    lookup_key TEXT PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    artist TEXT NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    last_requested DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_seed_requests_hits ON seed_requests (hits DESC)
+            ''')
             conn.commit()
         finally:
-            conn.close()
+            self._release(conn)
+
+    def _migrate(self):
+        """Apply any schema migrations this database hasn't seen yet.
+
+        Each migration runs in its own transaction together with the version
+        bump, so a crash halfway leaves the database on the previous version.
+        BEGIN IMMEDIATE makes workers starting at the same time take turns.
+        """
+        conn = self._get_connection()
+        try:
+            for version, statements in enumerate(MIGRATIONS, start=1):
+                if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+                    continue
+                conn.execute('BEGIN IMMEDIATE')
+                # Another worker may have migrated while we waited for the lock
+                if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+                    conn.rollback()
+                    continue
+                logging.info(f"Applying database migration {version}")
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version}')
+                conn.commit()
+                conn.execute('PRAGMA optimize')  # Refresh query planner stats for the new indexes
+        finally:
+            self._release(conn)
 
     ### ✅ USER AUTHENTICATION ###
-    def create_user(self, username, password, firstname, lastname, email, age=None, sex=None, country=None):
-        """Create a new user with the given details."""
+    def create_user(self, username, password, firstname, lastname, email, age=None, sex=None, country=None,
+                    password_hash=None):
+        """Create a new user with the given details.
+
+        Pass password_hash when the password was already hashed (see submit_hash).
+        """
         conn = None
         try:
             conn = self._get_connection()
@@ -89,7 +297,7 @@ class Database:
                 # First check for existing username/email
                 cursor.execute('''
                     SELECT username, email FROM users 
-                    WHERE LOWER(username) = LOWER(?) OR LOWER(email) = LOWER(?)
+                    WHERE username = ? COLLATE NOCASE OR email = ? COLLATE NOCASE
                 ''', (username, email))
                 
                 existing = cursor.fetchone()
@@ -100,7 +308,7 @@ class Database:
                         return {"success": False, "error": "email_taken"}
 
                 # If we get here, neither username nor email exists
-                hashed_password = generate_password_hash(password)
+                hashed_password = password_hash or hash_password(password)
                 cursor.execute('''
                     INSERT INTO users 
                     (username, password, firstname, lastname, email, dob, sex, country)
@@ -117,119 +325,266 @@ class Database:
             return {"success": False, "error": "unexpected_error"}
         finally:
             if conn:
-                conn.close()
+                self._release(conn)
 
-    def verify_user(self, username, password):
-        """Verify user credentials and return user data if valid."""
-        conn = None
+    def find_login(self, login):
+        """Find the account for a username or email (one indexed query).
+
+        An exact username match wins, then a case-insensitive username match,
+        then an email match.
+        """
+        conn = self._get_connection()
         try:
-            conn = self._get_connection()
             cursor = conn.cursor()
-            
-            # First try direct username comparison
             cursor.execute('''
                 SELECT id, username, password, email 
                 FROM users 
-                WHERE username = ?
-            ''', (username,))
-            
-            user = cursor.fetchone()
-            
-            # If not found, try case-insensitive username
-            if not user:
-                cursor.execute('''
-                    SELECT id, username, password, email 
-                    FROM users 
-                    WHERE LOWER(username) = LOWER(?)
-                ''', (username,))
-                user = cursor.fetchone()
-            
-            # If still not found, try email
-            if not user:
-                cursor.execute('''
-                    SELECT id, username, password, email 
-                    FROM users 
-                    WHERE LOWER(email) = LOWER(?)
-                ''', (username,))
-                user = cursor.fetchone()
-
-            if user:
-                if check_password_hash(user[2], password):
-                    logging.info(f"Login successful: {user[1]}")
-                    return {
-                        "id": user[0],
-                        "username": user[1],
-                        "email": user[3]
-                    }
-                else:
-                    logging.warning(f"Invalid password for user: {username}")
-                    return {"error": "invalid_password"}
-            else:
-                logging.warning(f"User not found: {username}")
-                return {"error": "user_not_found"}
-
-        except Exception as e:
-            logging.error(f"Database error in verify_user: {e}")
-            return {"error": "database_error"}
+                WHERE username = ? COLLATE NOCASE OR email = ? COLLATE NOCASE
+                ORDER BY username = ? DESC, username = ? COLLATE NOCASE DESC
+                LIMIT 1
+            ''', (login, login, login, login))
+            return cursor.fetchone()
         finally:
-            if conn:
-                conn.close()
+            self._release(conn)
 
-    def save_song(self, user_id, song_data):
-        """Save a song to liked songs."""
+    def _rehash_password(self, user_id, password):
+        """Store the password again using the current hash settings"""
         conn = self._get_connection()
         try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO saved_songs (user_id, track_id, track_name, artist_name, album_cover)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, song_data.get('spotify_id', song_data['track_id']), 
-                  song_data['track_name'], song_data['artist_name'], 
-                  song_data.get('album_cover')))
+            new_hash = hash_password(password)
+            conn.execute('UPDATE users SET password = ? WHERE id = ?', (new_hash, user_id))
             conn.commit()
-            return True
+            logging.info(f"Upgraded password hash for user {user_id}")
         except sqlite3.Error as e:
-            print(f"Error saving song: {e}")
-            return False
+            logging.error(f"Error upgrading password hash: {e}")
         finally:
-            conn.close()
+            self._release(conn)
+
+    def verify_user(self, username, password):
+        """Verify user credentials and return user data if valid."""
+        try:
+            user = self.find_login(username)
+            return self.finish_login(username, user, bool(user) and check_password(user[2], password), password)
+        except Exception as e:
+            logging.error(f"Database error in verify_user: {e}")
+            return {"error": "database_error"}
+
+    def finish_login(self, username, user, password_ok, password):
+        """What verify_user returns, once find_login's row (or None) and the password were checked"""
+        if user:
+            if password_ok:
+                logging.info(f"Login successful: {user[1]}")
+                # Passwords saved with older settings get upgraded while we have them
+                if needs_rehash(user[2]):
+                    self._rehash_password(user[0], password)
+                return {
+                    "id": user[0],
+                    "username": user[1],
+                    "email": user[3]
+                }
+            else:
+                logging.warning(f"Invalid password for user: {username}")
+                return {"error": "invalid_password"}
+        else:
+            logging.warning(f"User not found: {username}")
+            return {"error": "user_not_found"}
+
+    @staticmethod
+    def _catalog_entry(song_data):
+        """Catalog info from a liked/hidden song, as sent by the front end"""
+        track_id = song_data.get('spotify_id') or song_data.get('track_id')
+        cover = song_data.get('album_cover')
+        return {
+            'title': song_data['track_name'],
+            'artist': song_data['artist_name'],
+            # Only Spotify IDs are 22-character base62 strings; Deezer and MusicBrainz IDs aren't
+            'spotify_id': track_id if track_id and len(track_id) == 22 and track_id.isalnum() else None,
+            'cover_url': cover if cover and cover not in ('null', 'undefined') else None
+        }
+
+    def save_song(self, user_id, song_data):
+        """Save a song to liked songs."""
+        return self.apply_song_changes([self.song_change('like', user_id, song_data)])
 
     def remove_song(self, user_id, track_id):
         """Remove a song from liked songs."""
+        return self.apply_song_changes([self.song_change('unlike', user_id, {'track_id': track_id})])
+
+    def unhide_song(self, user_id, track_id):
+        """Remove a song from hidden songs."""
+        return self.apply_song_changes([self.song_change('unhide', user_id, {'track_id': track_id})])
+
+    ### ✍️ BATCHED SONG CHANGES ###
+    # action -> (table, statement). Likes and hides take (user_id, track_id, track_name, artist_name,
+    # album_cover); unlikes and unhides take (user_id, track_id).
+    SONG_CHANGES = {
+        'like': ('saved_songs', '''
+            INSERT INTO saved_songs (user_id, track_id, track_name, artist_name, album_cover)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, track_id) DO UPDATE SET
+                track_name = excluded.track_name,
+                artist_name = excluded.artist_name,
+                album_cover = COALESCE(excluded.album_cover, saved_songs.album_cover)
+        '''),
+        'unlike': ('saved_songs', '''
+            DELETE FROM saved_songs
+            WHERE user_id = ? AND track_id = ?
+        '''),
+        'hide': ('hidden_songs', '''
+            INSERT INTO hidden_songs (user_id, track_id, track_name, artist_name, album_cover)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, track_id) DO UPDATE SET
+                track_name = excluded.track_name,
+                artist_name = excluded.artist_name,
+                album_cover = COALESCE(excluded.album_cover, hidden_songs.album_cover)
+        '''),
+        'unhide': ('hidden_songs', '''
+            DELETE FROM hidden_songs
+            WHERE user_id = ? AND track_id = ?
+        '''),
+    }
+
+    @classmethod
+    def song_change(cls, action, user_id, song_data):
+        """One like/unlike/hide/unhide, ready for apply_song_changes().
+
+        Raises KeyError if song_data is missing something the action needs
+        (track_id always; track_name and artist_name to like or hide).
+        """
+        if action not in cls.SONG_CHANGES:
+            raise ValueError(f"Unknown song change: {action}")
+        if action in ('like', 'hide'):
+            row = (user_id, song_data.get('spotify_id', song_data['track_id']),
+                   song_data['track_name'], song_data['artist_name'], song_data.get('album_cover'))
+            return action, row, cls._catalog_entry(song_data)
+        return action, (user_id, song_data['track_id']), None
+
+    def apply_song_changes(self, changes):
+        """Apply song_change()s in order, all in one transaction (so one commit for the lot)"""
+        if not changes:
+            return True
         conn = self._get_connection()
         try:
             cursor = conn.cursor()
-            cursor.execute('''
-                DELETE FROM saved_songs 
-                WHERE user_id = ? AND track_id = ?
-            ''', (user_id, track_id))
+            # Runs of the same action share one executemany; order between runs is kept
+            for action, run in itertools.groupby(changes, key=lambda change: change[0]):
+                cursor.executemany(self.SONG_CHANGES[action][1], [row for _, row, _ in run])
+            cursor.executemany('''
+                INSERT INTO library_versions (user_id, version) VALUES (?, 1)
+                ON CONFLICT (user_id) DO UPDATE SET version = version + 1
+            ''', [(user_id,) for user_id in sorted({row[0] for _, row, _ in changes})])
+            self._upsert_tracks(cursor, [entry for _, _, entry in changes if entry])
             conn.commit()
+            with self._filter_lock:
+                for table, user_id in {(self.SONG_CHANGES[action][0], row[0]) for action, row, _ in changes}:
+                    self._filter_generations[(table, user_id)] = self._filter_generations.get((table, user_id), 0) + 1
+                    self._song_filters.delete((table, user_id))
             return True
         except sqlite3.Error as e:
-            print(f"Error removing song: {e}")
+            logging.error(f"Error saving song changes: {e}")
             return False
         finally:
-            conn.close()
+            self._release(conn)
 
-    def unhide_song(self, user_id, track_id):
-        """Remove a song from hidden songs."""
+    ### 📄 PAGED LISTINGS ###
+    @staticmethod
+    def _liked_song(row):
+        return {
+            'track_id': row[0],  # This is now the Spotify ID
+            'spotify_id': row[0],  # Add explicit Spotify ID
+            'track_name': row[1],
+            'artist_name': row[2],
+            'album_cover': row[3],
+            'saved_at': row[4]
+        }
+
+    @staticmethod
+    def _hidden_song(row):
+        return {
+            'id': row[0],  # This is now the Spotify ID
+            'spotify_id': row[0],  # Add explicit Spotify ID
+            'title': row[1],
+            'artist': row[2],
+            'date': row[3],
+            'album_cover': row[4]
+        }
+
+    @staticmethod
+    def encode_cursor(timestamp, row_id):
+        """Opaque "continue after this row" token for paged listings"""
+        return base64.urlsafe_b64encode(f"{timestamp}|{row_id}".encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Turn a cursor back into (timestamp, row_id). Raises ValueError if it's not one of ours."""
+        try:
+            timestamp, row_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').rsplit('|', 1)
+            return timestamp, int(row_id)
+        except Exception:
+            raise ValueError("Invalid cursor")
+
+    def _song_page(self, query, user_id, limit, after):
+        """Fetch one page of a listing, newest first, using keyset pagination.
+
+        The query must select the song columns followed by the sort timestamp
+        and row id, and take (user_id, timestamp, row_id, limit) parameters.
+        Returns (rows, next_cursor); next_cursor is None on the last page.
+        """
+        timestamp, row_id = self.decode_cursor(after) if after else ('9999-12-31 23:59:59', 2 ** 63 - 1)
         conn = self._get_connection()
         try:
             cursor = conn.cursor()
-            cursor.execute('''
-                DELETE FROM hidden_songs 
-                WHERE user_id = ? AND track_id = ?
-            ''', (user_id, track_id))
-            conn.commit()
-            return True
-        except sqlite3.Error as e:
-            print(f"Error unhiding song: {e}")
-            return False
+            # Fetch one extra row so we know whether there's another page
+            cursor.execute(query, (user_id, timestamp, row_id, limit + 1))
+            rows = cursor.fetchall()
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = self.encode_cursor(rows[-1][-2], rows[-1][-1])
+            return rows, next_cursor
         finally:
-            conn.close()
+            self._release(conn)
+
+    def get_liked_songs_page(self, user_id, limit=50, after=None):
+        """One page of liked songs, newest first. Returns (songs, next_cursor)."""
+        rows, next_cursor = self._song_page('''
+            SELECT track_id, track_name, artist_name, album_cover, saved_at, saved_at, id
+            FROM saved_songs
+            WHERE user_id = ? AND (saved_at, id) < (?, ?)
+            ORDER BY saved_at DESC, id DESC
+            LIMIT ?
+        ''', user_id, limit, after)
+        return [self._liked_song(row) for row in rows], next_cursor
+
+    def get_hidden_songs_page(self, user_id, limit=50, after=None):
+        """One page of hidden songs, newest first. Returns (songs, next_cursor)."""
+        rows, next_cursor = self._song_page('''
+            SELECT track_id, track_name, artist_name, hidden_at, album_cover, hidden_at, id
+            FROM hidden_songs
+            WHERE user_id = ? AND (hidden_at, id) < (?, ?)
+            ORDER BY hidden_at DESC, id DESC
+            LIMIT ?
+        ''', user_id, limit, after)
+        return [self._hidden_song(row) for row in rows], next_cursor
+
+    def _iter_pages(self, get_page, user_id, page_size):
+        after = None
+        while True:
+            songs, after = get_page(user_id, page_size, after)
+            yield from songs
+            if after is None:
+                return
+
+    def iter_liked_songs(self, user_id, page_size=500):
+        """Yield every liked song, one page at a time, so memory stays flat"""
+        return self._iter_pages(self.get_liked_songs_page, user_id, page_size)
+
+    def iter_hidden_songs(self, user_id, page_size=500):
+        """Yield every hidden song, one page at a time, so memory stays flat"""
+        return self._iter_pages(self.get_hidden_songs_page, user_id, page_size)
 
     def get_hidden_songs(self, user_id):
-        """Get all hidden songs for a user."""
+        """Get all hidden songs for a user. Raises sqlite3.Error if they can't be read."""
         conn = self._get_connection()
         try:
             cursor = conn.cursor()
@@ -237,24 +592,18 @@ class Database:
                 SELECT track_id, track_name, artist_name, hidden_at, album_cover
                 FROM hidden_songs 
                 WHERE user_id = ?
-                ORDER BY hidden_at DESC
+                ORDER BY hidden_at DESC, id DESC
             ''', (user_id,))
-            return [{
-                'id': row[0],  # This is now the Spotify ID
-                'spotify_id': row[0],  # Add explicit Spotify ID
-                'title': row[1],
-                'artist': row[2],
-                'date': row[3],
-                'album_cover': row[4]
-            } for row in cursor.fetchall()]
+            return [self._hidden_song(row) for row in cursor.fetchall()]
         except sqlite3.Error as e:
-            print(f"Error getting hidden songs: {e}")
-            return []
+            # Raised rather than answered with [], so nobody caches an empty list by mistake
+            logging.error(f"Error getting hidden songs: {e}")
+            raise
         finally:
-            conn.close()
+            self._release(conn)
 
     def get_liked_songs(self, user_id):
-        """Get all liked songs for a user."""
+        """Get all liked songs for a user. Raises sqlite3.Error if they can't be read."""
         conn = self._get_connection()
         try:
             cursor = conn.cursor()
@@ -262,39 +611,317 @@ class Database:
                 SELECT track_id, track_name, artist_name, album_cover, saved_at
                 FROM saved_songs 
                 WHERE user_id = ?
-                ORDER BY saved_at DESC
+                ORDER BY saved_at DESC, id DESC
             ''', (user_id,))
             rows = cursor.fetchall()
-            return [{
-                'track_id': row[0],  # This is now the Spotify ID
-                'spotify_id': row[0],  # Add explicit Spotify ID
-                'track_name': row[1],
-                'artist_name': row[2],
-                'album_cover': row[3],
-                'saved_at': row[4]
-            } for row in rows]
+            return [self._liked_song(row) for row in rows]
         except sqlite3.Error as e:
-            print(f"Error getting liked songs: {e}")
-            return []
+            logging.error(f"Error getting liked songs: {e}")
+            raise
         finally:
-            conn.close()
+            self._release(conn)
 
     def hide_song(self, user_id, song_data):
         """Hide a song from recommendations."""
+        return self.apply_song_changes([self.song_change('hide', user_id, song_data)])
+
+    def _song_filter(self, table, user_id):
+        """Track IDs and catalog keys of a user's songs in one table, cached in memory.
+
+        Raises sqlite3.Error if they can't be read.
+        """
+        cached = self._song_filters.get((table, user_id))
+        if cached is not MISS:
+            return cached
+
+        generation = self._filter_generations.get((table, user_id), 0)
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            # table is always one of our own table names, never user input
+            cursor.execute(f'''
+                SELECT track_id, track_name, artist_name
+                FROM {table}
+                WHERE user_id = ?
+            ''', (user_id,))
+            songs = set()
+            for track_id, track_name, artist_name in cursor.fetchall():
+                songs.add(track_id)
+                songs.add(normalize_track_key(track_name, artist_name))
+            songs = frozenset(songs)
+        except sqlite3.Error as e:
+            # Raised rather than answered with an empty set, which would bring hidden songs back
+            logging.error(f"Error loading {table} filter: {e}")
+            raise
+        finally:
+            self._release(conn)
+
+        # A change committed while we were reading may be missing from songs, so don't keep it
+        with self._filter_lock:
+            if self._filter_generations.get((table, user_id), 0) == generation:
+                self._song_filters.set((table, user_id), songs, SONG_FILTER_TTL)
+        return songs
+
+    def get_hidden_filter(self, user_id):
+        """Everything a user has hidden, as a set of track IDs and catalog keys.
+
+        A candidate is hidden if its ID or normalize_track_key() is in the set.
+        """
+        return self._song_filter('hidden_songs', user_id)
+
+    def get_liked_filter(self, user_id):
+        """Everything a user has liked, in the same form as get_hidden_filter"""
+        return self._song_filter('saved_songs', user_id)
+
+    def get_library_version(self, user_id):
+        """A number that changes whenever the user's liked or hidden songs do (0 if they never have)"""
+        conn = self._get_connection()
+        try:
+            row = conn.execute('SELECT version FROM library_versions WHERE user_id = ?', (user_id,)).fetchone()
+            return row[0] if row else 0
+        finally:
+            self._release(conn)
+
+    ### 🎵 TRACK CATALOG ###
+    def _upsert_tracks(self, cursor, tracks):
+        """Merge what we know about some tracks into the catalog.
+
+        Known values are never overwritten with blanks, so the catalog only gets
+        more complete over time.
+        """
+        rows = []
+        for track in tracks:
+            if not track.get('title') or not track.get('artist'):
+                continue
+            rows.append((
+                normalize_track_key(track['title'], track['artist']),
+                track['title'], track['artist'],
+                track.get('spotify_id'),
+                str(track['deezer_id']) if track.get('deezer_id') else None,
+                track.get('preview_url'), track.get('cover_url')
+            ))
+        cursor.executemany('''
+            INSERT INTO tracks (lookup_key, title, artist, spotify_id, deezer_id, preview_url, cover_url)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (lookup_key) DO UPDATE SET
+                spotify_id = COALESCE(excluded.spotify_id, tracks.spotify_id),
+                deezer_id = COALESCE(excluded.deezer_id, tracks.deezer_id),
+                preview_url = COALESCE(excluded.preview_url, tracks.preview_url),
+                cover_url = COALESCE(excluded.cover_url, tracks.cover_url),
+                updated_at = CURRENT_TIMESTAMP
+        ''', rows)
+
+    def upsert_tracks(self, tracks):
+        """Add or fill in catalog entries.
+
+        Each track is a dict with title and artist, plus any of spotify_id,
+        deezer_id, preview_url and cover_url.
+        """
+        conn = self._get_connection()
+        try:
+            self._upsert_tracks(conn.cursor(), tracks)
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            logging.error(f"Error updating track catalog: {e}")
+            return False
+        finally:
+            self._release(conn)
+
+    def get_tracks(self, pairs):
+        """Look up (title, artist) pairs in the catalog.
+
+        Returns a dict of lookup_key -> track info for the ones we know.
+        """
+        return self.get_tracks_by_keys({normalize_track_key(title, artist) for title, artist in pairs})
+
+    def get_tracks_by_keys(self, keys):
+        """Same as get_tracks, for catalog keys we already have"""
+        keys = list(keys)
+        if not keys:
+            return {}
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            found = {}
+            for start in range(0, len(keys), 500):  # Stay under SQLite's variable limit
+                chunk = keys[start:start + 500]
+                cursor.execute(f'''
+                    SELECT lookup_key, title, artist, spotify_id, deezer_id, preview_url, cover_url
+                    FROM tracks
+                    WHERE lookup_key IN ({','.join('?' * len(chunk))})
+                ''', chunk)
+                for row in cursor.fetchall():
+                    found[row[0]] = {
+                        'title': row[1],
+                        'artist': row[2],
+                        'spotify_id': row[3],
+                        'deezer_id': row[4],
+                        'preview_url': row[5],
+                        'cover_url': row[6]
+                    }
+            return found
+        except sqlite3.Error as e:
+            logging.error(f"Error reading track catalog: {e}")
+            return {}
+        finally:
+            self._release(conn)
+
+    def get_track(self, title, artist):
+        """Look up a single track in the catalog (None if we've never seen it)"""
+        return self.get_tracks([(title, artist)]).get(normalize_track_key(title, artist))
+
+    ### 🤝 CO-LIKES ###
+    def get_likes_since(self, after_id=0, limit=5000):
+        """Likes with an id above after_id, oldest first, leaving out songs the same user hid.
+
+        Rows are (id, user_id, track_id, track_name, artist_name, album_cover).
+        """
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT s.id, s.user_id, s.track_id, s.track_name, s.artist_name, s.album_cover
+                FROM saved_songs s
+                WHERE s.id > ? AND NOT EXISTS (
+                    SELECT 1 FROM hidden_songs h WHERE h.user_id = s.user_id AND h.track_id = s.track_id)
+                ORDER BY s.id
+                LIMIT ?
+            ''', (after_id, limit))
+            return cursor.fetchall()
+        except sqlite3.Error as e:
+            logging.error(f"Error reading likes: {e}")
+            return []
+        finally:
+            self._release(conn)
+
+    def add_track_edges(self, edges):
+        """Remember "similar track" links: (title, artist, similar title, similar artist, weight)"""
+        rows = [(normalize_track_key(title, artist), normalize_track_key(other_title, other_artist), weight)
+                for title, artist, other_title, other_artist, weight in edges]
+        if not rows:
+            return True
+        conn = self._get_connection()
+        try:
+            conn.executemany('''
+                INSERT INTO track_edges (source_key, target_key, weight) VALUES (?, ?, ?)
+                ON CONFLICT (source_key, target_key) DO UPDATE SET
+                    weight = excluded.weight,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', rows)
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            logging.error(f"Error saving track links: {e}")
+            return False
+        finally:
+            self._release(conn)
+
+    def get_track_edges_since(self, after_rowid=0, limit=10000):
+        """Similar-track links in storage order: (rowid, source_key, target_key, weight)"""
         conn = self._get_connection()
         try:
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO hidden_songs 
-                (user_id, track_id, track_name, artist_name, album_cover)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, song_data.get('spotify_id', song_data['track_id']), 
-                  song_data['track_name'], song_data['artist_name'], 
-                  song_data.get('album_cover')))
+                SELECT rowid, source_key, target_key, weight FROM track_edges
+                WHERE rowid > ?
+                ORDER BY rowid
+                LIMIT ?
+            ''', (after_rowid, limit))
+            return cursor.fetchall()
+        except sqlite3.Error as e:
+            logging.error(f"Error reading track links: {e}")
+            return []
+        finally:
+            self._release(conn)
+
+    ### 🔥 POPULAR SEEDS ###
+    def record_seed_requests(self, seeds):
+        """Count recommendation requests for some (title, artist) seeds"""
+        rows = [(normalize_track_key(title, artist), title, artist) for title, artist in seeds]
+        if not rows:
+            return True
+        conn = self._get_connection()
+        try:
+            conn.executemany('''
+                INSERT INTO seed_requests (lookup_key, title, artist, hits) VALUES (?, ?, ?, 1)
+                ON CONFLICT (lookup_key) DO UPDATE SET
+                    hits = hits + 1,
+                    last_requested = CURRENT_TIMESTAMP
+            ''', rows)
             conn.commit()
             return True
         except sqlite3.Error as e:
-            print(f"Error hiding song: {e}")
+            logging.error(f"Error counting seed requests: {e}")
             return False
         finally:
-            conn.close()
+            self._release(conn)
+
+    def get_popular_seeds(self, limit=50, days=7):
+        """The most requested seeds that were asked for in the last few days, as (title, artist)"""
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT title, artist FROM seed_requests
+                WHERE last_requested >= datetime('now', ?)
+                ORDER BY hits DESC
+                LIMIT ?
+            ''', (f'-{int(days)} days', limit))
+            return cursor.fetchall()
+        except sqlite3.Error as e:
+            logging.error(f"Error reading popular seeds: {e}")
+            return []
+        finally:
+            self._release(conn)
+
+    def get_liked_seeds(self, limit=50):
+        """The songs liked by the most users, as (title, artist)"""
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT MIN(track_name), MIN(artist_name)
+                FROM saved_songs
+                GROUP BY track_name COLLATE NOCASE, artist_name COLLATE NOCASE
+                ORDER BY COUNT(DISTINCT user_id) DESC
+                LIMIT ?
+            ''', (limit,))
+            return cursor.fetchall()
+        except sqlite3.Error as e:
+            logging.error(f"Error reading liked seeds: {e}")
+            return []
+        finally:
+            self._release(conn)
+
+    def search_tracks(self, query, limit=10):
+        """Catalog songs with a Spotify ID whose title or artist starts with the query's first word.
+
+        Results use the same shape as /api/search. Callers narrow them down further.
+        """
+        words = (query or '').split()
+        if not words:
+            return []
+        # Escape LIKE wildcards so they're matched literally
+        term = words[0].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT spotify_id, title, artist, cover_url
+                FROM tracks
+                WHERE (title LIKE ? ESCAPE '\\' OR artist LIKE ? ESCAPE '\\') AND spotify_id IS NOT NULL
+                LIMIT ?
+            ''', (term, term, limit * 5))
+            return [{
+                "id": row[0],
+                "title": row[1],
+                "artist": row[2],
+                "image": row[3],
+                "spotify_id": row[0]
+            } for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logging.error(f"Error searching track catalog: {e}")
+            return []
+        finally:
+            self._release(conn)
@@ -0,0 +1,205 @@
+"""
+TuneFuse Fake Upstream
+
+A local stand-in for the Spotify, Last.fm and Deezer endpoints we use, so
+the app can be run and benchmarked without network access or API keys:
+- Spotify: /spotify/api/token and /spotify/v1/search
+- Last.fm: /lastfm/2.0/?method=track.getsimilar
+- Deezer: /deezer/search, /deezer/artist/<id>/related, /deezer/artist/<id>/top
+  and /deezer/preview/<id>.mp3
+- Answers are made up, but always the same for the same question
+- Latency, errors (500) and rate limiting (429 with Retry-After) can be
+  switched on to see how the app copes
+- GET /_stats returns calls per endpoint, POST /_reset clears them
+
+Run it on its own:
+    python fake_upstream.py --port 8765 --latency 50 --error-rate 0.01
+and point the app at it:
+    SPOTIFY_API_URL=http://127.0.0.1:8765/spotify/v1
+    SPOTIFY_TOKEN_URL=http://127.0.0.1:8765/spotify/api/token
+    LASTFM_API_URL=http://127.0.0.1:8765/lastfm/2.0/
+    DEEZER_API_URL=http://127.0.0.1:8765/deezer
+"""
+
+import argparse
+import asyncio
+import random
+import re
+import zlib
+from collections import Counter
+
+from aiohttp import web
+
+SONGS = 100000  # Songs in the made-up catalog
+ARTISTS = 5000
+PREVIEW_BYTES = 200 * 1024  # About the size of a real 30-second preview
+
+_SONG_NUMBER = re.compile(r'Song (\d+)')
+_ARTIST_NUMBER = re.compile(r'Artist (\d+)')
+
+
+def song_title(n):
+    return f"Song {n}"
+
+
+def artist_name(n):
+    return f"Artist {n % ARTISTS}"
+
+
+def spotify_id(n):
+    """A 22-character base62 ID, like Spotify's"""
+    rng = random.Random(n)
+    return ''.join(rng.choice('0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(22))
+
+
+def stable_rng(*parts):
+    """A random generator seeded by the question, so the same question gets the same answer"""
+    return random.Random(zlib.crc32('|'.join(str(p) for p in parts).encode('utf-8')))
+
+
+def song_number(text, fallback_parts):
+    """The song a query is about: "Song 123" in the text, or one picked from the query itself"""
+    match = _SONG_NUMBER.search(text or '')
+    if match:
+        return int(match.group(1)) % SONGS
+    return stable_rng(*fallback_parts).randrange(SONGS)
+
+
+class FakeUpstream:
+    def __init__(self, latency=0, jitter=0.5, error_rate=0, throttle_rate=0, seed=0):
+        """latency is the typical response time in seconds; jitter spreads it (lognormal sigma)"""
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.errors = Counter()
+        self._preview = bytes(PREVIEW_BYTES)
+
+    def app(self):
+        app = web.Application(middlewares=[self._behave])
+        app.router.add_post('/spotify/api/token', self.spotify_token)
+        app.router.add_get('/spotify/v1/search', self.spotify_search)
+        app.router.add_get('/lastfm/2.0/', self.lastfm)
+        app.router.add_get('/deezer/search', self.deezer_search)
+        app.router.add_get('/deezer/artist/{id}/related', self.deezer_related)
+        app.router.add_get('/deezer/artist/{id}/top', self.deezer_top)
+        app.router.add_get('/deezer/preview/{id}.mp3', self.deezer_preview)
+        app.router.add_get('/_stats', self.stats)
+        app.router.add_post('/_reset', self.reset)
+        return app
+
+    @web.middleware
+    async def _behave(self, request, handler):
+        """Add latency, errors and 429s to every upstream endpoint"""
+        if request.path.startswith('/_'):
+            return await handler(request)
+        endpoint = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * self.rng.lognormvariate(0, self.jitter))
+        roll = self.rng.random()
+        if roll < self.throttle_rate:
+            self.errors[f"{endpoint} 429"] += 1
+            return web.json_response({"error": "rate limited"}, status=429, headers={"Retry-After": "1"})
+        if roll < self.throttle_rate + self.error_rate:
+            self.errors[f"{endpoint} 500"] += 1
+            return web.json_response({"error": "server error"}, status=500)
+        return await handler(request)
+
+    def _base(self, request):
+        return f"{request.scheme}://{request.host}"
+
+    def _deezer_track(self, request, n, rank=None):
+        return {
+            "id": n,
+            "title": song_title(n),
+            "rank": rank if rank is not None else stable_rng('rank', n).randrange(1000, 1000000),
+            "isrc": f"FAKE{n:08d}",
+            "preview": f"{self._base(request)}/deezer/preview/{n}.mp3",
+            "album": {"cover_xl": f"{self._base(request)}/covers/{n}.jpg"},
+            "artist": {"id": n % ARTISTS, "name": artist_name(n)}
+        }
+
+    async def spotify_token(self, request):
+        return web.json_response({"access_token": "fake-token", "token_type": "Bearer", "expires_in": 3600})
+
+    async def spotify_search(self, request):
+        query = request.query.get('q', '')
+        limit = int(request.query.get('limit', 10))
+        first = song_number(query, ('spotify', query))
+        rng = stable_rng('spotify', query)
+        numbers = [first] + [rng.randrange(SONGS) for _ in range(limit - 1)]
+        return web.json_response({"tracks": {"items": [{
+            "id": spotify_id(n),
+            "name": song_title(n),
+            "artists": [{"name": artist_name(n)}],
+            "album": {"images": [{"url": f"{self._base(request)}/covers/{n}.jpg"}]}
+        } for n in numbers]}})
+
+    async def lastfm(self, request):
+        if request.query.get('method') != 'track.getsimilar':
+            return web.json_response({"error": 3, "message": "Invalid Method"}, status=400)
+        track, artist = request.query.get('track', ''), request.query.get('artist', '')
+        limit = int(request.query.get('limit', 50))
+        rng = stable_rng('lastfm', track, artist)
+        # Some seeds are obscure and Last.fm knows nothing about them
+        if rng.random() < 0.05:
+            return web.json_response({"similartracks": {"track": []}})
+        numbers = rng.sample(range(SONGS), limit)
+        return web.json_response({"similartracks": {"track": [{
+            "name": song_title(n),
+            "artist": {"name": artist_name(n)},
+            "match": f"{1 - i / (limit + 1):.6f}",
+            "mbid": f"fake-mbid-{n}" if n % 3 else "",
+            "image": [{"#text": f"{self._base(request)}/covers/{n}.jpg"}]
+        } for i, n in enumerate(numbers)]}})
+
+    async def deezer_search(self, request):
+        query = request.query.get('q', '')
+        if query.startswith('artist:'):
+            match = _ARTIST_NUMBER.search(query)
+            artist = int(match.group(1)) if match else stable_rng('deezer', query).randrange(ARTISTS)
+            return web.json_response({"data": [self._deezer_track(request, artist)]})
+        n = song_number(query, ('deezer', query))
+        return web.json_response({"data": [self._deezer_track(request, n)]})
+
+    async def deezer_related(self, request):
+        artist = int(request.match_info['id'])
+        rng = stable_rng('related', artist)
+        return web.json_response({"data": [
+            {"id": a, "name": artist_name(a)} for a in rng.sample(range(ARTISTS), 20)
+        ]})
+
+    async def deezer_top(self, request):
+        artist = int(request.match_info['id'])
+        # Songs by artist a are a, a + ARTISTS, a + 2 * ARTISTS, ...
+        return web.json_response({"data": [
+            self._deezer_track(request, artist + i * ARTISTS, rank=1000000 // (i + 1)) for i in range(5)
+        ]})
+
+    async def deezer_preview(self, request):
+        return web.Response(body=self._preview, content_type='audio/mpeg')
+
+    async def stats(self, request):
+        return web.json_response({"calls": dict(self.calls), "errors": dict(self.errors)})
+
+    async def reset(self, request):
+        self.calls.clear()
+        self.errors.clear()
+        return web.json_response({"ok": True})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for Spotify, Last.fm and Deezer")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0, help="typical response time in milliseconds")
+    parser.add_argument('--jitter', type=float, default=0.5, help="spread of the response time (lognormal sigma)")
+    parser.add_argument('--error-rate', type=float, default=0, help="share of calls that fail with a 500")
+    parser.add_argument('--throttle-rate', type=float, default=0, help="share of calls that get a 429")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    fake = FakeUpstream(args.latency / 1000, args.jitter, args.error_rate, args.throttle_rate, args.seed)
+    web.run_app(fake.app(), host=args.host, port=args.port, print=None, access_log=None)
@@ -0,0 +1,53 @@
+"""
+TuneFuse Gunicorn Settings
+
+Runs the app with several worker processes. Started from this folder,
+gunicorn picks these settings up by itself:
+    gunicorn
+or, for the async version:
+    WEB_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn asgi:app
+
+- The app is loaded once in the parent process (preload_app), which also
+  does the slow start-up work (building the local recommender, opening the
+  similarity index) before forking, so workers start ready and share that
+  memory instead of each building their own
+- What can't cross a fork (SQLite connections, the event loop and HTTP
+  pools, background threads) is closed before forking or started fresh in
+  each worker on first use
+- Every worker signs sessions with the same key (SECRET_KEY, or one
+  generated once in SECRET_KEY_FILE), so it doesn't matter which one answers
+"""
+
+import multiprocessing
+import os
+import sys
+
+# Workers (can be tuned from .env)
+wsgi_app = "server:app"  # When no app is given on the command line
+bind = os.getenv("WEB_BIND", "127.0.0.1:5000")
+workers = int(os.getenv("WEB_WORKERS", str(multiprocessing.cpu_count() * 2 + 1)))  # Worker processes
+threads = int(os.getenv("WEB_THREADS", "4"))  # Requests each worker answers at once
+worker_class = os.getenv("WEB_WORKER_CLASS", "gthread")
+timeout = int(os.getenv("WEB_TIMEOUT", "30"))  # Seconds before a stuck worker is restarted
+keepalive = 5  # Seconds to keep an idle browser connection open
+preload_app = os.getenv("WEB_PRELOAD", "1").lower() in ('1', 'true', 'yes')  # Load the app once, before forking
+max_requests = int(os.getenv("WEB_MAX_REQUESTS", "0"))  # Restart a worker after this many requests (0 = never)
+max_requests_jitter = max_requests // 10  # So workers don't all restart at once
+
+
+def _tunefuse():
+    # Only there before forking when the app was preloaded
+    return sys.modules.get('server')
+
+
+def when_ready(server):
+    """Runs in the parent once it's listening, before the first worker is forked"""
+    app = _tunefuse()
+    if app:
+        app.warm_up()
+
+
+def pre_fork(server, worker):
+    app = _tunefuse()
+    if app:
+        app.prepare_for_fork()
@@ -0,0 +1,195 @@
+"""
+TuneFuse HTTP Caching
+
+Less to send, and less to send again:
+- JSON, HTML, CSS and JS responses are compressed with brotli (when the
+  Brotli package is installed) or gzip, whichever the browser accepts.
+  Streamed responses are compressed as they stream.
+- ETags survive compression: the encoding is added to the tag ("v1" becomes
+  "v1-gzip"), and If-None-Match matches a tag in any encoding
+- CSS, JS and images under assets/ are also served under content-hashed
+  names (/assets/js/app.1a2b3c4d5e6f.js). A name never changes meaning,
+  so browsers may keep those files for a year. They're compressed once,
+  as hard as possible, instead of on every request.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # Optional: without it we only gzip
+
+# Compression (can be tuned from .env)
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "500"))  # Smaller responses aren't worth it
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))  # 11 is smallest, but far too slow for every request
+
+COMPRESSIBLE_TYPES = {
+    'application/json', 'application/javascript', 'text/javascript',
+    'text/html', 'text/css', 'text/plain', 'image/svg+xml'
+}
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)  # Best first
+ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def choose_encoding(accept_encoding):
+    """The best encoding an Accept-Encoding header allows ('br' or 'gzip'), or None"""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def should_compress(mimetype, status, headers):
+    """True for a full response of a text type that isn't encoded yet"""
+    return status == 200 and mimetype in COMPRESSIBLE_TYPES and 'Content-Encoding' not in headers
+
+
+def compress(data, encoding, best=False):
+    """Compress bytes in one go. best=True is slow but smallest (for files compressed once)."""
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if best else BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=9 if best else GZIP_LEVEL, mtime=0)
+
+
+def _compressor(encoding):
+    """(feed, finish) functions for compressing a stream"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # 31 = gzip framing
+    return compressor.compress, compressor.flush
+
+
+def _as_bytes(chunk):
+    return chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+
+def compress_stream(chunks, encoding):
+    """Compress an iterable of str/bytes chunks as they come"""
+    feed, finish = _compressor(encoding)
+    for chunk in chunks:
+        out = feed(_as_bytes(chunk))
+        if out:
+            yield out
+    yield finish()
+
+
+async def compress_stream_async(chunks, encoding):
+    """compress_stream() for an async iterable"""
+    feed, finish = _compressor(encoding)
+    async for chunk in chunks:
+        out = feed(_as_bytes(chunk))
+        if out:
+            yield out
+    yield finish()
+
+
+def encoded_etag(etag, encoding):
+    """The ETag header for the encoded version of a response ('"v1"' -> '"v1-gzip"')"""
+    weak = etag.startswith('W/')
+    value = (etag[2:] if weak else etag).strip('"')
+    return f'{"W/" if weak else ""}"{value}-{encoding}"'
+
+
+def matching_etag(if_none_match, etag):
+    """The tag in an If-None-Match header that names etag (in any encoding), or None.
+
+    If-None-Match compares weakly, so W/ is ignored.
+    """
+    names = {etag} | {f"{etag}-{encoding}" for encoding in ('br', 'gzip')}
+    for tag in (if_none_match or '').split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return f'"{etag}"'
+        if (tag[2:] if tag.startswith('W/') else tag).strip('"') in names:
+            return tag
+    return None
+
+
+class StaticAssets:
+    def __init__(self, directory, extensions=('.css', '.js', '.png', '.jpg', '.svg', '.ico', '.woff2'), reload=False):
+        """Index the files under directory by content hash.
+
+        reload=True notices files that changed since (for development); the
+        old hashed names keep working so pages that are already open don't break.
+        """
+        self.directory = os.path.abspath(directory)
+        self.extensions = extensions
+        self.reload = reload
+        self._lock = threading.Lock()
+        self._by_path = {}  # 'js/app.js' -> asset
+        self._by_name = {}  # 'js/app.1a2b3c4d5e6f.js' -> asset
+        for root, _, files in os.walk(self.directory):
+            for filename in files:
+                if filename.endswith(self.extensions):
+                    self._load(os.path.relpath(os.path.join(root, filename), self.directory).replace(os.sep, '/'))
+
+    def _load(self, path):
+        full_path = os.path.join(self.directory, path)
+        mtime = os.stat(full_path).st_mtime
+        with open(full_path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        stem, extension = os.path.splitext(path)
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        variants = {None: data}
+        if mimetype in COMPRESSIBLE_TYPES:
+            for encoding in ENCODINGS:
+                compressed = compress(data, encoding, best=True)
+                if len(compressed) < len(data):
+                    variants[encoding] = compressed
+        asset = {"name": f"{stem}.{digest}{extension}", "digest": digest, "mimetype": mimetype,
+                 "variants": variants, "mtime": mtime}
+        with self._lock:
+            self._by_path[path] = asset
+            self._by_name[asset['name']] = asset
+        return asset
+
+    def url(self, path):
+        """The content-hashed URL for a file under the assets folder (its plain URL if we don't have it)"""
+        path = path.lstrip('/')
+        asset = self._by_path.get(path)
+        if asset and self.reload:
+            try:
+                if os.stat(os.path.join(self.directory, path)).st_mtime != asset['mtime']:
+                    asset = self._load(path)
+            except OSError:
+                pass
+        return f"/assets/{asset['name']}" if asset else f"/{path}"
+
+    def respond(self, name, accept_encoding, if_none_match):
+        """(status, body, mimetype, headers) for a content-hashed asset, or None if there's no such name"""
+        asset = self._by_name.get(name)
+        if asset is None:
+            return None
+        encoding = choose_encoding(accept_encoding)
+        if encoding not in asset['variants']:
+            encoding = None
+        headers = {
+            "Cache-Control": ASSET_CACHE_CONTROL,
+            "ETag": f'"{asset["digest"]}-{encoding}"' if encoding else f'"{asset["digest"]}"',
+            "Vary": "Accept-Encoding"
+        }
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        if matching_etag(if_none_match, asset['digest']):
+            return 304, b'', asset['mimetype'], headers
+        return 200, asset['variants'][encoding], asset['mimetype'], headers
@@ -0,0 +1,146 @@
+"""
+TuneFuse HTTP Pools
+
+Every page view talks to Last.fm, Deezer and Spotify, so we keep our
+connections to them warm instead of reconnecting each time:
+- One long-lived event loop per worker process for all our async code
+- One shared aiohttp session with keep-alive pools per upstream host
+- One pooled requests.Session for the code that isn't async
+
+All of this is created lazily and recreated after a fork, so it works the
+same under `python server.py` and under gunicorn. When the app runs on an
+ASGI server instead, the async helpers here work on that server's loop.
+"""
+
+import asyncio
+import atexit
+import contextvars
+import logging
+import os
+import threading
+import weakref
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+# Pool sizing (can be tuned from .env)
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))  # Total open connections
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))  # Per upstream host
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))  # Seconds to remember DNS answers
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))  # Seconds to keep idle connections
+
+_lock = threading.Lock()
+_loop = None
+_loop_pid = None
+_loop_state = weakref.WeakKeyDictionary()  # loop -> objects that belong to it (sessions, semaphores...)
+_http_session = None
+_http_session_pid = None
+
+
+def _start_loop():
+    """Spin up a fresh event loop in a background thread"""
+    global _loop, _loop_pid
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name="tunefuse-event-loop", daemon=True)
+    thread.start()
+    _loop = loop
+    _loop_pid = os.getpid()
+    logging.debug(f"Started shared event loop for process {_loop_pid}")
+
+
+def get_loop():
+    """Get this worker's long-lived event loop, starting it if needed"""
+    if _loop is None or _loop_pid != os.getpid():
+        with _lock:
+            # Threads don't survive a fork, so a child always needs its own loop
+            if _loop is None or _loop_pid != os.getpid():
+                _start_loop()
+    return _loop
+
+
+async def _in_context(context, coro):
+    # Tasks on the loop start from the loop thread's context, so bring the caller's along
+    for var, value in context.items():
+        var.set(value)
+    return await coro
+
+
+def run_async(coro, timeout=None):
+    """Run a coroutine on the shared loop and wait for its result (from sync code).
+
+    The coroutine sees the caller's context variables (like the request's timing).
+    """
+    coro = _in_context(contextvars.copy_context(), coro)
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result(timeout)
+
+
+def loop_local(key, factory):
+    """Get an object tied to the running event loop, creating it on first use.
+
+    Only call this from async code (on the shared loop or an ASGI server's loop).
+    """
+    state = _loop_state.setdefault(asyncio.get_running_loop(), {})
+    if key not in state:
+        state[key] = factory()
+    return state[key]
+
+
+def get_session():
+    """Get the aiohttp session for the running loop (call from async code)"""
+    def create():
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+        )
+        return aiohttp.ClientSession(connector=connector)
+
+    session = loop_local('aiohttp_session', create)
+    if session.closed:
+        _loop_state[asyncio.get_running_loop()].pop('aiohttp_session', None)
+        session = loop_local('aiohttp_session', create)
+    return session
+
+
+async def close_session():
+    """Close the running loop's aiohttp session (for ASGI shutdown)"""
+    session = _loop_state.get(asyncio.get_running_loop(), {}).pop('aiohttp_session', None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+def get_http_session():
+    """Get the pooled requests.Session for sync code"""
+    global _http_session, _http_session_pid
+    if _http_session is None or _http_session_pid != os.getpid():
+        with _lock:
+            if _http_session is None or _http_session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=10, pool_maxsize=HTTP_POOL_LIMIT_PER_HOST)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _http_session = session
+                _http_session_pid = os.getpid()
+    return _http_session
+
+
+def close():
+    """Close the pools and stop the loop (called automatically at exit)"""
+    global _loop, _http_session
+    if _loop is not None and _loop_pid == os.getpid() and _loop.is_running():
+        session = _loop_state.get(_loop, {}).get('aiohttp_session')
+        if session is not None and not session.closed:
+            try:
+                run_async(session.close(), timeout=5)
+            except Exception as e:
+                logging.warning(f"Error closing HTTP session: {e}")
+        _loop.call_soon_threadsafe(_loop.stop)
+    _loop = None
+    if _http_session is not None:
+        _http_session.close()
+        _http_session = None
+
+
+atexit.register(close)
@@ -0,0 +1,237 @@
+"""
+TuneFuse Local Recommendations
+
+Our own users already tell us which songs go together: people who like one
+song tend to like certain others. This builds an item-to-item recommender
+from everyone's liked songs, with no outside API involved:
+- Songs are matched by catalog key, so the same song liked from search and
+  from a recommendation counts as one
+- Two songs are similar when the same users like both (cosine similarity
+  over their sets of fans). Songs a user liked and later hid don't count.
+- Only each user's newest likes are paired up: someone with n likes adds n²
+  pairs, so a few heavy users would otherwise swamp everyone else (and our
+  memory)
+- New likes are folded in every few seconds; a full rebuild now and then
+  picks up unlikes and hides
+- Neighbour lists are computed once per song and kept in memory, so
+  answering is a dictionary lookup
+"""
+
+import itertools
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+from database import normalize_track_key
+
+_EMPTY = (np.zeros(0, dtype=np.int64), np.zeros(0))
+
+
+def co_like_matrix(user_likes, songs, max_user_likes):
+    """songs x songs CSR matrix of how many users like both song i and song j.
+
+    user_likes holds each user's song indexes, oldest first; only the newest
+    max_user_likes of them count.
+    """
+    recent = [list(likes)[-max_user_likes:] for likes in user_likes]
+    lengths = np.fromiter(map(len, recent), dtype=np.int64, count=len(recent))
+    rows = np.repeat(np.arange(len(recent)), lengths)
+    cols = np.fromiter(itertools.chain.from_iterable(recent), dtype=np.int64, count=int(lengths.sum()))
+    # Binary user x song matrix; its Gram matrix counts the users who like each pair of songs
+    likes = sparse.csr_matrix((np.ones(len(cols), dtype=np.int64), (rows, cols)), shape=(len(recent), songs))
+    likes.data[:] = 1  # The same song liked twice still counts once
+    return (likes.T @ likes).tocsr()
+
+
+class LocalRecommender:
+    def __init__(self, db, min_co_likes=2, neighbors=50, sync_interval=10, rebuild_interval=3600,
+                 max_user_likes=500):
+        """Item-item recommender over db's liked songs.
+
+        Two songs only count as related once at least min_co_likes users like both.
+        """
+        self.db = db
+        self.min_co_likes = min_co_likes
+        self.max_user_likes = max_user_likes  # Newest likes per user that count towards co-likes
+        self.neighbors = neighbors  # Neighbours kept per song
+        self.sync_interval = sync_interval  # Seconds between picking up new likes
+        self.rebuild_interval = rebuild_interval  # Seconds between full rebuilds
+        self._lock = threading.Lock()
+        self._worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="local-recs")
+        self._busy = False
+        self._built_at = None
+        self._synced_at = 0
+        self._install({}, [], {}, sparse.csr_matrix((0, 0), dtype=np.int64), np.zeros(0, dtype=np.int64), 0)
+
+    def _install(self, keys, items, user_items, co_likes, like_counts, last_id):
+        """Swap in freshly built data (caller holds the lock, or nobody else can see us yet)"""
+        self._keys = keys  # catalog key -> song index
+        self._items = items  # song index -> title, artist, track_id, album_cover
+        self._user_items = user_items  # user_id -> song indexes, oldest first (a dict used as an ordered set)
+        self._co_likes = co_likes  # CSR: users who like both song i and song j
+        self._delta = defaultdict(Counter)  # Co-likes added since the last rebuild
+        self._like_counts = like_counts  # Users who like each song
+        self._top = {}  # song index -> (neighbour indexes, scores), filled in on demand
+        self._last_id = last_id  # Newest saved_songs row we've seen
+
+    @staticmethod
+    def _song_index(keys, items, track_id, title, artist, cover):
+        key = normalize_track_key(title, artist)
+        index = keys.get(key)
+        if index is None:
+            index = keys[key] = len(items)
+            items.append(None)
+        # The newest like has the freshest cover and ID
+        items[index] = {"track_id": track_id, "title": title, "artist": artist, "album_cover": cover}
+        return index
+
+    def rebuild(self):
+        """Rebuild everything from the database"""
+        started = time.perf_counter()
+        keys, items, user_items, last_id = {}, [], {}, 0
+        while True:
+            rows = self.db.get_likes_since(last_id)
+            if not rows:
+                break
+            for _, user_id, track_id, title, artist, cover in rows:
+                index = self._song_index(keys, items, track_id, title, artist, cover)
+                liked = user_items.setdefault(user_id, {})
+                liked.pop(index, None)  # Liked again: it's one of their newest now
+                liked[index] = None
+            last_id = rows[-1][0]
+
+        co_likes = co_like_matrix(user_items.values(), len(items), self.max_user_likes)
+        like_counts = np.zeros(len(items), dtype=np.int64)  # Popularity still counts every like
+        for songs in user_items.values():
+            like_counts[list(songs)] += 1
+
+        with self._lock:
+            self._install(keys, items, user_items, co_likes, like_counts, last_id)
+            self._built_at = self._synced_at = time.monotonic()
+        logging.info(f"Local recommender rebuilt: {len(items)} songs, {len(user_items)} users "
+                     f"in {time.perf_counter() - started:.2f}s")
+
+    def sync(self):
+        """Fold in likes saved since we last looked (by any worker)"""
+        while True:
+            rows = self.db.get_likes_since(self._last_id)
+            if not rows:
+                break
+            with self._lock:
+                likes = [(user_id, self._song_index(self._keys, self._items, track_id, title, artist, cover))
+                         for _, user_id, track_id, title, artist, cover in rows]
+                liked = {user_id: dict(self._user_items.get(user_id, {})) for user_id in {user for user, _ in likes}}
+
+            # Pair the new likes up without the lock, so recommendations aren't kept waiting.
+            # Only this thread changes likes, so the copies stay current while we work.
+            delta, added = defaultdict(Counter), []
+            for user_id, index in likes:
+                songs = liked[user_id]
+                if index in songs:
+                    continue
+                for other in itertools.islice(reversed(songs), self.max_user_likes):
+                    delta[index][other] += 1
+                    delta[other][index] += 1
+                songs[index] = None
+                added.append((user_id, index))
+
+            with self._lock:
+                for user_id, index in added:
+                    self._user_items.setdefault(user_id, {})[index] = None
+                    if index >= len(self._like_counts):
+                        grown = np.zeros(max(2 * len(self._like_counts), index + 1), dtype=np.int64)
+                        grown[:len(self._like_counts)] = self._like_counts
+                        self._like_counts = grown
+                    self._like_counts[index] += 1
+                    self._top.pop(index, None)
+                for index, counts in delta.items():
+                    self._delta[index].update(counts)
+                    self._top.pop(index, None)
+                self._last_id = rows[-1][0]
+        self._synced_at = time.monotonic()
+
+    def refresh_in_background(self):
+        """Start a sync (or a rebuild, when one is due) on our own thread. Never waits for it."""
+        now = time.monotonic()
+        with self._lock:
+            if self._busy:
+                return
+            rebuild = self._built_at is None or now - self._built_at >= self.rebuild_interval
+            if not rebuild and now - self._synced_at < self.sync_interval:
+                return
+            self._busy = True
+        self._worker.submit(self._refresh, rebuild)
+
+    def _refresh(self, rebuild):
+        try:
+            if rebuild:
+                self.rebuild()
+            else:
+                self.sync()
+        except Exception as e:
+            logging.error(f"Local recommender refresh failed: {e}")
+        finally:
+            with self._lock:
+                self._busy = False
+
+    def _co_like_row(self, index):
+        """(song indexes, co-like counts) for everything liked together with a song"""
+        if index < self._co_likes.shape[0]:
+            start, end = self._co_likes.indptr[index], self._co_likes.indptr[index + 1]
+            cols, counts = self._co_likes.indices[start:end], self._co_likes.data[start:end]
+        else:
+            cols, counts = _EMPTY
+        extra = self._delta.get(index)
+        if extra:
+            cols = np.concatenate([cols, np.fromiter(extra.keys(), dtype=np.int64, count=len(extra))])
+            counts = np.concatenate([counts, np.fromiter(extra.values(), dtype=np.int64, count=len(extra))])
+            cols, positions = np.unique(cols, return_inverse=True)
+            counts = np.bincount(positions, weights=counts)
+        return cols, counts
+
+    def _neighbors(self, index):
+        cols, counts = self._co_like_row(index)
+        keep = (cols != index) & (counts >= self.min_co_likes)
+        cols, counts = cols[keep], counts[keep]
+        if not len(cols):
+            return _EMPTY
+        scores = counts / np.sqrt(self._like_counts[index] * self._like_counts[cols])
+        if len(cols) > self.neighbors:
+            best = np.argpartition(-scores, self.neighbors)[:self.neighbors]
+            cols, scores = cols[best], scores[best]
+        order = np.argsort(-scores, kind='stable')
+        return cols[order], scores[order]
+
+    def similar(self, title, artist, limit=20):
+        """Songs most often liked together with this one, best first (empty if we don't know it)"""
+        with self._lock:
+            index = self._keys.get(normalize_track_key(title, artist))
+            if index is None:
+                return []
+            top = self._top.get(index)
+            if top is None:
+                top = self._top[index] = self._neighbors(index)
+            return [dict(self._items[other], score=float(score))
+                    for other, score in zip(top[0][:limit], top[1][:limit])]
+
+    def like_counts(self, keys):
+        """How many users like each of these songs (by catalog key), as an array"""
+        with self._lock:
+            indexes = [self._keys.get(key) for key in keys]
+            return np.array([self._like_counts[i] if i is not None and i < len(self._like_counts) else 0
+                             for i in indexes], dtype=np.int64)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "songs": len(self._items),
+                "users": len(self._user_items),
+                "pending_updates": len(self._delta),
+                "cached_neighbors": len(self._top),
+                "ready": self._built_at is not None
+            }
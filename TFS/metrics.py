@@ -0,0 +1,418 @@
+"""
+TuneFuse Metrics
+
+Numbers about where the time goes, in Prometheus text format on /metrics:
+- Latency histograms per route, per upstream provider (with status codes)
+  and per Database method, plus in-flight gauges
+- Counters from the caches, breakers and other parts of the app, read
+  when /metrics is scraped
+- Each worker keeps its own numbers; with a shared folder (METRICS_DIR)
+  they also publish them there, and /metrics adds up every live worker
+- Optionally a Server-Timing header per request (time spent in the
+  database and with each provider), and a sampling profiler that saves the
+  stacks of requests that turn out to be slow
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_request_timing = contextvars.ContextVar('tunefuse_request_timing', default=None)
+
+
+def _label_key(labels):
+    return tuple(sorted((str(k), str(v)) for k, v in labels.items())) if labels else ()
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (name + '="' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+               for name, value in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_number(value):
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+class Registry:
+    def __init__(self, buckets=DEFAULT_BUCKETS, share_dir=None, share_interval=5):
+        """Metrics for one worker. With share_dir, workers also see each other's (see render())."""
+        self.buckets = tuple(buckets)
+        self.share_dir = share_dir
+        self.share_interval = share_interval  # Seconds between publishing our numbers to share_dir
+        self._lock = threading.Lock()
+        self._kinds = {}  # name -> (kind, help)
+        self._values = defaultdict(float)  # (name, labels) -> counter or gauge value
+        self._histograms = {}  # (name, labels) -> [count per bucket..., count above, sum]
+        self._collectors = []
+        self._publisher_pid = None
+
+    def describe(self, name, kind, text):
+        """Declare a metric's type (counter, gauge or histogram) and help text"""
+        self._kinds[name] = (kind, text)
+
+    def inc(self, name, labels=None, value=1):
+        """Add to a counter"""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._values[key] += value
+
+    def add(self, name, value, labels=None):
+        """Move a gauge up or down"""
+        self.inc(name, labels, value)
+
+    def observe(self, name, seconds, labels=None):
+        """Record one duration in a histogram"""
+        key = (name, _label_key(labels))
+        slot = bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            histogram[slot] += 1
+            histogram[-1] += seconds
+
+    def clear(self):
+        """Forget everything recorded so far (e.g. in a pre-fork parent, so workers start from zero)"""
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+
+    def collect_with(self, collector):
+        """Call collector() on every scrape; it yields (name, kind, help, labels, value)"""
+        self._collectors.append(collector)
+
+    @contextmanager
+    def track(self, name, labels=None, part=None, in_flight=None):
+        """Time a block into a histogram.
+
+        The block gets the labels dict and may add to it as it goes (e.g. the
+        status once a response arrives); if it raises first, the status is the
+        exception's name. part also adds the time to the request's Server-Timing
+        breakdown, and in_flight is a gauge counting blocks still running.
+        """
+        labels = dict(labels or {})
+        if in_flight:
+            self.add(in_flight, 1, labels)
+        in_flight_labels = dict(labels)
+        started = time.perf_counter()
+        try:
+            yield labels
+        except BaseException as e:
+            labels.setdefault('status', 'cancelled' if isinstance(e, asyncio.CancelledError) else type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe(name, elapsed, labels)
+            if part:
+                add_timing(part, elapsed)
+            if in_flight:
+                self.add(in_flight, -1, in_flight_labels)
+
+    def snapshot(self):
+        """Everything we have right now, collectors included, as a JSON-friendly dict"""
+        kinds = dict(self._kinds)
+        with self._lock:
+            values = [[name, list(labels), value] for (name, labels), value in self._values.items()]
+            histograms = [[name, list(labels), list(counts)] for (name, labels), counts in self._histograms.items()]
+        for collector in self._collectors:
+            try:
+                for name, kind, text, labels, value in collector():
+                    kinds.setdefault(name, (kind, text))
+                    values.append([name, list(_label_key(labels)), value])
+            except Exception as e:
+                logging.error(f"Metrics collector failed: {e}")
+        return {"pid": os.getpid(), "buckets": list(self.buckets), "kinds": kinds,
+                "values": values, "histograms": histograms}
+
+    ### 📤 SHARING BETWEEN WORKERS ###
+    def start_publishing(self):
+        """Publish this process's numbers to share_dir every share_interval (call from the workers only)"""
+        if not self.share_dir or self._publisher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._publisher_pid == os.getpid():
+                return
+            self._publisher_pid = os.getpid()
+        threading.Thread(target=self._publish_forever, name="metrics-publisher", daemon=True).start()
+
+    def _publish_forever(self):
+        while True:
+            self.publish()
+            time.sleep(self.share_interval)
+
+    def publish(self):
+        """Write our snapshot to share_dir for the other workers"""
+        try:
+            os.makedirs(self.share_dir, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.share_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(temp_path, os.path.join(self.share_dir, f"{os.getpid()}.json"))
+        except OSError as e:
+            logging.error(f"Couldn't publish metrics: {e}")
+
+    def _shared_snapshots(self):
+        """Snapshots of the other live workers (files of workers that are gone get removed)"""
+        snapshots = []
+        for entry in os.scandir(self.share_dir):
+            name, extension = os.path.splitext(entry.name)
+            if extension != '.json' or not name.isdigit() or int(name) == os.getpid():
+                continue
+            try:
+                os.kill(int(name), 0)
+            except ProcessLookupError:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(entry.path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # Being replaced right now; it'll be there next scrape
+        return snapshots
+
+    ### 📝 PROMETHEUS TEXT FORMAT ###
+    def render(self):
+        """Prometheus text format for this worker, plus every other live worker when sharing"""
+        snapshots = [self.snapshot()]
+        if self.share_dir and os.path.isdir(self.share_dir):
+            snapshots += self._shared_snapshots()
+
+        kinds, values, histograms = {}, defaultdict(float), {}
+        for snapshot in snapshots:
+            for name, (kind, text) in snapshot['kinds'].items():
+                kinds.setdefault(name, (kind, text))
+            for name, labels, value in snapshot['values']:
+                values[(name, tuple(map(tuple, labels)))] += value
+            if snapshot['buckets'] != list(self.buckets):
+                continue  # A worker with other settings; its histograms don't line up with ours
+            for name, labels, counts in snapshot['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                total = histograms.setdefault(key, [0] * len(counts))
+                for i, count in enumerate(counts):
+                    total[i] += count
+
+        by_name = defaultdict(list)
+        for (name, labels), value in values.items():
+            by_name[name].append((labels, value))
+        for (name, labels), counts in histograms.items():
+            by_name[name].append((labels, counts))
+
+        lines = []
+        for name in sorted(by_name):
+            kind, text = kinds.get(name, ('untyped', ''))
+            if text:
+                lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(by_name[name], key=lambda sample: sample[0]):
+                if kind != 'histogram':
+                    lines.append(f"{name}{_format_labels(labels)} {_format_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets, value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', _format_number(bound))])} {cumulative}")
+                cumulative += value[len(self.buckets)]
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {value[-1]:.6f}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+
+def instrument_methods(cls, registry, name, skip=('iter_',)):
+    """Time every public method of a class into a histogram labelled by method.
+
+    Methods called from inside another timed method are still counted in
+    the histogram, but only the outermost call goes into Server-Timing.
+    Static methods, class methods and generators (names starting with skip)
+    are left alone.
+    """
+    active = threading.local()
+
+    def timed(method_name, method):
+        def wrapper(*args, **kwargs):
+            outermost = not getattr(active, 'busy', False)
+            active.busy = True
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                if outermost:
+                    active.busy = False
+                    add_timing('db', elapsed)
+                registry.observe(name, elapsed, {"method": method_name})
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        wrapper.__wrapped__ = method
+        return wrapper
+
+    for attr, value in list(vars(cls).items()):
+        if (attr.startswith('_') or attr.startswith(skip) or not callable(value)
+                or isinstance(value, (staticmethod, classmethod)) or hasattr(value, '__wrapped__')):
+            continue
+        setattr(cls, attr, timed(attr, value))
+
+
+### ⏱️ PER-REQUEST TIMING ###
+class RequestTiming:
+    """Where one request's time went (for the Server-Timing header)"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.parts = defaultdict(lambda: [0.0, 0])  # part -> [seconds, calls]
+
+    def add(self, part, seconds):
+        entry = self.parts[part]
+        entry[0] += seconds
+        entry[1] += 1
+
+    def header(self):
+        """Server-Timing value. Concurrent calls overlap, so parts can add up to more than the total."""
+        parts = [f'{part};dur={seconds * 1000:.1f};desc="{calls} calls"'
+                 for part, (seconds, calls) in sorted(self.parts.items())]
+        parts.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(parts)
+
+
+def start_request_timing():
+    """Start timing the current request (its context, and tasks started from it)"""
+    timing = RequestTiming()
+    _request_timing.set(timing)
+    return timing
+
+
+def add_timing(part, seconds):
+    """Add time to the current request's breakdown, if we're in one"""
+    timing = _request_timing.get()
+    if timing is not None:
+        timing.add(part, seconds)
+
+
+### 🔥 SLOW REQUEST PROFILER ###
+class SlowRequestProfiler:
+    def __init__(self, threshold, interval=0.005, directory=None, top=5, max_depth=60):
+        """Sample the stacks of requests in flight every interval seconds.
+
+        Requests that take threshold seconds or more get their samples logged
+        (the top few stacks) and, with a directory, saved in the "folded"
+        format that flame graph tools read. Faster requests are forgotten.
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self.directory = directory
+        self.top = top
+        self.max_depth = max_depth
+        self._active = {}
+        self._lock = threading.Lock()
+        self._sampler_pid = None
+        self.slow_requests = 0
+
+    def begin(self, label, task=None):
+        """Start sampling the calling thread, or an asyncio task (for async servers). Returns a handle."""
+        if self._sampler_pid != os.getpid():
+            with self._lock:
+                if self._sampler_pid != os.getpid():
+                    self._sampler_pid = os.getpid()
+                    threading.Thread(target=self._sample_forever, name="slow-request-profiler", daemon=True).start()
+        handle = {"label": label, "thread": threading.get_ident(), "task": task,
+                  "stacks": Counter(), "started": time.perf_counter()}
+        with self._lock:
+            self._active[id(handle)] = handle
+        return handle
+
+    def end(self, handle):
+        """Stop sampling; report the request if it was slow"""
+        with self._lock:
+            self._active.pop(id(handle), None)
+            # The sampler only counts under the lock and only for active handles, so this copy is final
+            stacks = Counter(handle['stacks'])
+        elapsed = time.perf_counter() - handle['started']
+        if elapsed >= self.threshold and stacks:
+            self.slow_requests += 1
+            self._report(handle['label'], stacks, elapsed)
+
+    def _sample_forever(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active.values())
+            if not active:
+                continue
+            frames = sys._current_frames()
+            samples = []
+            for handle in active:
+                try:
+                    stack = self._task_stack(handle['task']) if handle['task'] else self._thread_stack(
+                        frames.get(handle['thread']))
+                except Exception:
+                    continue  # The task or thread moved on while we looked
+                if stack:
+                    samples.append((handle, stack))
+            with self._lock:
+                for handle, stack in samples:
+                    if id(handle) in self._active:  # Not if its request ended while we looked
+                        handle['stacks'][stack] += 1
+
+    @staticmethod
+    def _describe(frame):
+        return f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+
+    def _thread_stack(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            names.append(self._describe(frame))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def _task_stack(self, task):
+        # Follow the chain of awaits from the task's coroutine down to where it's waiting
+        names, coro = [], task.get_coro()
+        while coro is not None and len(names) < self.max_depth:
+            frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+            if frame is None:
+                break
+            names.append(self._describe(frame))
+            coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+        return ';'.join(names)
+
+    def _report(self, label, stacks, elapsed):
+        samples = sum(stacks.values())
+        top = '\n'.join(f"  {count / samples:5.1%}  ... > {' > '.join(stack.split(';')[-3:])}"
+                        for stack, count in stacks.most_common(self.top))
+        logging.warning(f"Slow request {label} took {elapsed:.2f}s ({samples} samples), "
+                        f"top stacks:\n{top}")
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            safe_label = re.sub(r'[^\w.-]+', '_', label).strip('_')
+            path = os.path.join(self.directory, f"slow-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-"
+                                                f"{safe_label}-{int(elapsed * 1000)}ms.folded")
+            with open(path, 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            logging.error(f"Couldn't save slow request profile: {e}")
@@ -0,0 +1,113 @@
+"""
+TuneFuse Preview Cache
+
+Keeps the 30-second MP3 previews people actually listen to on disk, so the
+library pages can play them back without going to Deezer every time:
+- One file per song, named after its catalog key
+- Files are written to a temp name and renamed into place, so workers
+  never see half-written previews
+- When the folder grows past its size limit, the least recently played
+  previews are deleted first
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PreviewCache:
+    def __init__(self, directory='preview_cache', max_bytes=512 * 1024 * 1024):
+        """Set up the cache folder (created if needed)"""
+        # Absolute, because send_file() treats relative paths as relative to the app, not the working folder
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._total_bytes = self._scan_size()
+
+    def _scan_size(self):
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.mp3'):
+                total += entry.stat().st_size
+        return total
+
+    def path_for(self, key):
+        """Where the preview for a catalog key lives on disk"""
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f"{name}.mp3")
+
+    def get(self, key):
+        """Path of the cached preview, or None. Marks it as recently played."""
+        path = self.path_for(key)
+        try:
+            os.utime(path)  # mtime doubles as "last played" for the LRU
+            return path
+        except FileNotFoundError:
+            return None
+
+    @contextmanager
+    def writer(self, key):
+        """Write a preview. It only becomes visible if the block finishes cleanly."""
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                yield out
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, self.path_for(key))
+        except BaseException:
+            # Includes GeneratorExit when a client hangs up mid-stream
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+        with self._lock:
+            self._total_bytes += size
+            over_limit = self._total_bytes > self.max_bytes
+        if over_limit:
+            self.trim()
+
+    def store(self, key, chunks):
+        """Save a preview from an iterable of byte chunks and return its path"""
+        with self.writer(key) as out:
+            for chunk in chunks:
+                out.write(chunk)
+        return self.path_for(key)
+
+    def trim(self):
+        """Delete the least recently played previews until we're under the limit"""
+        with self._lock:
+            files = []
+            for entry in os.scandir(self.directory):
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                # Leftover temp files from crashed workers
+                if entry.name.endswith('.part') and stat.st_mtime < time.time() - 3600:
+                    self._remove(entry.path)
+                elif entry.name.endswith('.mp3'):
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in files)
+            # Leave some headroom so we don't trim again on the very next write
+            target = self.max_bytes * 0.9
+            for _, size, path in sorted(files):
+                if total <= target:
+                    break
+                if self._remove(path):
+                    total -= size
+            self._total_bytes = total
+            logging.debug(f"Preview cache trimmed to {total} bytes")
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
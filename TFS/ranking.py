@@ -0,0 +1,105 @@
+"""
+TuneFuse Recommendation Ranking
+
+Recommendations come from more than one place (Last.fm similar tracks and
+Deezer's related artists). Rather than taking one source and ignoring the
+other, their candidates are merged and ranked:
+- Candidates are matched by catalog key, so a song both sources suggest is
+  one candidate that keeps what each of them knows about it
+- Scoring is a weighted sum over a small feature matrix, all at once with
+  NumPy: Last.fm's match score, Deezer's rank, and how many of our users
+  like the song. A source that didn't say counts as the middle value.
+- Only the best candidates get previews and Spotify IDs looked up, so no
+  lookups are spent on songs that get dropped anyway
+- Each user's results are then re-ordered by how much they like each artist,
+  which is cheap enough to do on every request
+"""
+
+from collections import Counter
+
+import numpy as np
+
+from database import normalize_track_key
+
+FEATURES = ('match', 'rank', 'popularity')  # Columns of the feature matrix
+
+DEEZER_RANK_SCALE = np.log1p(1_000_000)  # Deezer ranks go up to about a million
+POPULARITY_SCALE = np.log1p(100)  # Songs liked by this many of our users count as fully popular
+
+
+def merge_candidates(*sources):
+    """Merge candidate lists into one, one entry per catalog key, in first-seen order.
+
+    A candidate is a dict with title, artist and a set of sources, plus
+    whatever its source knows (match, rank, mbid, deezer_id, isrc, ...).
+    When two sources suggest the same song, the first one's values win and
+    the second fills in the rest.
+    """
+    merged = {}
+    for candidates in sources:
+        for candidate in candidates:
+            key = normalize_track_key(candidate['title'], candidate['artist'])
+            existing = merged.get(key)
+            if existing is None:
+                merged[key] = dict(candidate, key=key)
+                continue
+            for field, value in candidate.items():
+                if existing.get(field) is None:
+                    existing[field] = value
+            existing['sources'] = existing['sources'] | candidate['sources']
+    return list(merged.values())
+
+
+def feature_matrix(candidates, like_counts):
+    """(candidates x FEATURES) array scaled to 0-1, NaN where no source said"""
+    features = np.empty((len(candidates), len(FEATURES)))
+    features[:, 0] = np.array([c.get('match') for c in candidates], dtype=float)
+    features[:, 1] = np.log1p(np.array([c.get('rank') for c in candidates], dtype=float)) / DEEZER_RANK_SCALE
+    features[:, 2] = np.log1p(np.asarray(like_counts, dtype=float)) / POPULARITY_SCALE
+    return np.clip(features, 0, 1)
+
+
+def score(features, weights):
+    """Weighted sum of each row. Missing values count as the median of the ones we have."""
+    missing = np.isnan(features)
+    if missing.any():
+        features = features.copy()
+        present = ~missing.all(axis=0)
+        medians = np.zeros(features.shape[1])
+        medians[present] = np.nanmedian(features[:, present], axis=0)
+        features[missing] = np.broadcast_to(medians, features.shape)[missing]
+    return features @ np.array([weights[name] for name in FEATURES], dtype=float)
+
+
+def top_k(scores, k):
+    """Indexes of the k highest scores, best first"""
+    scores = np.asarray(scores)
+    best = np.argpartition(-scores, k)[:k] if len(scores) > k else np.arange(len(scores))
+    return best[np.argsort(-scores[best], kind='stable')]
+
+
+def artist_affinity(liked):
+    """How much a user likes each artist (0-1), from their liked-songs filter.
+
+    liked is the set from Database.get_liked_filter(); its catalog keys start
+    with the normalized artist.
+    """
+    counts = Counter(key.split('|', 1)[0] for key in liked if '|' in key)
+    most = max(counts.values(), default=0)
+    return {artist: count / most for artist, count in counts.items()}
+
+
+def personalize(results, scores, affinity, weight):
+    """Re-order ranked results for one user: their score plus weight x the user's artist affinity.
+
+    Results stored before scores were (scores is None) keep their order as
+    a score from 1 down to 0.
+    """
+    if not affinity or not weight or len(results) < 2:
+        return results
+    if scores is None or len(scores) != len(results):
+        scores = np.linspace(1, 0, len(results))
+    boost = np.array([affinity.get(normalize_track_key(r['title'], r['artist']).split('|', 1)[0], 0)
+                      for r in results])
+    order = np.argsort(-(np.asarray(scores, dtype=float) + weight * boost), kind='stable')
+    return [results[i] for i in order]
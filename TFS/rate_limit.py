@@ -0,0 +1,163 @@
+"""
+TuneFuse Upstream Rate Limiter
+
+Spotify, Last.fm and Deezer all limit how fast we may call them, and the
+limit is for the whole app, not per worker. This keeps one token bucket per
+provider in a small SQLite file that every worker process shares:
+- Each call takes a token; tokens refill at the provider's rate
+- Interactive calls (the search box, the main recommendation lookups) may
+  use the whole bucket, background enrichment has to leave a reserve
+- Callers say how long they're willing to wait. If there's no token in
+  time they get RateLimited and carry on without that call, instead of
+  queueing forever
+- A 429 from a provider pauses its bucket for every worker at once
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+
+class RateLimited(Exception):
+    """No token for this provider within the time the caller was willing to wait"""
+
+
+class RateLimiter:
+    def __init__(self, rates, db_name='tunefuse_limits.db', reserve=0.25):
+        """rates maps provider -> (calls per second, burst size), shared by all workers.
+
+        reserve is the share of each bucket that only interactive calls may use.
+        """
+        self.rates = rates
+        self.db_name = db_name
+        self.reserve = reserve
+        self.limited = {provider: 0 for provider in rates}
+        self._local = threading.local()
+        self._create_tables()
+
+    def _get_connection(self):
+        """One connection per thread, in autocommit mode so we control the transactions"""
+        conn = getattr(self._local, 'conn', None)
+        # Connections can't be shared with a forked child, so it opens its own
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_name, timeout=1, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')  # Losing a few tokens in a crash is fine
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """Close this thread's connection"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _create_tables(self):
+        self._get_connection().execute('''
+            CREATE TABLE IF NOT EXISTS buckets (
+                provider TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                paused_until REAL NOT NULL DEFAULT 0
+            )
+        ''')
+
+    def try_acquire(self, provider, priority=INTERACTIVE):
+        """Take a token if one is free. Returns 0 if we got it, else seconds until one should be."""
+        if provider not in self.rates:
+            return 0
+        rate, burst = self.rates[provider]
+        floor = 1 if priority == INTERACTIVE else 1 + self.reserve * burst
+        conn = self._get_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                row = conn.execute(
+                    'SELECT tokens, updated_at, paused_until FROM buckets WHERE provider = ?', (provider,)
+                ).fetchone()
+                tokens, updated_at, paused_until = row or (burst, now, 0)
+                tokens = min(burst, tokens + max(0, now - updated_at) * rate)
+
+                if paused_until > now:
+                    wait = paused_until - now
+                elif tokens >= floor:
+                    tokens -= 1
+                    wait = 0
+                else:
+                    wait = (floor - tokens) / rate
+
+                conn.execute(
+                    'INSERT OR REPLACE INTO buckets (provider, tokens, updated_at, paused_until) VALUES (?, ?, ?, ?)',
+                    (provider, tokens, now, paused_until)
+                )
+                conn.execute('COMMIT')
+                return wait
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            # A broken limiter file shouldn't take the site down with it
+            logging.error(f"Rate limiter error: {e}")
+            return 0
+
+    def pause(self, provider, seconds):
+        """Stop every worker calling a provider for a while (after a 429)"""
+        if provider not in self.rates:
+            return
+        until = time.time() + seconds
+        try:
+            self._get_connection().execute('''
+                INSERT INTO buckets (provider, tokens, updated_at, paused_until) VALUES (?, 0, ?, ?)
+                ON CONFLICT(provider) DO UPDATE SET
+                    tokens = 0,
+                    updated_at = excluded.updated_at,
+                    paused_until = MAX(paused_until, excluded.paused_until)
+            ''', (provider, time.time(), until))
+        except sqlite3.Error as e:
+            logging.error(f"Rate limiter error: {e}")
+
+    def _give_up(self, provider):
+        self.limited[provider] += 1
+        return RateLimited(f"No {provider} capacity right now")
+
+    def acquire_sync(self, provider, priority=INTERACTIVE, max_wait=0):
+        """Wait up to max_wait seconds for a token, or raise RateLimited"""
+        give_up_at = time.monotonic() + max_wait
+        while True:
+            wait = self.try_acquire(provider, priority)
+            if wait == 0:
+                return
+            if time.monotonic() + wait > give_up_at:
+                raise self._give_up(provider)
+            time.sleep(wait)
+
+    async def acquire(self, provider, priority=INTERACTIVE, max_wait=0):
+        """Same as acquire_sync, without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        give_up_at = loop.time() + max_wait
+        while True:
+            # Taking a token is a tiny SQLite write, but it may wait on another worker's lock
+            wait = await loop.run_in_executor(None, self.try_acquire, provider, priority)
+            if wait == 0:
+                return
+            if loop.time() + wait > give_up_at:
+                raise self._give_up(provider)
+            await asyncio.sleep(wait)
+
+    async def pause_async(self, provider, seconds):
+        await asyncio.get_running_loop().run_in_executor(None, self.pause, provider, seconds)
+
+    def stats(self):
+        return {
+            provider: {"rate": rate, "burst": burst, "limited": self.limited[provider]}
+            for provider, (rate, burst) in self.rates.items()
+        }
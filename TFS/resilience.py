@@ -0,0 +1,136 @@
+"""
+TuneFuse Upstream Resilience
+
+Last.fm, Deezer and Spotify all have bad days. These helpers keep one slow
+or broken provider from dragging every request down with it:
+- A circuit breaker per provider: after a few failures in a row we stop
+  calling it for a while and go straight to the fallback, then let a single
+  test call through to see if it's back
+- Retry delays with jitter that respect the provider's Retry-After header
+- Hedged calls: if an answer is taking unusually long, fire a second copy
+  and take whichever comes back first
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpen(Exception):
+    """The provider has been failing, so we're not calling it right now"""
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        """Opens after failure_threshold failures in a row, retries after reset_timeout seconds"""
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True if we may call the provider now"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Let one test call through; the next one waits for another reset_timeout
+                self.state = 'half_open'
+                self.opened_at = time.monotonic()
+                return True
+            self.rejected += 1
+            return False
+
+    def check(self):
+        """Raise CircuitOpen unless we may call the provider now"""
+        if not self.allow():
+            raise CircuitOpen(f"{self.name} circuit is open")
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logging.info(f"{self.name} is back, closing its circuit")
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+                if self.state == 'closed':
+                    logging.warning(f"{self.name} failed {self.failures} times in a row, opening its circuit")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def record_status(self, status):
+        """Record an HTTP answer: rate limits and server errors count as failures"""
+        if status in RETRYABLE_STATUSES:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "rejected": self.rejected
+        }
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (seconds or an HTTP date), or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt, retry_after=None, base=0.1, cap=2.0):
+    """How long to wait before retry number attempt (0-based).
+
+    The provider's Retry-After wins; otherwise "full jitter" exponential
+    backoff, so retries from many requests don't all land at once.
+    """
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def hedged(call, delay, backup=None):
+    """Await call(); if it hasn't answered after delay seconds, race a second copy.
+
+    backup is what runs as the second copy (call again by default).
+    Returns the first successful answer. Raises only if both copies fail.
+    """
+    tasks = [asyncio.ensure_future(call())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            tasks.append(asyncio.ensure_future((backup or call)()))
+
+        pending, error = set(tasks), None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -10,82 +10,474 @@ This is the main server file that handles:
 Made with using Flask
 """
 
-import base64
 import os
-import requests
+import contextvars
+import hashlib
+import json
 import logging
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for
+import random
+import sqlite3
+import tempfile
+import time
+from flask import Flask, Response, request, jsonify, render_template, session, redirect, url_for, send_file, g
 from dotenv import load_dotenv
-from database import Database
+from database import Database, normalize_track_key
+from spotify_auth import SpotifyTokenManager
+from http_pool import run_async, loop_local, get_session, get_http_session
+from cache import TieredCache, MISS
+from preview_cache import PreviewCache
+from autocomplete import Autocomplete
+from resilience import CircuitBreaker, CircuitOpen, RETRYABLE_STATUSES, parse_retry_after, retry_delay, hedged
+from rate_limit import RateLimiter, RateLimited, INTERACTIVE, BACKGROUND
+from batch_resolver import BatchResolver
+from local_recs import LocalRecommender
+from write_behind import WriteBehindQueue
+import ranking
+import http_cache
+from ann_index import IVFIndex
+from track_embeddings import SIMILARITY_INDEX_DIR
+from metrics import Registry, SlowRequestProfiler, instrument_methods, start_request_timing
 from werkzeug.security import generate_password_hash, check_password_hash
-import aiohttp
-from aiohttp import ClientSession
 import asyncio
-from functools import wraps
+import aiohttp
+from requests import RequestException
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
 # Load our secret keys from .env file (keeps them safe!)
 load_dotenv()
+
+# Set up logging so we can track any problems
+logging.basicConfig(level=logging.DEBUG)
 SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 SPOTIFY_REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI")
 LASTFM_API_KEY = os.getenv("LASTFM_API_KEY")
-DEEZER_API_URL = "https://api.deezer.com/search"
+
+# Upstream APIs (point these at fake_upstream.py to run without the real services)
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com/v1")
+SPOTIFY_TOKEN_URL = os.getenv("SPOTIFY_TOKEN_URL", "https://accounts.spotify.com/api/token")
+LASTFM_API_URL = os.getenv("LASTFM_API_URL", "http://ws.audioscrobbler.com/2.0/")
+DEEZER_API_URL = os.getenv("DEEZER_API_URL", "https://api.deezer.com")
+SPOTIFY_SEARCH_URL = f"{SPOTIFY_API_URL}/search"
+DEEZER_SEARCH_URL = f"{DEEZER_API_URL}/search"
+
+# Recommendation pipeline tuning
+RECOMMENDATIONS_BUDGET = float(os.getenv("RECOMMENDATIONS_BUDGET", "4"))  # Seconds per request
+DEEZER_CONCURRENCY = int(os.getenv("DEEZER_CONCURRENCY", "8"))  # Parallel Deezer lookups
+SPOTIFY_CONCURRENCY = int(os.getenv("SPOTIFY_CONCURRENCY", "8"))  # Parallel Spotify lookups
+SPOTIFY_BATCH_WINDOW = float(os.getenv("SPOTIFY_BATCH_WINDOW", "0.01"))  # Seconds to collect Spotify ID lookups
+
+# Precomputed recommendations
+RECS_FRESH_TTL = int(os.getenv("RECS_FRESH_TTL", str(24 * 3600)))  # Served as-is for this long
+RECS_MAX_AGE = int(os.getenv("RECS_MAX_AGE", str(7 * 24 * 3600)))  # Stale answers are served (and refreshed) until then
+RECS_FALLBACK_TTL = int(os.getenv("RECS_FALLBACK_TTL", "900"))  # Deezer-fallback answers get retried sooner
+RECS_PREWARM_INTERVAL = int(os.getenv("RECS_PREWARM_INTERVAL", "3600"))  # Seconds between pre-warm runs (0 = off)
+RECS_PREWARM_SEEDS = int(os.getenv("RECS_PREWARM_SEEDS", "50"))  # Popular and most-liked seeds kept warm
+
+# Local (co-like) recommendations
+LOCAL_RECS_MIN_RESULTS = int(os.getenv("LOCAL_RECS_MIN_RESULTS", "10"))  # Fewer than this and we ask Last.fm instead
+LOCAL_RECS_MIN_CO_LIKES = int(os.getenv("LOCAL_RECS_MIN_CO_LIKES", "2"))  # Users who must like both songs
+LOCAL_RECS_SYNC_INTERVAL = int(os.getenv("LOCAL_RECS_SYNC_INTERVAL", "10"))  # Seconds between picking up new likes
+LOCAL_RECS_REBUILD_INTERVAL = int(os.getenv("LOCAL_RECS_REBUILD_INTERVAL", "3600"))  # Seconds between full rebuilds
+LOCAL_RECS_MAX_USER_LIKES = int(os.getenv("LOCAL_RECS_MAX_USER_LIKES", "500"))  # Newest likes per user that count
+LOCAL_RECS_LIMIT = 20  # Same as Last.fm
+SIMILARITY_INDEX_CHECK = 60  # Seconds between looks for a newer similarity index
+
+# Ranking Last.fm and Deezer candidates (can be tuned from .env)
+RECS_RESULTS = int(os.getenv("RECS_RESULTS", "20"))  # Best candidates enriched and returned per seed
+RECS_SPARES = int(os.getenv("RECS_SPARES", "20"))  # Runners-up kept per seed to stand in for songs a user hid
+LASTFM_SIMILAR_LIMIT = int(os.getenv("LASTFM_SIMILAR_LIMIT", "50"))  # Similar tracks asked from Last.fm
+DEEZER_RELATED_ARTISTS = 5  # Related artists whose top tracks we consider
+DEEZER_TRACKS_PER_ARTIST = 4
+RANK_WEIGHTS = {
+    'match': float(os.getenv("RANK_WEIGHT_MATCH", "1")),  # Last.fm match score
+    'rank': float(os.getenv("RANK_WEIGHT_DEEZER", "0.3")),  # Deezer rank (how much a song is played there)
+    'popularity': float(os.getenv("RANK_WEIGHT_POPULARITY", "0.3"))  # How many of our users like it
+}
+RANK_WEIGHT_AFFINITY = float(os.getenv("RANK_WEIGHT_AFFINITY", "0.5"))  # How much the user likes the artist
+
+# Upstream response cache
+CACHE_DB = os.getenv("CACHE_DB", "tunefuse_cache.db")  # Shared by every worker
+CACHE_MEMORY_SIZE = int(os.getenv("CACHE_MEMORY_SIZE", "10000"))  # Entries kept in memory per worker
+LASTFM_CACHE_TTL = int(os.getenv("LASTFM_CACHE_TTL", str(24 * 3600)))  # Similar-track lists
+LOOKUP_CACHE_TTL = int(os.getenv("LOOKUP_CACHE_TTL", str(7 * 24 * 3600)))  # Deezer/Spotify matches
+NEGATIVE_CACHE_TTL = int(os.getenv("NEGATIVE_CACHE_TTL", "3600"))  # "Nothing found" answers
+
+# Audio preview cache
+PREVIEW_CACHE_DIR = os.getenv("PREVIEW_CACHE_DIR", "preview_cache")
+PREVIEW_CACHE_MAX_MB = int(os.getenv("PREVIEW_CACHE_MAX_MB", "512"))
+PREVIEW_CHUNK_SIZE = 64 * 1024  # Bytes per chunk when relaying previews
+
+# Search autocomplete
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "300"))  # Seconds to reuse a search answer
+SEARCH_UPSTREAM_TIMEOUT = float(os.getenv("SEARCH_UPSTREAM_TIMEOUT", "0.8"))  # Then answer locally
+
+# Upstream resilience
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "1.5"))  # Seconds per upstream call
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))  # Retries on 429/5xx/dropped connections
+UPSTREAM_HEDGE_DELAY = float(os.getenv("UPSTREAM_HEDGE_DELAY", "0.75"))  # Backup enrichment lookup after this (0 = off)
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))  # Failures in a row before we stop calling a provider
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "30"))  # Seconds before we try it again
+
+# Upstream rate limits, in calls per second for all workers together
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", "tunefuse_limits.db")  # Shared by every worker
+SPOTIFY_RATE_LIMIT = float(os.getenv("SPOTIFY_RATE_LIMIT", "10"))
+LASTFM_RATE_LIMIT = float(os.getenv("LASTFM_RATE_LIMIT", "5"))
+DEEZER_RATE_LIMIT = float(os.getenv("DEEZER_RATE_LIMIT", "10"))
+BACKGROUND_RATE_WAIT = float(os.getenv("BACKGROUND_RATE_WAIT", "0.2"))  # Then skip the enrichment lookup
+
+# Likes and hides (can be tuned from .env)
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "").lower() in ('1', 'true', 'yes')  # Commit them on a background thread
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", "10000"))  # Queued writes before requests wait for the writer
+MAX_BATCH_SONGS = 500  # Most songs one batch request may change
+
+# Sessions (can be set in .env)
+SECRET_KEY = os.getenv("SECRET_KEY")  # Signs the login cookie; every worker must use the same one
+SECRET_KEY_FILE = os.getenv("SECRET_KEY_FILE", ".secret_key")  # Where we keep a generated key when SECRET_KEY isn't set
+
+# Metrics and profiling (can be tuned from .env)
+METRICS_DIR = os.getenv("METRICS_DIR", "")  # Folder where workers share their numbers, so /metrics covers them all
+SERVER_TIMING = os.getenv("SERVER_TIMING", "").lower() in ('1', 'true', 'yes')  # Add a Server-Timing header
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "0"))  # Profile requests slower than this (0 = off)
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))  # Seconds between stack samples
+PROFILE_DIR = os.getenv("PROFILE_DIR", "")  # Save slow-request stacks here for flame graphs (empty = just log them)
+
+def load_secret_key():
+    """SECRET_KEY, or a random key generated once and kept in SECRET_KEY_FILE.
+
+    Every worker process (and every restart) has to sign sessions with the
+    same key, or users get logged out whenever another worker answers. When
+    several workers start at once, the first one to save its key wins and the
+    others read it.
+    """
+    if SECRET_KEY:
+        return SECRET_KEY
+    empty = False
+    try:
+        with open(SECRET_KEY_FILE, 'rb') as f:
+            key = f.read()
+        if key:
+            return key
+        empty = True
+    except FileNotFoundError:
+        pass
+
+    # Write it under a temporary name first, so nobody ever reads a half-written key
+    directory = os.path.dirname(os.path.abspath(SECRET_KEY_FILE))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.secret_key-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(32))
+        if empty:
+            # An empty file is no use to anyone, so swap ours in over it
+            os.replace(temp_path, SECRET_KEY_FILE)
+            logging.warning(f"{SECRET_KEY_FILE} was empty, generated a new key in it")
+        else:
+            try:
+                os.link(temp_path, SECRET_KEY_FILE)
+                logging.warning(f"No SECRET_KEY set, generated one in {SECRET_KEY_FILE}")
+            except FileExistsError:
+                pass  # Another worker beat us to it
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    with open(SECRET_KEY_FILE, 'rb') as f:
+        key = f.read()
+    if not key:
+        raise RuntimeError(f"Couldn't save a session key in {SECRET_KEY_FILE}; set SECRET_KEY instead")
+    return key
 
 # Create our Flask app with some basic settings
 app = Flask(__name__, 
     static_folder='assets',
     static_url_path=''
 )
-app.secret_key = os.urandom(24)  # Random key for extra security
+app.secret_key = load_secret_key()  # Shared by every worker, so sessions work whichever one answers
 app.config['SESSION_COOKIE_SECURE'] = False  # For local development
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)  # Stay logged in for a week
 
+# CSS, JS and images under content-hashed names, so browsers can keep them for a year.
+# Edited files get new names straight away when running `python server.py` (development).
+static_assets = http_cache.StaticAssets(app.static_folder, reload=__name__ == '__main__')
+
+@app.context_processor
+def asset_helpers():
+    return {"asset_url": static_assets.url}
+
+@app.after_request
+def compress_response(response):
+    """Compress JSON, HTML, CSS and JS for browsers that accept it"""
+    if response.direct_passthrough or not http_cache.should_compress(
+            response.mimetype, response.status_code, response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = http_cache.choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = http_cache.compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < http_cache.COMPRESS_MIN_BYTES:
+            return response
+        response.set_data(http_cache.compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    if 'ETag' in response.headers:
+        response.headers['ETag'] = http_cache.encoded_etag(response.headers['ETag'], encoding)
+    return response
+
+# Timings and counters for /metrics, kept per worker (and shared through METRICS_DIR)
+metrics = Registry(share_dir=METRICS_DIR or None)
+for name, kind, text in (
+    ('tunefuse_http_request_duration_seconds', 'histogram', "Time to answer a request, by route and status"),
+    ('tunefuse_http_requests_in_flight', 'gauge', "Requests being answered right now"),
+    ('tunefuse_upstream_request_duration_seconds', 'histogram', "Time per call to a provider, by status"),
+    ('tunefuse_upstream_requests_in_flight', 'gauge', "Calls to a provider waiting for an answer right now"),
+    ('tunefuse_db_call_duration_seconds', 'histogram', "Time per Database method call"),
+    ('tunefuse_preview_requests_total', 'counter', "Preview requests, by whether the file was cached"),
+):
+    metrics.describe(name, kind, text)
+instrument_methods(Database, metrics, 'tunefuse_db_call_duration_seconds')
+
+# Samples the stacks of slow requests, so we can see where their time went
+profiler = SlowRequestProfiler(SLOW_REQUEST_SECONDS, interval=PROFILE_INTERVAL,
+                               directory=PROFILE_DIR or None) if SLOW_REQUEST_SECONDS > 0 else None
+
+def route_name():
+    """The route pattern that matched (e.g. /api/songs/batch/<action>), so metrics don't grow per URL"""
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@app.before_request
+def start_request_metrics():
+    metrics.start_publishing()
+    g.request_started = time.perf_counter()
+    g.request_timing = start_request_timing()
+    metrics.add('tunefuse_http_requests_in_flight', 1)
+    g.profile = profiler.begin(f"{request.method} {route_name()}") if profiler else None
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' in g:
+        metrics.observe('tunefuse_http_request_duration_seconds', time.perf_counter() - g.request_started,
+                        {"route": route_name(), "method": request.method, "status": response.status_code})
+        if SERVER_TIMING:
+            response.headers['Server-Timing'] = g.request_timing.header()
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    if g.pop('request_started', None) is not None:
+        metrics.add('tunefuse_http_requests_in_flight', -1)
+        if g.profile:
+            profiler.end(g.profile)
+
+def upstream_call(provider):
+    """Time one call to a provider for /metrics and Server-Timing (the block fills in labels['status'])"""
+    return metrics.track('tunefuse_upstream_request_duration_seconds', {"provider": provider}, part=provider,
+                         in_flight='tunefuse_upstream_requests_in_flight')
+
+async def in_thread(func, *args):
+    """Run blocking code (like a database call) on the default thread pool, keeping the request's timing"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, contextvars.copy_context().run, func, *args)
+
 # Set up our database connection
 db = Database()
 
-# Set up logging so we can track any problems
-logging.basicConfig(level=logging.DEBUG)
+# In write-behind mode, likes and hides are committed in batches by one background thread
+song_writer = WriteBehindQueue(db, max_size=WRITE_QUEUE_SIZE) if WRITE_BEHIND else None
+
+def change_songs(changes):
+    """Apply Database.song_change()s: queued for the writer in write-behind mode, else right away"""
+    if song_writer:
+        return song_writer.submit(changes)
+    return db.apply_song_changes(changes)
+
+def caught_up(user_id):
+    """Wait until a user's own queued likes and hides are committed, so they see them when reading"""
+    if song_writer:
+        song_writer.wait_for_user(user_id)
+
+# Catalog writes happen on one background thread, off the request path
+catalog_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="catalog-writer")
+
+def remember_tracks(tracks):
+    """Queue what an upstream just told us about some tracks for the catalog"""
+    if tracks:
+        catalog_writer.submit(db.upsert_tracks, tracks)
+
+# Songs our own users like together, kept in memory per worker
+local_recommender = LocalRecommender(
+    db,
+    min_co_likes=LOCAL_RECS_MIN_CO_LIKES,
+    sync_interval=LOCAL_RECS_SYNC_INTERVAL,
+    rebuild_interval=LOCAL_RECS_REBUILD_INTERVAL,
+    max_user_likes=LOCAL_RECS_MAX_USER_LIKES
+)
+
+# Remembers what Last.fm, Deezer and Spotify told us (memory + shared disk)
+upstream_cache = TieredCache(memory_size=CACHE_MEMORY_SIZE, db_name=CACHE_DB)
+
+# Hot 30-second previews, kept on disk and shared by every worker
+preview_cache = PreviewCache(PREVIEW_CACHE_DIR, max_bytes=PREVIEW_CACHE_MAX_MB * 1024 * 1024)
+
+# Each provider gets its own circuit breaker, shared by every request on this worker
+breakers = {
+    name: CircuitBreaker(name, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET)
+    for name in ('lastfm', 'deezer', 'spotify')
+}
+
+# Meters calls to each provider across every worker (bursts of up to 2 seconds' worth)
+rate_limiter = RateLimiter({
+    'spotify': (SPOTIFY_RATE_LIMIT, 2 * SPOTIFY_RATE_LIMIT),
+    'lastfm': (LASTFM_RATE_LIMIT, 2 * LASTFM_RATE_LIMIT),
+    'deezer': (DEEZER_RATE_LIMIT, 2 * DEEZER_RATE_LIMIT)
+}, db_name=RATE_LIMIT_DB)
+
+# One Spotify token per process, refreshed shortly before it expires
+spotify_tokens = SpotifyTokenManager(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, token_url=SPOTIFY_TOKEN_URL)
 
 def get_spotify_token():
-    """Get or refresh Spotify access token."""
-    try:
-        auth_string = f"{SPOTIFY_CLIENT_ID}:{SPOTIFY_CLIENT_SECRET}"
-        auth_bytes = auth_string.encode('utf-8')
-        auth_base64 = str(base64.b64encode(auth_bytes), 'utf-8')
-        
-        url = "https://accounts.spotify.com/api/token"
-        headers = {
-            "Authorization": f"Basic {auth_base64}",
-            "Content-Type": "application/x-www-form-urlencoded"
-        }
-        data = {"grant_type": "client_credentials"}
-        
-        result = requests.post(url, headers=headers, data=data)
-        result.raise_for_status()  # Will raise an exception for HTTP errors
-        json_result = result.json()
-        token = json_result.get("access_token")
-        
-        if not token:
-            raise Exception("No token received from Spotify")
-            
-        return token
-    except Exception as e:
-        logging.error(f"Error getting Spotify token: {e}")
-        return None
+    """Get the cached Spotify access token (refreshed automatically)."""
+    return spotify_tokens.get_token()
+
+async def get_spotify_token_async():
+    """Get the cached Spotify access token without blocking the event loop."""
+    return await spotify_tokens.get_token_async()
 
-def async_route(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        return asyncio.run(f(*args, **kwargs))
-    return wrapper
+# Spotify can revoke or rotate a token before it expires; it then answers 401
+def renew_spotify_token(rejected):
+    """A new Spotify token to replace one Spotify rejected with a 401"""
+    spotify_tokens.invalidate(rejected)
+    return get_spotify_token()
+
+async def renew_spotify_token_async(rejected):
+    """Same as renew_spotify_token, without blocking the event loop"""
+    spotify_tokens.invalidate(rejected)
+    return await get_spotify_token_async()
 
 # Routes
 @app.route('/')
 def home():
     return render_template('index.html')
 
+@app.route('/assets/<path:name>')
+def hashed_asset(name):
+    """CSS, JS and images under their content-hashed names (see StaticAssets)"""
+    answer = static_assets.respond(name, request.headers.get('Accept-Encoding'), request.headers.get('If-None-Match'))
+    if answer is None:
+        return jsonify({"error": "Not found"}), 404
+    status, body, mimetype, headers = answer
+    return Response(body, status=status, mimetype=mimetype, headers=headers)
+
+class SpotifyUnavailable(Exception):
+    """We couldn't get a Spotify token"""
+
+def spotify_search(query):
+    """Ask Spotify for up to 10 tracks matching a query"""
+    spotify_token = get_spotify_token()
+    if not spotify_token:
+        raise SpotifyUnavailable()
+
+    params = {"q": query, "type": "track", "limit": 10}
+
+    def send(token):
+        breakers['spotify'].check()
+        rate_limiter.acquire_sync('spotify', INTERACTIVE, max_wait=UPSTREAM_TIMEOUT)
+        try:
+            with upstream_call('spotify') as labels:
+                response = get_http_session().get(SPOTIFY_SEARCH_URL, params=params,
+                                                  headers={"Authorization": f"Bearer {token}"},
+                                                  timeout=UPSTREAM_TIMEOUT)
+                labels['status'] = response.status_code
+        except RequestException:
+            breakers['spotify'].record_failure()
+            raise
+        breakers['spotify'].record_status(response.status_code)
+        if response.status_code == 429:
+            rate_limiter.pause('spotify', parse_retry_after(response.headers.get('Retry-After')) or 1)
+        return response
+
+    response = send(spotify_token)
+    if response.status_code == 401:
+        # Revoked or rotated early: try once more with a new token
+        spotify_token = renew_spotify_token(spotify_token)
+        if not spotify_token:
+            raise SpotifyUnavailable()
+        response = send(spotify_token)
+    response.raise_for_status()
+    return search_results(response.json())
+
+async def spotify_search_async(query):
+    """Same as spotify_search, without blocking the event loop"""
+    spotify_token = await get_spotify_token_async()
+    if not spotify_token:
+        raise SpotifyUnavailable()
+
+    params = {"q": query, "type": "track", "limit": "10"}
+
+    async def send(token, renewable):
+        """Search results, or None for a 401 we can retry with a new token"""
+        breakers['spotify'].check()
+        await rate_limiter.acquire('spotify', INTERACTIVE, max_wait=UPSTREAM_TIMEOUT)
+        try:
+            with upstream_call('spotify') as labels:
+                async with get_session().get(SPOTIFY_SEARCH_URL, params=params,
+                                             headers={"Authorization": f"Bearer {token}"},
+                                             timeout=aiohttp.ClientTimeout(total=UPSTREAM_TIMEOUT)) as response:
+                    labels['status'] = response.status
+                    breakers['spotify'].record_status(response.status)
+                    if response.status == 429:
+                        await rate_limiter.pause_async('spotify',
+                                                       parse_retry_after(response.headers.get('Retry-After')) or 1)
+                    if response.status == 401 and renewable:
+                        return None
+                    response.raise_for_status()
+                    return search_results(await response.json())
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            breakers['spotify'].record_failure()
+            raise
+
+    results = await send(spotify_token, renewable=True)
+    if results is None:
+        # Revoked or rotated early: try once more with a new token
+        spotify_token = await renew_spotify_token_async(spotify_token)
+        if not spotify_token:
+            raise SpotifyUnavailable()
+        results = await send(spotify_token, renewable=False)
+    return results
+
+def search_results(data):
+    """Turn a Spotify search response into our search results (and remember them)"""
+    tracks = data.get("tracks", {}).get("items", [])
+    results = [{
+        "id": track["id"],
+        "title": track["name"],
+        "artist": track["artists"][0]["name"],
+        "image": track["album"]["images"][0]["url"] if track["album"]["images"] else None,
+        "spotify_id": track["id"]
+    } for track in tracks]
+
+    remember_tracks([{
+        "title": r["title"],
+        "artist": r["artist"],
+        "spotify_id": r["spotify_id"],
+        "cover_url": r["image"]
+    } for r in results])
+    return results
+
+# Caches, coalesces and backs up the Spotify search behind the search box
+autocomplete = Autocomplete(
+    spotify_search,
+    fetch_async=spotify_search_async,
+    local_search=db.search_tracks,
+    ttl=SEARCH_CACHE_TTL,
+    upstream_timeout=SEARCH_UPSTREAM_TIMEOUT
+)
+
 @app.route('/api/search')
 def search():
     """Handle search with Spotify"""
@@ -93,38 +485,79 @@ def search():
     if not query:
         return jsonify([])
 
-    spotify_token = get_spotify_token()
-    if not spotify_token:
-        return jsonify({"error": "Spotify service unavailable"}), 503
-
     try:
-        url = f"https://api.spotify.com/v1/search?q={query}&type=track&limit=10"
-        headers = {"Authorization": f"Bearer {spotify_token}"}
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        
-        tracks = response.json().get("tracks", {}).get("items", [])
-        results = [{
-            "id": track["id"],
-            "title": track["name"],
-            "artist": track["artists"][0]["name"],
-            "image": track["album"]["images"][0]["url"] if track["album"]["images"] else None,
-            "spotify_id": track["id"]
-        } for track in tracks]
-        
-        return jsonify(results)
+        return jsonify(autocomplete.search(query))
+    except (SpotifyUnavailable, CircuitOpen, RateLimited):
+        return jsonify({"error": "Spotify service unavailable"}), 503
     except Exception as e:
         logging.error(f"Spotify search error: {str(e)}")
         return jsonify({"error": "Search failed"}), 500
 
+@app.route('/api/cache/stats')
+def cache_stats():
+    """Hit/miss/eviction counters for the upstream cache"""
+    return jsonify(upstream_cache.stats())
+
+def component_metrics():
+    """Counters the caches, breakers and background workers keep for themselves, read on every scrape"""
+    caches = {"upstream_memory": upstream_cache.memory.stats(), "upstream_disk": upstream_cache.disk.stats(),
+              "song_filters": db._song_filters.stats()}
+    for cache, stats in caches.items():
+        yield 'tunefuse_cache_hits_total', 'counter', "Cache hits", {"cache": cache}, stats['hits']
+        yield 'tunefuse_cache_misses_total', 'counter', "Cache misses", {"cache": cache}, stats['misses']
+    for provider, breaker in breakers.items():
+        stats = breaker.stats()
+        for state in ('closed', 'half_open', 'open'):
+            yield ('tunefuse_circuit_breaker_state', 'gauge', "1 for the state each provider's breaker is in",
+                   {"provider": provider, "state": state}, int(stats['state'] == state))
+        yield ('tunefuse_circuit_breaker_rejected_total', 'counter', "Calls refused by an open breaker",
+               {"provider": provider}, stats['rejected'])
+    for provider, stats in rate_limiter.stats().items():
+        yield ('tunefuse_rate_limited_total', 'counter', "Calls that gave up waiting for a rate limit token",
+               {"provider": provider}, stats['limited'])
+    recommender = local_recommender.stats()
+    yield 'tunefuse_local_recs_songs', 'gauge', "Songs in the local recommender", {}, recommender['songs']
+    yield ('tunefuse_local_recs_pending_updates', 'gauge', "Likes not yet folded into the local recommender", {},
+           recommender['pending_updates'])
+    if song_writer:
+        writer = song_writer.stats()
+        yield 'tunefuse_write_queue_length', 'gauge', "Song changes waiting for the writer", {}, writer['queued']
+        yield 'tunefuse_write_queue_changes_total', 'counter', "Song changes committed by the writer", {}, writer['changes']
+        yield 'tunefuse_write_queue_failed_total', 'counter', "Song changes the writer couldn't apply", {}, writer['failed']
+
+metrics.collect_with(component_metrics)
+
+@app.route('/metrics')
+def metrics_page():
+    """Prometheus metrics for this worker (and every other live worker, with METRICS_DIR)"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/check_login')
 def check_login():
-    """Check if user is logged in"""
+    """Check if user is logged in (only reads the signed session cookie, never the database)"""
     return jsonify({
         "logged_in": 'user_id' in session
     })
 
 # Auth routes
+REQUIRED_REGISTRATION_FIELDS = ['username', 'password', 'email', 'firstname', 'lastname']
+
+def missing_registration_fields(data):
+    """Required registration fields that are missing or empty"""
+    return [field for field in REQUIRED_REGISTRATION_FIELDS if not field in data or not data[field]]
+
+def login_error_message(result):
+    """What to tell the user when verify_user didn't log them in"""
+    error_msg = "Invalid username or password"
+    if result and "error" in result:
+        if result["error"] == "user_not_found":
+            error_msg = "User not found"
+        elif result["error"] == "invalid_password":
+            error_msg = "Invalid password"
+        elif result["error"] == "database_error":
+            error_msg = "Database error occurred"
+    return error_msg
+
 @app.route('/api/register', methods=['POST'])
 def register():
     """Handle user registration"""
@@ -133,11 +566,9 @@ def register():
         if not data:
             return jsonify({"error": "No data provided"}), 400
 
-        required_fields = ['username', 'password', 'email', 'firstname', 'lastname']
-        
         # Check required fields
-        if not all(field in data and data[field] for field in required_fields):
-            missing = [field for field in required_fields if not field in data or not data[field]]
+        missing = missing_registration_fields(data)
+        if missing:
             return jsonify({
                 "error": f"Missing required fields: {', '.join(missing)}"
             }), 400
@@ -208,18 +639,9 @@ def login():
             }), 200
         
         # Handle specific error cases
-        error_msg = "Invalid username or password"
-        if result and "error" in result:
-            if result["error"] == "user_not_found":
-                error_msg = "User not found"
-            elif result["error"] == "invalid_password":
-                error_msg = "Invalid password"
-            elif result["error"] == "database_error":
-                error_msg = "Database error occurred"
-
         return jsonify({
             "success": False,
-            "error": error_msg
+            "error": login_error_message(result)
         }), 401
 
     except Exception as e:
@@ -235,6 +657,68 @@ def logout():
     return jsonify({"success": True, "message": "Logout successful"})
 
 # Song management routes
+MAX_PAGE_SIZE = 500  # Most songs a client can ask for in one page
+
+def stream_json_array(items):
+    """Write a JSON array one item at a time instead of building it in memory"""
+    yield '['
+    for index, item in enumerate(items):
+        yield (',' if index else '') + json.dumps(item)
+    yield ']'
+
+def page_limit(args):
+    """The page size a listing request asked for, kept within bounds"""
+    return min(max(int(args.get('limit', 50)), 1), MAX_PAGE_SIZE)
+
+def wants(args, flag):
+    """True if a yes/no query parameter is switched on"""
+    return args.get(flag, '').lower() in ('1', 'true', 'yes')
+
+def library_etag(user_id, kind, query_string):
+    """ETag for a liked/hidden listing: changes with the user's library version and with the query"""
+    query = hashlib.sha1(query_string).hexdigest()[:10]
+    return f"{kind}-{user_id}-{db.get_library_version(user_id)}-{query}"
+
+def library_headers(response, etag):
+    """Let the browser keep a listing but check its ETag every time (only its own cache: it's per user)"""
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+def song_listing(user_id, kind, list_songs, get_page, iter_songs):
+    """Answer a liked/hidden listing request.
+
+    - No parameters: the whole list, as before
+    - ?limit=N&after=CURSOR: one page, as {"songs": [...], "next": cursor or null}
+    - ?stream=1: the whole list, streamed so memory use stays flat
+
+    A browser that already has the current version gets a 304, without the listing query.
+    A database error is a 500 with no ETag, so an empty or partial list never gets cached.
+    """
+    try:
+        caught_up(user_id)
+        etag = library_etag(user_id, kind, request.query_string)
+        matched = http_cache.matching_etag(request.headers.get('If-None-Match'), etag)
+        if matched:
+            return library_headers(Response(status=304), matched)
+
+        if wants(request.args, 'stream'):
+            response = Response(stream_json_array(iter_songs(user_id)), mimetype='application/json')
+        elif 'limit' not in request.args and 'after' not in request.args:
+            response = jsonify(list_songs(user_id))
+        else:
+            try:
+                limit = page_limit(request.args)
+                songs, next_cursor = get_page(user_id, limit, request.args.get('after'))
+            except ValueError:
+                return jsonify({"error": "Invalid limit or cursor"}), 400
+            response = jsonify({"songs": songs, "next": next_cursor})
+    except sqlite3.Error as e:
+        logging.error(f"Error listing {kind} songs: {e}")
+        return jsonify({"error": f"Failed to get {kind} songs"}), 500
+    return library_headers(response, f'"{etag}"')
+
 @app.route('/api/songs/like', methods=['GET', 'POST', 'DELETE'])
 def handle_like():
     """Handle liking/unliking songs and getting liked songs"""
@@ -244,19 +728,18 @@ def handle_like():
     user_id = session['user_id']
 
     if request.method == 'GET':
-        liked_songs = db.get_liked_songs(user_id)
-        return jsonify(liked_songs)
+        return song_listing(user_id, 'liked', db.get_liked_songs, db.get_liked_songs_page, db.iter_liked_songs)
     
     song_data = request.json
     
     if request.method == 'POST':
-        success = db.save_song(user_id, song_data)
+        success = change_songs([db.song_change('like', user_id, song_data)])
         if success:
             return jsonify({"message": "Song liked"}), 200
         return jsonify({"error": "Failed to like song"}), 500
     
     elif request.method == 'DELETE':
-        success = db.remove_song(user_id, song_data['track_id'])
+        success = change_songs([db.song_change('unlike', user_id, song_data)])
         if success:
             return jsonify({"message": "Song unliked"}), 200
         return jsonify({"error": "Failed to unlike song"}), 500
@@ -270,7 +753,7 @@ def hide_song():
     user_id = session['user_id']
     song_data = request.json
     
-    if db.hide_song(user_id, song_data):
+    if change_songs([db.song_change('hide', user_id, song_data)]):
         return jsonify({"message": "Song hidden"}), 200
     return jsonify({"error": "Failed to hide song"}), 500
 
@@ -280,8 +763,8 @@ def get_hidden_songs():
     if 'user_id' not in session:
         return jsonify({"error": "Not logged in"}), 401
     
-    hidden_songs = db.get_hidden_songs(session['user_id'])
-    return jsonify(hidden_songs)
+    return song_listing(session['user_id'], 'hidden', db.get_hidden_songs, db.get_hidden_songs_page,
+                        db.iter_hidden_songs)
 
 @app.route('/api/songs/unhide', methods=['POST'])
 def unhide_song():
@@ -290,129 +773,757 @@ def unhide_song():
         return jsonify({"error": "Not logged in"}), 401
 
     song_data = request.json
-    success = db.unhide_song(session['user_id'], song_data['track_id'])
+    success = change_songs([db.song_change('unhide', session['user_id'], song_data)])
     
     if success:
         return jsonify({"message": "Song unhidden"}), 200
     return jsonify({"error": "Failed to unhide song"}), 500
 
+BATCH_ACTIONS = {'like': 'liked', 'unlike': 'unliked', 'hide': 'hidden', 'unhide': 'unhidden'}
+
+def batch_song_changes(user_id, action, data):
+    """Song changes for a batch request body ({"songs": [...]}). Raises ValueError if it isn't valid."""
+    songs = data.get('songs') if isinstance(data, dict) else None
+    if not isinstance(songs, list) or not songs:
+        raise ValueError("Send a list of songs")
+    if len(songs) > MAX_BATCH_SONGS:
+        raise ValueError(f"At most {MAX_BATCH_SONGS} songs per request")
+    try:
+        return [db.song_change(action, user_id, song) for song in songs]
+    except (KeyError, TypeError, AttributeError):
+        raise ValueError("Every song needs a track_id (and a track_name and artist_name to like or hide it)")
+
+@app.route('/api/songs/batch/<action>', methods=['POST'])
+def batch_songs(action):
+    """Like, unlike, hide or unhide many songs at once, all in one transaction"""
+    if 'user_id' not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    if action not in BATCH_ACTIONS:
+        return jsonify({"error": "Unknown action"}), 404
+
+    try:
+        changes = batch_song_changes(session['user_id'], action, request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if change_songs(changes):
+        return jsonify({"message": f"{len(changes)} songs {BATCH_ACTIONS[action]}"}), 200
+    return jsonify({"error": f"Failed to {action} songs"}), 500
+
+async def gather_within_budget(coros, deadline):
+    """Run coroutines concurrently until the deadline.
+
+    Results come back in the same order as the coroutines. Anything that
+    failed or didn't finish in time comes back as None.
+    """
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    if not tasks:
+        return []
+
+    timeout = max(0, deadline - asyncio.get_running_loop().time())
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+
+    results = []
+    for task in tasks:
+        if task in done and task.exception() is None:
+            results.append(task.result())
+        else:
+            if task in done and not isinstance(task.exception(), (CircuitOpen, RateLimited)):
+                logging.error(f"Enrichment lookup failed: {task.exception()}")
+            results.append(None)
+    return results
+
+class UpstreamError(Exception):
+    """An upstream API answered with something other than a 200"""
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+async def fetch_json(session, provider, url, deadline, headers=None, hedge=False, priority=INTERACTIVE):
+    """GET a JSON document from a provider, giving up when the deadline passes.
+
+    Each try gets at most UPSTREAM_TIMEOUT seconds. Rate limits, server
+    errors, timeouts and dropped connections are retried with jittered
+    backoff (or after Retry-After, if that still fits in the budget) and
+    count against the provider's circuit breaker. hedge=True fires a backup
+    request when a try is slower than UPSTREAM_HEDGE_DELAY.
+
+    Every request needs a token from the shared rate limiter. BACKGROUND
+    calls only wait BACKGROUND_RATE_WAIT for one, then raise RateLimited.
+    """
+    breaker = breakers[provider]
+    loop = asyncio.get_running_loop()
+
+    async def get():
+        with upstream_call(provider) as labels:
+            async with session.get(url, headers=headers) as response:
+                labels['status'] = response.status
+                if response.status != 200:
+                    raise UpstreamError(f"{response.status} from {provider}", response.status,
+                                        response.headers.get('Retry-After'))
+                return await response.json()
+
+    async def backup():
+        # A hedge is extra load, so it only goes out if there's a spare token right now
+        await rate_limiter.acquire(provider, BACKGROUND)
+        return await get()
+
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        breaker.check()
+        max_wait = max(0, deadline - loop.time())
+        await rate_limiter.acquire(provider, priority,
+                                   max_wait if priority == INTERACTIVE else min(max_wait, BACKGROUND_RATE_WAIT))
+        timeout = min(UPSTREAM_TIMEOUT, max(0, deadline - loop.time()))
+        try:
+            call = hedged(get, UPSTREAM_HEDGE_DELAY, backup) if hedge and UPSTREAM_HEDGE_DELAY > 0 else get()
+            data = await asyncio.wait_for(call, timeout)
+        except UpstreamError as e:
+            breaker.record_status(e.status)
+            if e.status == 429:
+                await rate_limiter.pause_async(provider, parse_retry_after(e.retry_after) or 1)
+            if e.status not in RETRYABLE_STATUSES:
+                raise
+            error, retry_after = e, parse_retry_after(e.retry_after)
+        except asyncio.TimeoutError as e:
+            if timeout < UPSTREAM_TIMEOUT:
+                raise  # Our own budget ran out, that's not the provider's fault
+            breaker.record_failure()
+            error, retry_after = e, None
+        except aiohttp.ClientConnectionError as e:
+            breaker.record_failure()
+            error, retry_after = e, None
+        else:
+            breaker.record_success()
+            return data
+
+        delay = retry_delay(attempt, retry_after)
+        if attempt == UPSTREAM_RETRIES or loop.time() + delay >= deadline:
+            raise error
+        await asyncio.sleep(delay)
+
+def cache_key(kind, title, artist):
+    """Cache key for a lookup, ignoring case and stray whitespace"""
+    return f"{kind}:{artist.strip().casefold()}:{title.strip().casefold()}"
+
+async def cached_lookup(key, fetch, ttl):
+    """Return a cached answer, or fetch it and remember it.
+
+    Empty answers ("no match") are kept for NEGATIVE_CACHE_TTL instead of ttl.
+    Errors and timeouts are never cached.
+    """
+    value = await upstream_cache.aget(key)
+    if value is not MISS:
+        return value
+    value = await fetch()
+    await upstream_cache.aset(key, value, ttl if value else NEGATIVE_CACHE_TTL)
+    return value
+
+async def lookup_catalog(pairs):
+    """Check the track catalog for a list of (title, artist) pairs"""
+    return await in_thread(db.get_tracks, pairs)
+
+async def fetch_deezer_track(session, limiter, deadline, title, artist, known=None, priority=BACKGROUND):
+    """Find the Deezer preview and album cover for a track"""
+    if known and known.get('preview_url') and known.get('cover_url'):
+        return {
+            "preview_url": known['preview_url'],
+            "image": known['cover_url'],
+            "deezer_id": known.get('deezer_id')
+        }
+
+    async def fetch():
+        deezer_url = f"{DEEZER_SEARCH_URL}?q=track:\"{title}\" artist:\"{artist}\""
+        async with limiter:
+            deezer_data = await fetch_json(session, 'deezer', deezer_url, deadline, hedge=True, priority=priority)
+        if deezer_data.get('data'):
+            first = deezer_data['data'][0]
+            return {
+                "preview_url": first.get('preview'),
+                "image": first.get('album', {}).get('cover_xl'),
+                "deezer_id": first.get('id')
+            }
+        return None
+    return await cached_lookup(cache_key('deezer', title, artist), fetch, LOOKUP_CACHE_TTL)
+
+async def fetch_spotify_id(session, limiter, deadline, spotify_token, title, artist, isrc=None):
+    """Find the Spotify ID for a track (by ISRC when we know it, that's an exact match)"""
+    if not spotify_token:
+        return None
+    async def fetch():
+        query = f"isrc:{isrc}" if isrc else f"track:{title} artist:{artist}"
+        spotify_url = f"{SPOTIFY_SEARCH_URL}?q={query}&type=track&limit=1"
+        async with limiter:
+            try:
+                spotify_data = await fetch_json(session, 'spotify', spotify_url, deadline, hedge=True,
+                                                headers={"Authorization": f"Bearer {spotify_token}"},
+                                                priority=BACKGROUND)
+            except UpstreamError as e:
+                if e.status != 401:
+                    raise
+                # Revoked or rotated early: try once more with a new token
+                token = await renew_spotify_token_async(spotify_token)
+                if not token:
+                    raise
+                spotify_data = await fetch_json(session, 'spotify', spotify_url, deadline, hedge=True,
+                                                headers={"Authorization": f"Bearer {token}"},
+                                                priority=BACKGROUND)
+        if spotify_data.get('tracks', {}).get('items'):
+            return spotify_data['tracks']['items'][0]['id']
+        return None
+    return await cached_lookup(cache_key('spotify', title, artist), fetch, LOOKUP_CACHE_TTL)
+
+async def resolve_spotify_batch(items, deadline):
+    """Spotify IDs for a batch of unique (title, artist, isrc) items: cache first, then search"""
+    spotify_token = await get_spotify_token_async()
+    session, limiter = get_session(), provider_limits()['spotify']
+    keys = list(items)
+    spotify_ids = await gather_within_budget([
+        fetch_spotify_id(session, limiter, deadline, spotify_token, *items[key]) for key in keys
+    ], deadline)
+    return dict(zip(keys, spotify_ids))
+
+def spotify_resolver():
+    """This worker's shared Spotify ID resolver"""
+    return loop_local('spotify_resolver', lambda: BatchResolver(resolve_spotify_batch, window=SPOTIFY_BATCH_WINDOW))
+
+async def resolve_spotify_ids(tracks, deadline):
+    """Spotify IDs for a list of (title, artist, catalog entry, isrc), in the same order.
+
+    The catalog answers what it can; everything else goes through the shared
+    resolver, so a song wanted by several requests at once is looked up once.
+    """
+    resolver = spotify_resolver()
+    async def resolve(title, artist, known, isrc):
+        if known and known.get('spotify_id'):
+            return known['spotify_id']
+        return await resolver.resolve(normalize_track_key(title, artist), (title, artist, isrc), deadline)
+    return await gather_within_budget([resolve(*track) for track in tracks], deadline)
+
+async def fetch_lastfm_similar(session, deadline, track, artist):
+    """Get the raw list of similar tracks from Last.fm"""
+    async def fetch():
+        lastfm_url = f"{LASTFM_API_URL}?method=track.getsimilar&artist={artist}&track={track}&api_key={LASTFM_API_KEY}&format=json&limit={LASTFM_SIMILAR_LIMIT}"
+        data = await fetch_json(session, 'lastfm', lastfm_url, deadline)
+        return data.get('similartracks', {}).get('track', [])
+    return await cached_lookup(cache_key('lastfm', track, artist), fetch, LASTFM_CACHE_TTL)
+
+def is_excluded(excluded, title, artist, *track_ids):
+    """True if a candidate's catalog key or any of its IDs is in the excluded set"""
+    if not excluded:
+        return False
+    return normalize_track_key(title, artist) in excluded or any(
+        track_id and str(track_id) in excluded for track_id in track_ids)
+
+async def lastfm_candidates(session, track, artist, deadline):
+    """Similar tracks from Last.fm as ranking candidates (empty if Last.fm has nothing or fails)"""
+    try:
+        similar_tracks = await fetch_lastfm_similar(session, deadline, track, artist)
+    except Exception as e:
+        logging.warning(f"Last.fm request failed ({e!r}), using Deezer only")
+        return []
+
+    if not similar_tracks:
+        logging.info("No Last.fm results, using Deezer only")
+        return []
+
+    # Last.fm's links feed the similarity index (see track_embeddings.py)
+    catalog_writer.submit(db.add_track_edges, [
+        (track, artist, t['name'], t['artist']['name'], float(t.get('match') or 1)) for t in similar_tracks
+    ])
+
+    return [{
+        "title": t['name'],
+        "artist": t['artist']['name'],
+        "match": float(t['match']) if t.get('match') else None,
+        "mbid": t.get('mbid') or None,
+        "fallback_image": t.get('image', [{}])[-1].get('#text') or None,
+        "sources": {'lastfm'}
+    } for t in similar_tracks]
+
+async def deezer_candidates(session, artist, deadline, limits):
+    """Top tracks of related artists from Deezer as ranking candidates (empty if Deezer fails)"""
+    try:
+        # First get the artist ID from Deezer
+        deezer_data = await fetch_json(session, 'deezer', f"{DEEZER_SEARCH_URL}?q=artist:\"{artist}\"", deadline)
+        if not deezer_data.get("data"):
+            return []
+        artist_id = deezer_data["data"][0].get("artist", {}).get("id")
+        if not artist_id:
+            return []
+
+        # Get related artists
+        similar_data = await fetch_json(session, 'deezer', f"{DEEZER_API_URL}/artist/{artist_id}/related",
+                                        deadline)
+        similar_artists = similar_data.get("data", [])
+    except Exception as e:
+        logging.warning(f"Deezer related artists failed ({e!r})")
+        return []
+
+    async def top_tracks(artist_id):
+        async with limits['deezer']:
+            top_data = await fetch_json(session, 'deezer', f"{DEEZER_API_URL}/artist/{artist_id}/top", deadline)
+        return top_data.get("data", [])[:DEEZER_TRACKS_PER_ARTIST]
+
+    # Top tracks of the closest related artists, all at once
+    artist_tracks = await gather_within_budget(
+        [top_tracks(a['id']) for a in similar_artists[:DEEZER_RELATED_ARTISTS]], deadline)
+    return [{
+        "title": t['title'],
+        "artist": t['artist']['name'],
+        "rank": t.get('rank'),
+        "deezer_id": t.get('id'),
+        "isrc": t.get('isrc'),
+        "preview_url": t.get('preview'),
+        "image": t.get('album', {}).get('cover_xl'),
+        "sources": {'deezer'}
+    } for tracks in artist_tracks if tracks for t in tracks]
+
+async def enrich_candidates(session, candidates, deadline, limits):
+    """Previews, covers and Spotify IDs for ranked candidates. Returns results in the same order.
+
+    The catalog and what a source already told us come first; only the gaps
+    are looked up on Deezer and Spotify.
+    """
+    catalog = await lookup_catalog([(c['title'], c['artist']) for c in candidates])
+    known = [catalog.get(c['key']) for c in candidates]
+
+    async def deezer_info(candidate, entry):
+        if candidate.get('preview_url') and candidate.get('image'):
+            return {
+                "preview_url": candidate['preview_url'],
+                "image": candidate['image'],
+                "deezer_id": candidate.get('deezer_id')
+            }
+        return await fetch_deezer_track(session, limits['deezer'], deadline, candidate['title'], candidate['artist'],
+                                        entry)
+
+    # Every remaining Deezer and Spotify lookup runs at the same time, within the provider limits
+    deezer_info, spotify_ids = await asyncio.gather(
+        gather_within_budget([deezer_info(c, entry) for c, entry in zip(candidates, known)], deadline),
+        resolve_spotify_ids([(c['title'], c['artist'], entry, c.get('isrc'))
+                             for c, entry in zip(candidates, known)], deadline)
+    )
+
+    remember_tracks([{
+        "title": c['title'],
+        "artist": c['artist'],
+        "spotify_id": spotify_id,
+        "deezer_id": (deezer or {}).get('deezer_id'),
+        "preview_url": (deezer or {}).get('preview_url'),
+        "cover_url": (deezer or {}).get('image')
+    } for c, deezer, spotify_id in zip(candidates, deezer_info, spotify_ids)])
+
+    results = []
+    for c, deezer, spotify_id in zip(candidates, deezer_info, spotify_ids):
+        deezer = deezer or {}
+        results.append({
+            "id": spotify_id or c.get('mbid') or str(deezer.get('deezer_id') or ''),
+            "title": c['title'],
+            "artist": c['artist'],
+            "image": deezer.get('image') or c.get('fallback_image'),
+            "preview_url": deezer.get('preview_url'),
+            "spotify_id": spotify_id
+        })
+    return results
+
+def provider_limits():
+    """Per-provider concurrency limits, shared by every request on this worker"""
+    return loop_local('provider_limits', lambda: {
+        'deezer': asyncio.Semaphore(DEEZER_CONCURRENCY),
+        'spotify': asyncio.Semaphore(SPOTIFY_CONCURRENCY)
+    })
+
+# What we keep of a runner-up candidate, enough to enrich it later
+SPARE_FIELDS = ('title', 'artist', 'key', 'mbid', 'deezer_id', 'isrc', 'preview_url', 'image', 'fallback_image')
+
+async def find_recommendations(track, artist, excluded=frozenset()):
+    """Run the recommendation pipeline. Returns (source, results, scores, spares).
+
+    Last.fm and Deezer are asked at the same time; their candidates are
+    merged, scored (see ranking.py), and only the best RECS_RESULTS are
+    enriched. The next RECS_SPARES come back as spares, not enriched yet.
+    The source is "lastfm" when Last.fm contributed, else "deezer".
+    Songs whose ID or catalog key is in excluded are left out.
+    """
+    # Whatever has finished when the budget runs out is what we return
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + RECOMMENDATIONS_BUDGET
+    # Slow sources may only use half the budget, so there's time left to enrich the winners
+    candidates_deadline = loop.time() + RECOMMENDATIONS_BUDGET / 2
+    limits = provider_limits()
+    session = get_session()
+
+    lastfm, deezer = await asyncio.gather(
+        lastfm_candidates(session, track, artist, candidates_deadline),
+        deezer_candidates(session, artist, candidates_deadline, limits)
+    )
+    source = "lastfm" if lastfm else "deezer"
+
+    # Drop hidden (and maybe liked) songs before we spend any lookups on them
+    candidates = [c for c in ranking.merge_candidates(lastfm, deezer)
+                  if not is_excluded(excluded, c['title'], c['artist'], c.get('mbid'), c.get('deezer_id'))]
+    if not candidates:
+        return source, [], [], []
+
+    features = ranking.feature_matrix(candidates, local_recommender.like_counts([c['key'] for c in candidates]))
+    scores = ranking.score(features, RANK_WEIGHTS)
+    ranked = ranking.top_k(scores, RECS_RESULTS + RECS_SPARES)
+    best = ranked[:RECS_RESULTS]
+    spares = [dict({field: candidates[i].get(field) for field in SPARE_FIELDS}, score=float(scores[i]))
+              for i in ranked[RECS_RESULTS:]]
+
+    results = await enrich_candidates(session, [candidates[i] for i in best], deadline, limits)
+    kept = [(result, float(scores[i])) for result, i in zip(results, best)
+            if not (result['spotify_id'] and result['spotify_id'] in excluded)]
+    return source, [result for result, _ in kept], [s for _, s in kept], spares
+
+def recommendations_key(track, artist):
+    """Cache key for a seed's precomputed recommendations"""
+    return f"recs:{normalize_track_key(track, artist)}"
+
+def without_excluded(results, excluded):
+    """Drop the results a user has hidden (or liked, if they asked)"""
+    return [r for r in results
+            if not is_excluded(excluded, r['title'], r['artist'], r.get('id'), r.get('spotify_id'))]
+
+async def top_up(entry, excluded, wanted):
+    """Up to wanted of a seed's spares, enriched, to stand in for results the user filtered out"""
+    spares = [c for c in entry.get('spares', [])
+              if not is_excluded(excluded, c['title'], c['artist'], c.get('mbid'), c.get('deezer_id'))][:wanted]
+    if not spares:
+        return []
+    # Lookups are cached, so the next user with the same gaps gets these quickly
+    deadline = asyncio.get_running_loop().time() + RECOMMENDATIONS_BUDGET / 2
+    results = await enrich_candidates(get_session(), spares, deadline, provider_limits())
+    return without_excluded(results, excluded)
+
+async def compute_recommendations(track, artist, previous=None, recheck=False):
+    """Run the pipeline for a seed and store the answer. Returns the stored entry.
+
+    recheck=True first looks for an answer another worker already refreshed.
+    """
+    key = recommendations_key(track, artist)
+    if recheck:
+        loop = asyncio.get_running_loop()
+        entry, expires_at = await loop.run_in_executor(None, upstream_cache.disk.get, key)
+        if entry is not MISS and entry['fresh_until'] > time.time():
+            upstream_cache.memory.set(key, entry, expires_at=expires_at)
+            return entry
+        if entry is not MISS:
+            previous = entry
+
+    source, results, scores, spares = await find_recommendations(track, artist)
+    if previous and previous['source'] == 'lastfm' and source != 'lastfm':
+        # Last.fm is having trouble; keep its last answer rather than the fallback and try again soon
+        entry = dict(previous, fresh_until=time.time() + RECS_FALLBACK_TTL)
+    else:
+        fresh_for = RECS_FRESH_TTL if source == 'lastfm' else RECS_FALLBACK_TTL
+        entry = {"source": source, "results": results, "scores": scores, "spares": spares,
+                 "fresh_until": time.time() + fresh_for}
+    if entry['results']:
+        await upstream_cache.aset(key, entry, RECS_MAX_AGE)
+    return entry
+
+def refresh_recommendations(track, artist, previous=None, recheck=False):
+    """Start (or join) computing a seed's recommendations on this worker. Returns the task."""
+    refreshing = loop_local('recs_refreshing', dict)
+    key = recommendations_key(track, artist)
+    task = refreshing.get(key)
+    if task is None:
+        task = asyncio.ensure_future(compute_recommendations(track, artist, previous, recheck))
+        refreshing[key] = task
+
+        def finished(task):
+            refreshing.pop(key, None)
+            if not task.cancelled() and task.exception() is not None:
+                logging.warning(f"Refreshing recommendations for {key} failed: {task.exception()!r}")
+        task.add_done_callback(finished)
+    return task
+
+_similarity_index = {"index": None, "version": None, "checked": None}
+
+def similarity_index():
+    """The saved song similarity index (picks up newer versions by itself), or None if there isn't one"""
+    now = time.monotonic()
+    if _similarity_index["checked"] is None or now - _similarity_index["checked"] >= SIMILARITY_INDEX_CHECK:
+        _similarity_index["checked"] = now
+        version = IVFIndex.current_version(SIMILARITY_INDEX_DIR)
+        if version and version != _similarity_index["version"]:
+            try:
+                _similarity_index["index"] = IVFIndex.load(SIMILARITY_INDEX_DIR)
+                _similarity_index["version"] = version
+            except Exception as e:
+                logging.error(f"Couldn't load similarity index {version}: {e}")
+    return _similarity_index["index"]
+
+async def indexed_neighbors(track, artist, excluded=frozenset()):
+    """The seed's nearest songs in the similarity index, shaped like local_recommender.similar()"""
+    index = similarity_index()
+    if index is None:
+        return []
+    neighbors = index.similar(normalize_track_key(track, artist), LOCAL_RECS_LIMIT + len(excluded))
+    if not neighbors:
+        return []
+    catalog = await in_thread(db.get_tracks_by_keys, [key for key, _ in neighbors])
+    songs = []
+    for key, score in neighbors:
+        known = catalog.get(key)
+        if known and not is_excluded(excluded, known['title'], known['artist'], known['spotify_id'], known['deezer_id']):
+            songs.append({
+                "track_id": known['spotify_id'] or known['deezer_id'] or key,
+                "title": known['title'],
+                "artist": known['artist'],
+                "album_cover": known['cover_url'],
+                "score": score
+            })
+    return songs[:LOCAL_RECS_LIMIT]
+
+async def local_recommendations(track, artist, excluded=frozenset()):
+    """Songs our users like together with the seed, or None if we don't know enough yet.
+
+    Direct co-likes come first. When a seed has too few, its nearest songs in
+    the similarity index (co-likes plus Last.fm links) are used instead.
+    """
+    local_recommender.refresh_in_background()
+    similar = [song for song in local_recommender.similar(track, artist, LOCAL_RECS_LIMIT + len(excluded))
+               if not is_excluded(excluded, song['title'], song['artist'], song['track_id'])][:LOCAL_RECS_LIMIT]
+    if len(similar) < LOCAL_RECS_MIN_RESULTS:
+        similar = await indexed_neighbors(track, artist, excluded)
+    if len(similar) < LOCAL_RECS_MIN_RESULTS:
+        return None
+
+    # Previews and Spotify IDs come from the catalog; no upstream calls here
+    catalog = await lookup_catalog([(song['title'], song['artist']) for song in similar])
+    results = []
+    for song in similar:
+        known = catalog.get(normalize_track_key(song['title'], song['artist'])) or {}
+        spotify_id = known.get('spotify_id')
+        results.append({
+            "id": spotify_id or song['track_id'],
+            "title": song['title'],
+            "artist": song['artist'],
+            "image": known.get('cover_url') or song['album_cover'],
+            "preview_url": known.get('preview_url'),
+            "spotify_id": spotify_id
+        })
+    return results
+
+async def get_recommendations(track, artist, excluded=frozenset(), liked=frozenset()):
+    """Recommendations for a seed. Returns (source, results).
+
+    When enough of our users like the seed, their co-likes answer it ("local").
+    Otherwise we use the precomputed Last.fm/Deezer answer: fresh ones are
+    served straight away, stale ones too while a background refresh brings
+    them up to date. Only a seed we haven't seen in RECS_MAX_AGE waits for
+    the whole pipeline. Artists the user has liked (liked, from
+    get_liked_filter) move up the list.
+    """
+    start_prewarming()
+    catalog_writer.submit(db.record_seed_requests, [(track, artist)])
+
+    local = await local_recommendations(track, artist, excluded)
+    if local:
+        return "local", local
+
+    entry = await upstream_cache.aget(recommendations_key(track, artist))
+    if entry is MISS:
+        # shield() keeps the shared computation going if this request gives up
+        entry = await asyncio.shield(refresh_recommendations(track, artist))
+    elif entry['fresh_until'] <= time.time():
+        refresh_recommendations(track, artist, previous=entry, recheck=True)
+    results = ranking.personalize(entry['results'], entry.get('scores'), ranking.artist_affinity(liked),
+                                  RANK_WEIGHT_AFFINITY)
+    results = without_excluded(results, excluded)
+    if excluded and len(results) < RECS_RESULTS:
+        # The answer is shared by everyone, so songs this user hid are replaced from the spares
+        results += await top_up(entry, excluded, RECS_RESULTS - len(results))
+    return entry['source'], results
+
+async def prewarm_recommendations():
+    """Refresh the most requested and most liked seeds before anyone has to wait for them"""
+    loop = asyncio.get_running_loop()
+    popular = await loop.run_in_executor(None, db.get_popular_seeds, RECS_PREWARM_SEEDS)
+    liked = await loop.run_in_executor(None, db.get_liked_seeds, RECS_PREWARM_SEEDS)
+    seeds = {recommendations_key(track, artist): (track, artist) for track, artist in popular + liked}
+
+    warmed = 0
+    for key, (track, artist) in seeds.items():
+        entry = await upstream_cache.aget(key)
+        # Anything that would go stale before the next run gets refreshed now
+        if entry is MISS or entry['fresh_until'] <= time.time() + RECS_PREWARM_INTERVAL:
+            try:
+                # One seed at a time, so pre-warming never crowds out real requests
+                await refresh_recommendations(track, artist, recheck=True)
+                warmed += 1
+            except Exception as e:
+                logging.warning(f"Pre-warming {key} failed: {e!r}")
+    logging.info(f"Pre-warmed recommendations for {warmed} of {len(seeds)} seeds")
+
+async def prewarm_forever():
+    # Every worker runs this loop, but only the one holding the lease (in the
+    # shared cache database) pre-warms. If it goes away, another takes over.
+    loop = asyncio.get_running_loop()
+    await asyncio.sleep(random.uniform(10, 60))
+    while True:
+        try:
+            if await loop.run_in_executor(None, upstream_cache.disk.claim, 'lease:recs_prewarm', os.getpid(),
+                                          2 * RECS_PREWARM_INTERVAL):
+                await prewarm_recommendations()
+        except Exception as e:
+            logging.error(f"Pre-warm run failed: {e}")
+        await asyncio.sleep(RECS_PREWARM_INTERVAL * random.uniform(0.9, 1.1))
+
+def start_prewarming():
+    """Start this worker's pre-warm loop, once per event loop (call from async code)"""
+    if RECS_PREWARM_INTERVAL > 0:
+        loop_local('recs_prewarmer', lambda: asyncio.ensure_future(prewarm_forever()))
+
 @app.route('/api/recommendations')
-@async_route
-async def recommendations():
-    """Get recommendations from Last.fm with Deezer fallback"""
+def recommendations():
+    """Get recommendations from our own users' likes, or Last.fm and Deezer ranked together"""
     track = request.args.get('track')
     artist = request.args.get('artist')
+    exclude_liked = wants(request.args, 'exclude_liked')
     
     if not track or not artist:
         return jsonify({"error": "Missing track or artist"}), 400
 
     try:
-        results = []
-        recommendation_source = "lastfm"  # Default source
-        
-        # Try Last.fm first
-        lastfm_url = f"http://ws.audioscrobbler.com/2.0/?method=track.getsimilar&artist={artist}&track={track}&api_key={LASTFM_API_KEY}&format=json&limit=20"
-        async with ClientSession() as session:
-            async with session.get(lastfm_url) as response:
-                if response.status != 200:
-                    logging.warning("Last.fm request failed, falling back to Deezer")
-                    recommendation_source = "deezer"
-                else:
-                    data = await response.json()
-                    similar_tracks = data.get('similartracks', {}).get('track', [])
-                    if not similar_tracks:
-                        recommendation_source = "deezer"
-                        logging.info("No Last.fm results, falling back to Deezer")
-                    else:
-                        for track in similar_tracks:
-                            try:
-                                preview_url = None
-                                album_image = None
-                                spotify_id = None
-                                
-                                # Get Deezer preview and image
-                                deezer_url = f"{DEEZER_API_URL}?q=track:\"{track['name']}\" artist:\"{track['artist']['name']}\""
-                                async with session.get(deezer_url) as deezer_response:
-                                    if deezer_response.status == 200:
-                                        deezer_data = await deezer_response.json()
-                                        if deezer_data.get('data'):
-                                            preview_url = deezer_data['data'][0].get('preview')
-                                            album_image = deezer_data['data'][0].get('album', {}).get('cover_xl')
-                                
-                                # Get Spotify ID
-                                spotify_token = get_spotify_token()
-                                if spotify_token:
-                                    spotify_url = f"https://api.spotify.com/v1/search?q=track:{track['name']} artist:{track['artist']['name']}&type=track&limit=1"
-                                    headers = {"Authorization": f"Bearer {spotify_token}"}
-                                    async with session.get(spotify_url, headers=headers) as spotify_response:
-                                        if spotify_response.status == 200:
-                                            spotify_data = await spotify_response.json()
-                                            if spotify_data.get('tracks', {}).get('items'):
-                                                spotify_id = spotify_data['tracks']['items'][0]['id']
-                                
-                                results.append({
-                                    "id": spotify_id or track.get('mbid', ''),
-                                    "title": track['name'],
-                                    "artist": track['artist']['name'],
-                                    "image": album_image or track.get('image', [{}])[-1].get('#text'),
-                                    "preview_url": preview_url,
-                                    "spotify_id": spotify_id
-                                })
-                            except Exception as e:
-                                logging.error(f"Error processing Last.fm track: {e}")
-                                continue
-
-            # If Last.fm failed or returned no results, use Deezer as fallback
-            if recommendation_source == "deezer":
-                logging.info("Using Deezer fallback for recommendations")
-                # First get the artist ID from Deezer
-                deezer_search = f"{DEEZER_API_URL}?q=artist:\"{artist}\""
-                async with session.get(deezer_search) as response:
-                    deezer_data = await response.json()
-                    if deezer_data.get("data"):
-                        artist_id = deezer_data["data"][0].get("artist", {}).get("id")
-                        if artist_id:
-                            # Get related artists
-                            similar_url = f"https://api.deezer.com/artist/{artist_id}/related"
-                            async with session.get(similar_url) as similar_response:
-                                similar_artists = (await similar_response.json()).get("data", [])
-                                
-                                for similar_artist in similar_artists[:5]:  # Get top 5 similar artists
-                                    # Get top tracks for each similar artist
-                                    artist_tracks_url = f"https://api.deezer.com/artist/{similar_artist['id']}/top"
-                                    async with session.get(artist_tracks_url) as tracks_response:
-                                        artist_tracks = (await tracks_response.json()).get("data", [])
-                                        
-                                        for track in artist_tracks[:4]:  # Get top 4 tracks per artist
-                                            spotify_id = None
-                                            if get_spotify_token():
-                                                # Try to get Spotify ID
-                                                spotify_url = f"https://api.spotify.com/v1/search?q=track:{track['title']} artist:{track['artist']['name']}&type=track&limit=1"
-                                                headers = {"Authorization": f"Bearer {get_spotify_token()}"}
-                                                async with session.get(spotify_url, headers=headers) as spotify_response:
-                                                    if spotify_response.status == 200:
-                                                        spotify_data = await spotify_response.json()
-                                                        if spotify_data.get('tracks', {}).get('items'):
-                                                            spotify_id = spotify_data['tracks']['items'][0]['id']
-                                            
-                                            results.append({
-                                                "id": spotify_id or str(track["id"]),
-                                                "title": track["title"],
-                                                "artist": track["artist"]["name"],
-                                                "image": track["album"]["cover_xl"],
-                                                "preview_url": track["preview"],
-                                                "spotify_id": spotify_id
-                                            })
-
-            # Add source to response
-            return jsonify({
-                "source": recommendation_source,
-                "results": results
-            })
+        # Logged-in users never get songs they've hidden (or, if asked, already liked)
+        excluded = liked = frozenset()
+        if 'user_id' in session:
+            caught_up(session['user_id'])
+            excluded = db.get_hidden_filter(session['user_id'])
+            liked = db.get_liked_filter(session['user_id'])
+            if exclude_liked:
+                excluded = excluded | liked
+
+        # The pipeline runs on this worker's shared event loop and connection pools
+        recommendation_source, results = run_async(get_recommendations(track, artist, excluded, liked))
+
+        # Add source to response
+        return jsonify({
+            "source": recommendation_source,
+            "results": results
+        })
 
     except Exception as e:
         logging.error(f"Recommendations error: {str(e)}")
         return jsonify({"error": "Failed to fetch recommendations"}), 500
 
+async def find_preview_url(track, artist, refresh=False):
+    """Get the Deezer preview URL for a song, from the catalog if we can.
+
+    Deezer preview links expire, so refresh=True skips everything we have
+    remembered and asks Deezer again.
+    """
+    known = None
+    if refresh:
+        upstream_cache.delete(cache_key('deezer', track, artist))
+    else:
+        known = (await lookup_catalog([(track, artist)])).get(normalize_track_key(track, artist))
+        if known and known.get('preview_url'):
+            return known['preview_url']
+
+    deadline = asyncio.get_running_loop().time() + RECOMMENDATIONS_BUDGET
+    deezer = await fetch_deezer_track(get_session(), provider_limits()['deezer'], deadline, track, artist,
+                                      priority=INTERACTIVE)
+    if not deezer or not deezer.get('preview_url'):
+        return None
+    remember_tracks([{
+        "title": track,
+        "artist": artist,
+        "deezer_id": deezer.get('deezer_id'),
+        "preview_url": deezer['preview_url'],
+        "cover_url": deezer.get('image')
+    }])
+    return deezer['preview_url']
+
+def send_cached_preview(path):
+    """Serve a cached preview file (handles Range requests, uses sendfile where available)"""
+    return send_file(path, mimetype='audio/mpeg', conditional=True, max_age=24 * 3600)
+
+@app.route('/api/preview')
+def preview():
+    """Play a song's 30-second preview, cached on disk after the first listen"""
+    track = request.args.get('track')
+    artist = request.args.get('artist')
+
+    if not track or not artist:
+        return jsonify({"error": "Missing track or artist"}), 400
+
+    key = normalize_track_key(track, artist)
+    path = preview_cache.get(key)
+    metrics.inc('tunefuse_preview_requests_total', {"cached": "yes" if path else "no"})
+    if path:
+        return send_cached_preview(path)
+
+    try:
+        upstream = None
+        for refresh in (False, True):
+            preview_url = run_async(find_preview_url(track, artist, refresh=refresh))
+            if not preview_url:
+                return jsonify({"error": "No preview available"}), 404
+            with upstream_call('deezer_preview') as labels:
+                upstream = get_http_session().get(preview_url, stream=True, timeout=10)
+                labels['status'] = upstream.status_code
+            if upstream.status_code == 200:
+                break
+            # Most likely an expired link, so look it up again once
+            upstream.close()
+            upstream = None
+        if upstream is None:
+            return jsonify({"error": "Preview unavailable"}), 502
+    except Exception as e:
+        logging.error(f"Preview error: {str(e)}")
+        return jsonify({"error": "Preview unavailable"}), 502
+
+    # A range request needs the whole file first; previews are only a few hundred KB
+    if request.headers.get('Range'):
+        try:
+            with upstream:
+                path = preview_cache.store(key, upstream.iter_content(PREVIEW_CHUNK_SIZE))
+        except Exception as e:
+            logging.error(f"Preview download error: {str(e)}")
+            return jsonify({"error": "Preview unavailable"}), 502
+        return send_cached_preview(path)
+
+    # Otherwise relay the bytes as they arrive and keep a copy on disk
+    def relay():
+        with upstream, preview_cache.writer(key) as out:
+            for chunk in upstream.iter_content(PREVIEW_CHUNK_SIZE):
+                out.write(chunk)
+                yield chunk
+
+    headers = {"Accept-Ranges": "bytes", "Cache-Control": "public, max-age=86400"}
+    if upstream.headers.get('Content-Length'):
+        headers["Content-Length"] = upstream.headers['Content-Length']
+    return Response(relay(), mimetype='audio/mpeg', headers=headers)
+
+def warm_up():
+    """Load what every worker needs before the first request.
+
+    Under gunicorn with preload_app (see gunicorn.conf.py) this runs once in
+    the parent, and the forked workers share the result instead of each
+    building their own.
+    """
+    started = time.perf_counter()
+    try:
+        local_recommender.rebuild()
+    except Exception as e:
+        logging.error(f"Couldn't build the local recommender: {e}")
+    similarity_index()
+    logging.info(f"Warmed up in {time.perf_counter() - started:.2f}s")
+
+def prepare_for_fork():
+    """Let go of what can't be shared with forked workers (they reopen their own)"""
+    db.close()
+    upstream_cache.disk.close()
+    rate_limiter.close()
+    metrics.clear()
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,137 @@
+"""
+TuneFuse Spotify Token Manager
+
+Spotify hands out client-credentials tokens that stay valid for about an hour,
+so there's no reason to ask for a new one on every search. This module keeps
+one token per process and only goes back to Spotify when it's about to expire:
+- Every caller gets the cached token straight from memory
+- Shortly before expiry we refresh it in the background
+- If lots of requests need a new token at once, only one of them asks Spotify
+"""
+
+import asyncio
+import base64
+import logging
+import threading
+import time
+
+from http_pool import get_http_session
+
+SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"  # Default; server.py passes the configured one
+
+
+class SpotifyTokenManager:
+    def __init__(self, client_id, client_secret, refresh_margin=60, failure_backoff=5, timeout=10,
+                 token_url=SPOTIFY_TOKEN_URL):
+        """Set up an empty token cache for the given Spotify app credentials"""
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_url = token_url
+        self.refresh_margin = refresh_margin    # Refresh this many seconds before expiry
+        self.failure_backoff = failure_backoff  # Don't hammer Spotify after a failed refresh
+        self.timeout = timeout
+
+        self._token = None
+        self._expires_at = 0.0
+        self._retry_at = 0.0
+        self._refresh_lock = threading.Lock()   # Single-flight: one refresh at a time
+        self._state_lock = threading.Lock()
+        self._background_refresh = False
+
+    def _fetch_token(self):
+        """Ask Spotify for a brand new token. Returns (token, expires_in)."""
+        auth_string = f"{self.client_id}:{self.client_secret}"
+        auth_base64 = str(base64.b64encode(auth_string.encode('utf-8')), 'utf-8')
+
+        headers = {
+            "Authorization": f"Basic {auth_base64}",
+            "Content-Type": "application/x-www-form-urlencoded"
+        }
+        data = {"grant_type": "client_credentials"}
+
+        result = get_http_session().post(self.token_url, headers=headers, data=data, timeout=self.timeout)
+        result.raise_for_status()  # Will raise an exception for HTTP errors
+        json_result = result.json()
+        token = json_result.get("access_token")
+
+        if not token:
+            raise Exception("No token received from Spotify")
+
+        return token, int(json_result.get("expires_in", 3600))
+
+    def _is_fresh(self, now):
+        return self._token is not None and now < self._expires_at - self.refresh_margin
+
+    def _is_valid(self, now):
+        return self._token is not None and now < self._expires_at
+
+    def _refresh(self):
+        """Refresh the token, making sure concurrent callers share one request"""
+        with self._refresh_lock:
+            now = time.monotonic()
+            # Somebody else may have refreshed while we were waiting for the lock
+            if self._is_fresh(now):
+                return self._token
+            if now < self._retry_at:
+                return self._token if self._is_valid(now) else None
+
+            try:
+                token, expires_in = self._fetch_token()
+                self._token = token
+                self._expires_at = time.monotonic() + expires_in
+                logging.debug(f"Spotify token refreshed, expires in {expires_in}s")
+                return token
+            except Exception as e:
+                logging.error(f"Error getting Spotify token: {e}")
+                self._retry_at = time.monotonic() + self.failure_backoff
+                return self._token if self._is_valid(time.monotonic()) else None
+
+    def _refresh_in_background(self):
+        """Start a background refresh unless one is already running"""
+        with self._state_lock:
+            if self._background_refresh:
+                return
+            self._background_refresh = True
+
+        def run():
+            try:
+                self._refresh()
+            finally:
+                self._background_refresh = False
+
+        threading.Thread(target=run, name="spotify-token-refresh", daemon=True).start()
+
+    def _cached_token(self):
+        """Return the cached token if it can be used right now, or None"""
+        now = time.monotonic()
+        if self._is_fresh(now):
+            return self._token
+        if self._is_valid(now):
+            # Still good for a little while, so hand it out and refresh behind the scenes
+            self._refresh_in_background()
+            return self._token
+        return None
+
+    def get_token(self):
+        """Get a valid Spotify token, only blocking if we have none at all."""
+        return self._cached_token() or self._refresh()
+
+    async def get_token_async(self):
+        """Same as get_token, but never blocks the event loop on a refresh."""
+        token = self._cached_token()
+        if token:
+            return token
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._refresh)
+
+    def invalidate(self, rejected=None):
+        """Forget the cached token (e.g. after Spotify rejects it with a 401).
+
+        Pass the rejected token: when several calls get a 401 at once, only the
+        first one forgets it, and the others pick up its replacement instead of
+        throwing that away too.
+        """
+        if rejected is not None and rejected != self._token:
+            return
+        self._token = None
+        self._expires_at = 0.0
@@ -0,0 +1,73 @@
+"""
+Regression tests for the search-as-you-type cache.
+
+Run from this folder with:
+    python -m pytest -q
+"""
+
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+from autocomplete import Autocomplete
+
+
+class InstantPool:
+    """Stands in for the thread pool: runs the call right away, so the future is done before anyone waits"""
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def search_in_thread(autocomplete, query, timeout=5):
+    """Run a search on another thread and fail the test if it never comes back"""
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = autocomplete.search(query)
+        except Exception as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "search hung"
+    return outcome
+
+
+def test_instant_answer_does_not_deadlock():
+    results = [{"id": "1", "name": "Hello", "artist": "Adele"}]
+    autocomplete = Autocomplete(lambda query: results)
+    autocomplete._pool = InstantPool()
+
+    assert search_in_thread(autocomplete, "hello") == {'result': results}
+    assert autocomplete._inflight == {}
+    # And it was cached for next time
+    assert autocomplete.cache.get("hello") == results
+
+
+def test_instant_failure_does_not_deadlock():
+    def fetch(query):
+        raise RuntimeError("circuit open")
+
+    autocomplete = Autocomplete(fetch)
+    autocomplete._pool = InstantPool()
+
+    outcome = search_in_thread(autocomplete, "hello")
+    assert isinstance(outcome['error'], RuntimeError)
+    assert autocomplete._inflight == {}
+
+    # The lock was released, so the next search isn't stuck behind it
+    outcome = search_in_thread(autocomplete, "hello again")
+    assert isinstance(outcome['error'], RuntimeError)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-q'])
@@ -0,0 +1,135 @@
+"""
+Tests for getting a new Spotify token when Spotify rejects ours with a 401.
+
+Run from this folder with:
+    python -m pytest -q
+"""
+
+import asyncio
+import importlib
+import os
+
+import pytest
+
+from spotify_auth import SpotifyTokenManager
+
+
+def token_manager(tokens):
+    """A token manager that hands out the given tokens in order, counting how many it fetched"""
+    manager = SpotifyTokenManager('id', 'secret')
+    issued = iter(tokens)
+    manager.fetched = 0
+
+    def fetch_token():
+        manager.fetched += 1
+        return next(issued), 3600
+    manager._fetch_token = fetch_token
+    return manager
+
+
+def test_invalidate_forgets_the_rejected_token():
+    tokens = token_manager(['old', 'new'])
+    assert tokens.get_token() == 'old'
+    tokens.invalidate('old')
+    assert tokens.get_token() == 'new'
+    assert tokens.fetched == 2
+
+
+def test_invalidate_keeps_a_token_that_already_replaced_it():
+    tokens = token_manager(['old', 'new', 'newer'])
+    tokens.get_token()
+    tokens.invalidate('old')
+    assert tokens.get_token() == 'new'
+    # A second call that was rejected with the old token mustn't throw away the new one
+    tokens.invalidate('old')
+    assert tokens.get_token() == 'new'
+    assert tokens.fetched == 2
+
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    """The Flask app's module, with its databases and caches in a scratch folder"""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('app'))
+    os.environ['RECS_PREWARM_INTERVAL'] = '0'
+    try:
+        yield importlib.import_module('server')
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def revoked(server, monkeypatch):
+    """Spotify has revoked 'old'; only 'new' works"""
+    tokens = token_manager(['old', 'new'])
+    tokens.get_token()
+    monkeypatch.setattr(server, 'spotify_tokens', tokens)
+    server.breakers['spotify'].record_success()
+    return tokens
+
+
+SEARCH_ANSWER = {"tracks": {"items": [{
+    "id": "abc", "name": "Song 1", "artists": [{"name": "Artist 1"}], "album": {"images": []}
+}]}}
+
+
+class FakeResponse:
+    def __init__(self, authorization):
+        self.status_code = self.status = 200 if authorization == 'Bearer new' else 401
+        self.headers = {}
+
+    def raise_for_status(self):
+        if self.status_code != 200:
+            raise RuntimeError(f"{self.status_code} from Spotify")
+
+    def json(self):
+        return SEARCH_ANSWER
+
+
+class FakeSession:
+    def get(self, url, headers=None, **kwargs):
+        return FakeResponse(headers['Authorization'])
+
+
+class FakeAsyncResponse(FakeResponse):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def json(self):
+        return SEARCH_ANSWER
+
+
+class FakeAsyncSession:
+    def get(self, url, headers=None, **kwargs):
+        return FakeAsyncResponse(headers['Authorization'])
+
+
+def test_search_retries_with_a_new_token_after_401(server, revoked, monkeypatch):
+    monkeypatch.setattr(server, 'get_http_session', FakeSession)
+    results = server.spotify_search('song 1')
+    assert [r['id'] for r in results] == ['abc']
+    assert revoked.fetched == 2
+
+
+def test_async_search_retries_with_a_new_token_after_401(server, revoked, monkeypatch):
+    monkeypatch.setattr(server, 'get_session', FakeAsyncSession)
+    results = asyncio.run(server.spotify_search_async('song 1'))
+    assert [r['id'] for r in results] == ['abc']
+    assert revoked.fetched == 2
+
+
+def test_id_lookup_retries_with_a_new_token_after_401(server, revoked, monkeypatch):
+    async def fetch_json(session, provider, url, deadline, headers=None, **kwargs):
+        if headers['Authorization'] != 'Bearer new':
+            raise server.UpstreamError("401 from spotify", 401)
+        return SEARCH_ANSWER
+    monkeypatch.setattr(server, 'fetch_json', fetch_json)
+
+    async def lookup():
+        deadline = asyncio.get_running_loop().time() + 5
+        return await server.fetch_spotify_id(None, asyncio.Semaphore(1), deadline, 'old', 'Revoked Song', 'Artist 1')
+    assert asyncio.run(lookup()) == 'abc'
+    assert revoked.fetched == 2
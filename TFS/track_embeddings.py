@@ -0,0 +1,139 @@
+"""
+TuneFuse Song Embeddings
+
+Turns everything we know about which songs go together into a short vector
+per song, and keeps the similarity index (ann_index.py) up to date:
+- Co-likes: songs liked by the same user (minus songs they later hid)
+- Last.fm "similar track" links we've fetched for recommendations
+
+Songs that are close in this space are songs our users and Last.fm both
+think belong together, even when nobody has linked them directly.
+
+Usage (from cron, or by hand):
+    python track_embeddings.py          # add songs that are new since the last build
+    python track_embeddings.py --full   # retrain everything from scratch
+"""
+
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+from scipy import sparse
+from dotenv import load_dotenv
+
+from ann_index import IVFIndex, normalize_rows
+from database import Database, normalize_track_key
+from local_recs import co_like_matrix
+
+load_dotenv()
+SIMILARITY_INDEX_DIR = os.getenv("SIMILARITY_INDEX_DIR", "similarity_index")
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "64"))
+LASTFM_EDGE_WEIGHT = float(os.getenv("LASTFM_EDGE_WEIGHT", "2"))  # One Last.fm link counts like this many co-likes
+MAX_USER_LIKES = int(os.getenv("LOCAL_RECS_MAX_USER_LIKES", "500"))  # Newest likes per user that count as co-likes
+
+
+def affinity_graph(db):
+    """All songs we know links for, and a symmetric sparse matrix of how strongly they're linked"""
+    keys, index = [], {}
+
+    def song(key):
+        if key not in index:
+            index[key] = len(keys)
+            keys.append(key)
+        return index[key]
+
+    # Co-likes, from each user's newest likes
+    user_likes, last_id = {}, 0
+    while True:
+        rows = db.get_likes_since(last_id)
+        if not rows:
+            break
+        for _, user_id, _, title, artist, _ in rows:
+            liked = user_likes.setdefault(user_id, {})
+            song_index = song(normalize_track_key(title, artist))
+            liked.pop(song_index, None)
+            liked[song_index] = None
+        last_id = rows[-1][0]
+
+    # Last.fm links
+    sources, targets, weights, last_rowid = [], [], [], 0
+    while True:
+        rows = db.get_track_edges_since(last_rowid)
+        if not rows:
+            break
+        for _, source_key, target_key, weight in rows:
+            sources.append(song(source_key))
+            targets.append(song(target_key))
+            weights.append(weight)
+        last_rowid = rows[-1][0]
+
+    size = len(keys)
+    co_likes = co_like_matrix(user_likes.values(), size, MAX_USER_LIKES).astype(np.float64)
+    co_likes.setdiag(0)
+    links = sparse.csr_matrix((np.asarray(weights, dtype=np.float64) * LASTFM_EDGE_WEIGHT, (sources, targets)),
+                              shape=(size, size))
+    graph = (co_likes + links + links.T).tocsr()
+    graph.eliminate_zeros()
+    return keys, graph
+
+
+def spectral_embeddings(graph, dim, oversample=10, power_iterations=3, seed=0):
+    """Embeddings from the top singular vectors of the degree-normalized graph (randomized SVD)"""
+    degrees = np.asarray(graph.sum(axis=1)).ravel()
+    scale = sparse.diags(1 / np.sqrt(np.maximum(degrees, 1e-12)))
+    normalized = (scale @ graph @ scale).tocsr()
+
+    rank = min(dim, graph.shape[0])
+    sketch = normalized @ np.random.default_rng(seed).normal(size=(graph.shape[0], rank + oversample))
+    for _ in range(power_iterations):
+        sketch, _ = np.linalg.qr(sketch)
+        sketch = normalized @ (normalized.T @ sketch)
+    basis, _ = np.linalg.qr(sketch)
+    small_u, singular_values, _ = np.linalg.svd((normalized.T @ basis).T, full_matrices=False)
+    vectors = (basis @ small_u[:, :rank]) * np.sqrt(singular_values[:rank])
+    return normalize_rows(vectors)
+
+
+def update_index(db, directory=SIMILARITY_INDEX_DIR, dim=EMBEDDING_DIM, full=False):
+    """Bring the saved similarity index up to date. Returns the number of songs added."""
+    started = time.perf_counter()
+    keys, graph = affinity_graph(db)
+    linked = np.flatnonzero(graph.getnnz(axis=1))
+    if not len(linked):
+        logging.info("No song links yet, nothing to index")
+        return 0
+
+    index = None if full or IVFIndex.current_version(directory) is None else IVFIndex.load(directory)
+    if index is None:
+        graph = graph[linked][:, linked]
+        vectors = spectral_embeddings(graph, dim)
+        index = IVFIndex.build([keys[i] for i in linked], vectors)
+        added = len(linked)
+    else:
+        # New songs are placed at the weighted average of the indexed songs they're linked to
+        known = np.array([index.vector(key) is not None for key in keys])
+        new = linked[~known[linked]]
+        known_rows = np.flatnonzero(known)
+        known_vectors = np.vstack([index.vector(keys[i]) for i in known_rows]) if len(known_rows) else None
+        added = 0
+        if len(new) and known_vectors is not None:
+            vectors = graph[new][:, known_rows] @ known_vectors
+            placed = np.linalg.norm(vectors, axis=1) > 0  # Songs only linked to other new songs wait for --full
+            index.add([keys[i] for i in new[placed]], vectors[placed])
+            added = int(placed.sum())
+
+    index.save(directory)
+    logging.info(f"Similarity index updated: {added} songs added, {len(index)} total, "
+                 f"in {time.perf_counter() - started:.1f}s")
+    return added
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build or update the song similarity index")
+    parser.add_argument('--full', action='store_true', help="retrain everything from scratch")
+    parser.add_argument('--dim', type=int, default=EMBEDDING_DIM, help="embedding size")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    update_index(Database(), dim=args.dim, full=args.full)
@@ -0,0 +1,132 @@
+"""
+TuneFuse Write-Behind Queue
+
+Every like, unlike, hide and unhide is its own transaction with its own
+commit (and fsync), and the user's request waits for it. In write-behind
+mode the request doesn't wait:
+- The change goes on an in-memory queue and the request returns straight away
+- One writer thread takes everything that's waiting and applies it in a
+  single transaction (group commit), so a burst of clicks costs one commit
+- Reading your own library first waits for your queued changes to be
+  committed, so a like always shows up in your next listing (on this worker)
+- The queue is bounded; when it's full, requests wait for the writer to
+  catch up instead of piling up more work
+
+Changes still in the queue are lost if the process is killed, so this trades
+a few milliseconds of durability for speed. The queue is drained on a normal
+exit.
+"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+
+
+class WriteBehindQueue:
+    def __init__(self, db, max_size=10000, max_batch=500, put_timeout=5):
+        """Queue for db.apply_song_changes(). max_size is how many submits may wait at once."""
+        self.db = db
+        self.max_batch = max_batch  # Most changes per transaction
+        self.put_timeout = put_timeout  # Seconds a request waits for room in a full queue
+        self._queue = queue.Queue(maxsize=max_size)
+        self._put_lock = threading.Lock()  # Keeps sequence numbers in queue order
+        self._committed = threading.Condition()
+        self._next_seq = 0
+        self._committed_seq = 0  # Everything up to here is in the database
+        self._user_seqs = {}  # user_id -> sequence number of their newest queued change
+        self._thread = None
+        self._pid = None
+        self.batches = 0
+        self.changes = 0
+        self.failed = 0
+        atexit.register(self.flush)
+
+    def _start(self):
+        # A forked worker doesn't inherit the writer thread, so it starts its own
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="song-writer", daemon=True)
+            self._thread.start()
+
+    def submit(self, changes):
+        """Queue a list of Database.song_change()s. False if the queue stayed full for put_timeout."""
+        if not changes:
+            return True
+        self._start()
+        with self._put_lock:
+            seq = self._next_seq + 1
+            try:
+                self._queue.put((seq, changes), timeout=self.put_timeout)
+            except queue.Full:
+                logging.error("Song write queue is full, dropping changes")
+                return False
+            self._next_seq = seq
+            with self._committed:
+                for _, row, _ in changes:
+                    self._user_seqs[row[0]] = seq
+        return True
+
+    def wait_for_user(self, user_id, timeout=5):
+        """Wait until every change queued for a user so far is committed. False on timeout."""
+        with self._committed:
+            seq = self._user_seqs.get(user_id)
+            if seq is None:
+                return True
+            done = self._committed.wait_for(lambda: self._committed_seq >= seq, timeout)
+            if done and self._user_seqs.get(user_id) == seq:
+                del self._user_seqs[user_id]
+            return done
+
+    def flush(self, timeout=10):
+        """Wait until everything queued so far is committed"""
+        with self._committed:
+            if self._thread is None or self._pid != os.getpid():
+                return self._committed_seq >= self._next_seq
+            seq = self._next_seq
+            return self._committed.wait_for(lambda: self._committed_seq >= seq, timeout)
+
+    def _run(self):
+        while True:
+            seq, changes = self._queue.get()
+            changes = list(changes)
+            # Whatever queued up while we were busy goes into the same transaction
+            while len(changes) < self.max_batch:
+                try:
+                    seq, more = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                changes.extend(more)
+            self._apply(changes)
+
+            with self._committed:
+                self._committed_seq = seq
+                for _, row, _ in changes:
+                    if self._user_seqs.get(row[0], 0) <= seq:
+                        self._user_seqs.pop(row[0], None)
+                self._committed.notify_all()
+
+    def _apply(self, changes):
+        try:
+            if self.db.apply_song_changes(changes):
+                self.batches += 1
+                self.changes += len(changes)
+                return
+            # One bad change shouldn't take the rest of the batch down with it
+            for change in changes:
+                if self.db.apply_song_changes([change]):
+                    self.changes += 1
+                else:
+                    self.failed += 1
+        except Exception as e:
+            logging.error(f"Song writer failed: {e}")
+            self.failed += len(changes)
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "batches": self.batches,
+            "changes": self.changes,
+            "failed": self.failed
+        }